@@ -0,0 +1,139 @@
+"""
+Микробенчмарк разбора колбэков: старая цепочка лямбда-фильтров против
+CallbackRouter из bot.py (словарь префиксов + кодеки) по мере роста числа хендлеров.
+
+Для каждого N собираются два aiogram-роутера с N колбэк-хендлерами одинаковой формы
+("<префикс>:<дата>:<время>"): в первом каждый хендлер висит на своём
+`lambda c: c.data and c.data.startswith(...)` и сам разбирает данные через split,
+во втором — один хендлер CallbackRouter. Синхронные лямбды aiogram выполняет
+в пуле потоков, так что цепочка платит за переход в поток на каждый проверенный
+фильтр. Нажатия равномерно распределены по всем хендлерам, время — на один апдейт
+через TelegramEventObserver.trigger, без сети и базы.
+
+    python bench_callbacks.py --handlers 8,32,128,512 --updates 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+# bot.py читает настройки при импорте; базу он при этом не открывает
+os.environ.setdefault("API_TOKEN", "123456:BENCH")
+os.environ.setdefault("MASTER_CHAT_ID", "1")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-callbacks-"), "bench.db"))
+os.environ.setdefault("METRICS_PORT", "0")
+
+from aiogram import Router, types  # noqa: E402
+
+import bot  # noqa: E402
+
+DATE_ISO = "2026-03-14"
+TIME_STR = "15:30"
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Стоимость разбора колбэков: цепочка фильтров против таблицы префиксов")
+    p.add_argument("--handlers", default="8,32,128,512", help="числа хендлеров через запятую")
+    p.add_argument("--updates", type=int, default=2000, help="апдейтов на каждый замер")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="итог одной JSON-строкой")
+    return p.parse_args()
+
+# ================= ДВА РОУТЕРА =================
+
+def chain_router(n: int) -> Tuple[Router, List[str]]:
+    """Как было: по хендлеру на префикс, каждый со своим лямбда-фильтром и split внутри."""
+    router = Router()
+    data: List[str] = []
+    for i in range(n):
+        prefix = f"r{i}:"
+
+        async def handler(call: types.CallbackQuery) -> Tuple[str, str]:
+            # время содержит ":", поэтому split ограничен тремя частями
+            _, date_iso, time_str = call.data.split(":", 2)
+            return date_iso, time_str
+
+        router.callback_query.register(handler, lambda c, prefix=prefix: c.data and c.data.startswith(prefix))
+        data.append(f"{prefix}{DATE_ISO}:{TIME_STR}")
+    return router, data
+
+def table_router(n: int) -> Tuple[Router, List[str]]:
+    """Как стало: один хендлер CallbackRouter, данные разбирает кодек."""
+    router = Router()
+    callbacks = bot.CallbackRouter()
+    data: List[str] = []
+    for i in range(n):
+        codec = bot.CallbackCodec(f"r{i}", bot.TimeCb, bot.CB_DATE, bot.CB_TIME)
+
+        @callbacks.route(codec)
+        async def handler(call: types.CallbackQuery, cb: bot.TimeCb) -> Tuple[str, str]:
+            return cb.date_iso, cb.time_str
+
+        data.append(codec.pack(DATE_ISO, TIME_STR))
+
+    @callbacks.stale
+    async def stale(call: types.CallbackQuery) -> None:
+        return None
+
+    router.callback_query.register(callbacks.dispatch, callbacks.resolve)
+    return router, data
+
+# ================= ЗАМЕР =================
+
+def make_calls(data: List[str], count: int, rnd: random.Random) -> List[types.CallbackQuery]:
+    user = types.User(id=1, is_bot=False, first_name="bench")
+    return [
+        types.CallbackQuery(id=str(i), from_user=user, chat_instance="bench", data=rnd.choice(data))
+        for i in range(count)
+    ]
+
+async def measure(router: Router, calls: List[types.CallbackQuery]) -> float:
+    """Микросекунд на апдейт."""
+    observer = router.callback_query
+    # прогрев: первые вызовы разбирают сигнатуры хендлеров
+    for call in calls[:100]:
+        await observer.trigger(call)
+    started = time.perf_counter()
+    for call in calls:
+        result = await observer.trigger(call)
+        if result != (DATE_ISO, TIME_STR):
+            raise RuntimeError(f"колбэк {call.data!r} разобран неверно: {result!r}")
+    return (time.perf_counter() - started) / len(calls) * 1e6
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    rows: List[Dict[str, Any]] = []
+    for n in (int(x) for x in args.handlers.split(",") if x.strip()):
+        chain, chain_data = chain_router(n)
+        table, table_data = table_router(n)
+        chain_us = await measure(chain, make_calls(chain_data, args.updates, random.Random(args.seed)))
+        table_us = await measure(table, make_calls(table_data, args.updates, random.Random(args.seed)))
+        rows.append({
+            "handlers": n,
+            "chain_us": round(chain_us, 2),
+            "table_us": round(table_us, 2),
+            "speedup": round(chain_us / table_us, 2) if table_us else 0.0,
+            "chain_bytes": max(len(d.encode()) for d in chain_data),
+            "table_bytes": max(len(d.encode()) for d in table_data),
+        })
+    return rows
+
+def print_report(rows: List[Dict[str, Any]]) -> None:
+    print(f"{'хендлеров':>10}{'цепочка, мкс':>15}{'таблица, мкс':>15}{'выигрыш':>10}{'байт (было→стало)':>20}")
+    for r in rows:
+        size = f"{r['chain_bytes']}→{r['table_bytes']}"
+        print(f"{r['handlers']:>10}{r['chain_us']:>15.2f}{r['table_us']:>15.2f}{r['speedup']:>9.2f}×{size:>20}")
+    print("(время — на один апдейт через observer.trigger, нажатия равномерно по всем хендлерам)")
+
+def main() -> None:
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps({"updates": args.updates, "rows": rows}))
+    else:
+        print_report(rows)
+
+if __name__ == "__main__":
+    main()
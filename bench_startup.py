@@ -0,0 +1,255 @@
+"""
+Замер холодного старта bot.py: интерпретатор, импорт, инициализация базы
+и задержка до ответа на первый апдейт.
+
+Каждый прогон — отдельный процесс `python bench_startup.py --child`, который
+импортирует bot и запускает main() в режиме polling против локального фейкового
+Bot API. Фейк отдаёт один /start на первый getUpdates и засекает первый sendMessage.
+Первый прогон идёт на пустой базе (миграции), остальные — на уже готовой.
+
+    python bench_startup.py --runs 5 --importtime 15
+"""
+import time
+
+_T0 = time.time()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import signal  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+from typing import Any, Dict, List, Optional  # noqa: E402
+
+FAKE_API_HOST = "127.0.0.1"
+CHILD_MARK = "BENCH "
+CHAT_ID = 777
+# этапы bot.main() из bot.startup_phases
+STARTUP_PHASES = ("db_open", "db_init", "tls", "api", "services", "ready", "warm_up")
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Замер времени старта бота")
+    p.add_argument("--runs", type=int, default=5, help="сколько запусков (первый — на пустой базе)")
+    p.add_argument("--port", type=int, default=18191)
+    p.add_argument("--importtime", type=int, default=0, help="показать N самых тяжёлых импортов (python -X importtime)")
+    p.add_argument("--timeout", type=float, default=60.0, help="сколько ждать ответа на первый апдейт, сек")
+    p.add_argument("--verbose", action="store_true", help="не прятать логи бота")
+    p.add_argument("--json", action="store_true", help="итог одной JSON-строкой")
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return p.parse_args()
+
+# ================= ДОЧЕРНИЙ ПРОЦЕСС =================
+
+def child_main() -> None:
+    def report(**fields: Any) -> None:
+        print(CHILD_MARK + json.dumps(fields), flush=True)
+
+    started = time.time()
+    import bot
+
+    report(started=_T0, import_s=time.time() - started)
+    try:
+        asyncio.run(bot.main())
+    finally:
+        report(phases=bot.startup_phases)
+
+# ================= ФЕЙКОВЫЙ BOT API =================
+
+class FakeApi:
+    """Минимальный Bot API: один /start на первый getUpdates и отметки времени."""
+
+    def __init__(self) -> None:
+        self.first_poll: Optional[float] = None
+        self.first_reply: Optional[float] = None
+        self.replied = asyncio.Event()
+        self._update_id = 0
+
+    def reset(self) -> None:
+        self.first_poll = None
+        self.first_reply = None
+        self.replied = asyncio.Event()
+
+    async def handle(self, request: Any) -> Any:
+        from aiohttp import web
+
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        result: Any = True
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            if self.first_poll is None:
+                self.first_poll = time.time()
+                self._update_id += 1
+                result = [{
+                    "update_id": self._update_id,
+                    "message": {
+                        "message_id": 1,
+                        "date": int(time.time()),
+                        "chat": {"id": CHAT_ID, "type": "private"},
+                        "from": {"id": CHAT_ID, "is_bot": False, "first_name": "bench"},
+                        "text": "/start",
+                        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                    },
+                }]
+            else:
+                await asyncio.sleep(0.2)
+                result = []
+        elif method in ("sendMessage", "editMessageText"):
+            if self.first_reply is None and int(data.get("chat_id", 0)) == CHAT_ID:
+                self.first_reply = time.time()
+                self.replied.set()
+            result = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                "text": str(data.get("text", "")),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    async def serve(self, port: int) -> Any:
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, FAKE_API_HOST, port).start()
+        return runner
+
+# ================= ПРОГОНЫ =================
+
+def child_env(args: argparse.Namespace, db_path: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "API_TOKEN": "123456:BENCH",
+        "MASTER_CHAT_ID": "1",
+        "DB_PATH": db_path,
+        "TELEGRAM_API_URL": f"http://{FAKE_API_HOST}:{args.port}",
+        "BOT_MODE": "polling",
+        "BOT_WORKERS": "1",
+        "METRICS_PORT": "0",
+    })
+    return env
+
+async def run_once(args: argparse.Namespace, fake: FakeApi, db_path: str) -> Dict[str, float]:
+    fake.reset()
+    spawned = time.time()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "--child",
+        env=child_env(args, db_path),
+        stdout=subprocess.PIPE,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.wait_for(fake.replied.wait(), args.timeout)
+        # даём прогреву досчитаться, чтобы он попал в отчёт
+        await asyncio.sleep(0.5)
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+        out, _ = await proc.communicate()
+
+    child: Dict[str, Any] = {}
+    for line in out.decode().splitlines():
+        if line.startswith(CHILD_MARK):
+            child.update(json.loads(line[len(CHILD_MARK):]))
+    phases = child.get("phases", {})
+    return {
+        "interpreter_s": child["started"] - spawned,
+        "import_s": child["import_s"],
+        **{f"{name}_s": phases.get(name, 0.0) for name in STARTUP_PHASES},
+        "first_poll_s": fake.first_poll - spawned,
+        "first_update_s": fake.first_reply - fake.first_poll,
+        "total_s": fake.first_reply - spawned,
+    }
+
+def import_breakdown(args: argparse.Namespace, db_path: str, top: int) -> List[Dict[str, Any]]:
+    """Два верхних уровня python -X importtime: кто из зависимостей сколько стоит."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bot"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=child_env(args, db_path),
+        capture_output=True,
+        text=True,
+    )
+    roots: List[Dict[str, Any]] = []
+    children: List[Dict[str, Any]] = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time: self | cumulative | name"; вложенность — отступом имени,
+        # вложенные модули печатаются раньше того, кто их импортировал
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        row = {"module": name.strip(), "cumulative_ms": int(cumulative) / 1000}
+        if depth == 1:
+            children.append(row)
+        elif depth == 0:
+            row["children"] = sorted(children, key=lambda r: r["cumulative_ms"], reverse=True)[:top]
+            roots.append(row)
+            children = []
+    roots.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+    return roots[:top]
+
+def summarize(runs: List[Dict[str, float]]) -> Dict[str, Any]:
+    warm = runs[1:] or runs
+    return {
+        "cold_db": runs[0],
+        "warm_db_median": {k: statistics.median(r[k] for r in warm) for k in warm[0]},
+        "runs": len(runs),
+    }
+
+def print_report(summary: Dict[str, Any], imports: List[Dict[str, Any]]) -> None:
+    labels = [
+        ("interpreter_s", "запуск интерпретатора"),
+        ("import_s", "import bot"),
+        ("db_open_s", "  открытие базы"),
+        ("db_init_s", "  init_db (параллельно)"),
+        ("tls_s", "  TLS-контекст (параллельно)"),
+        ("api_s", "  deleteWebhook + getMe (параллельно)"),
+        ("services_s", "  мастера, outbox, напоминания"),
+        ("ready_s", "main() до приёма апдейтов"),
+        ("first_poll_s", "от запуска до первого getUpdates"),
+        ("first_update_s", "первый апдейт → ответ"),
+        ("total_s", "от запуска до первого ответа"),
+        ("warm_up_s", "фоновый прогрев"),
+    ]
+    cold, warm = summary["cold_db"], summary["warm_db_median"]
+    print(f"{'этап':<36}{'пустая база':>14}{'готовая база':>14}")
+    for key, title in labels:
+        print(f"{title:<36}{cold[key] * 1000:>11.1f} мс{warm[key] * 1000:>11.1f} мс")
+    print(f"(готовая база — медиана по {summary['runs'] - 1 or 1} запускам)")
+    if imports:
+        print("\nсамые тяжёлые импорты (cumulative):")
+        for row in imports:
+            print(f"  {row['module']:<40}{row['cumulative_ms']:>9.1f} мс")
+            for child in row["children"]:
+                print(f"    {child['module']:<38}{child['cumulative_ms']:>9.1f} мс")
+
+async def main() -> None:
+    args = parse_args()
+    tmpdir = tempfile.mkdtemp(prefix="bench-startup-")
+    db_path = os.path.join(tmpdir, "bench.db")
+    fake = FakeApi()
+    runner = await fake.serve(args.port)
+    try:
+        runs = [await run_once(args, fake, db_path) for _ in range(max(1, args.runs))]
+    finally:
+        await runner.cleanup()
+    imports = import_breakdown(args, db_path, args.importtime) if args.importtime else []
+
+    summary = summarize(runs)
+    if args.json:
+        print(json.dumps({**summary, "imports": imports}))
+    else:
+        print_report(summary, imports)
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child_main()
+    else:
+        asyncio.run(main())
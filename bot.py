@@ -1,22 +1,51 @@
 import asyncio
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import signal
+import threading
+import time
+import bisect
 import datetime
-from typing import List, Tuple, Optional, Any
+import functools
+import heapq
+from contextlib import aclosing, asynccontextmanager, suppress
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, List, Tuple, Optional, Any, AsyncIterator, Awaitable, Dict, Set, Callable, NamedTuple, Sequence, TextIO, Union
 
 import aiosqlite
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from pydantic import ConfigDict
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey, DEFAULT_DESTINY
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendMessage
+from aiogram.methods.base import TelegramMethod
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     KeyboardButton,
     ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
 )
 
+if TYPE_CHECKING:
+    # aiohttp.web и вебхук aiogram (~25 мс импорта) нужны только серверам: грузим их в функциях
+    from aiohttp import web
+
 # ================= НАСТРОЙКИ =================
 
 API_TOKEN = os.getenv("API_TOKEN")
@@ -27,296 +56,3711 @@ MASTER_CHAT_ID_RAW = os.getenv("MASTER_CHAT_ID")
 if not MASTER_CHAT_ID_RAW:
     raise RuntimeError("ENV MASTER_CHAT_ID is not set")
 MASTER_CHAT_ID = int(MASTER_CHAT_ID_RAW)
+# MASTER_CHAT_ID — это мастер №1; остальных мастеров добавляют командой /addmaster
+DEFAULT_MASTER_ID = 1
+MASTER_NAME = os.getenv("MASTER_NAME", "Мастер")
 
 DB_PATH = os.getenv("DB_PATH", "appointments.db")
 
 # Ссылку в канал задашь позже — просто поменяй тут
 CHANNEL_URL = os.getenv("CHANNEL_URL", "https://t.me/your_channel_here")
 
-logging.basicConfig(level=logging.INFO)
+# FSM: сколько живёт брошенное состояние и как долго копим изменения перед записью в базу
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+FSM_FLUSH_DELAY = float(os.getenv("FSM_FLUSH_DELAY", "1.0"))
+
+# Режим работы: polling (по умолчанию, для разработки) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))
+
+# Сколько процессов-воркеров обрабатывают апдейты; больше 1 — фронт раздаёт апдейты по воркерам
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
+# Расписание: часы по дням недели, перерывы, выходные, услуги (JSON, см. DEFAULT_SCHEDULE)
+SCHEDULE_JSON = os.getenv("SCHEDULE_JSON", "")
+
+# Сколько секунд слот держится за клиентом между выбором времени и подтверждением
+SLOT_HOLD_TTL = int(os.getenv("SLOT_HOLD_TTL", "300"))
+
+# Очередь уведомлений: лимиты Telegram и ретраи
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))  # сообщений/сек на бота (лимит ~30)
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # сообщений/сек в один чат
+OUTBOX_DIGEST_WINDOW = float(os.getenv("OUTBOX_DIGEST_WINDOW", "3"))  # сек, копим уведомления мастеру в сводку
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+
+# Через сколько дней прошедшие записи уезжают в архив (appointments_history)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+
+# Напоминания клиенту: за сколько часов до записи (через запятую)
+REMINDER_HOURS = [int(h) for h in os.getenv("REMINDER_HOURS", "24,2").split(",") if h.strip()]
+
+# Лист ожидания: скольким ждущим сразу сообщаем об освободившемся времени и через сколько секунд
+# пишем следующим по очереди, если слот так никто и не занял
+WAITLIST_BATCH = int(os.getenv("WAITLIST_BATCH", "5"))
+WAITLIST_BATCH_DELAY = float(os.getenv("WAITLIST_BATCH_DELAY", "120"))
+
+# Рассылки: сколько сообщений в секунду рассылка берёт из общего лимита бота (остальное — уведомлениям),
+# сколько отправок идёт одновременно и сколько получателей читаем из базы за раз (шаг сохранения прогресса)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+
+# Другой адрес Bot API (локальный bot-api сервер или фейковый Telegram в тестах)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Антифлуд: сколько апдейтов в секунду пропускаем от одного пользователя и запас на короткий всплеск
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "2"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "6"))
+
+# Метрики Prometheus на локальном порту (/metrics); 0 — не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Секрет в адресе ICS-ленты для подписки календаря мастера; пусто — ленты нет
+ICS_FEED_TOKEN = os.getenv("ICS_FEED_TOKEN", "")
+
+# Логи: уровень, формат (json — одна запись на строку, text — как раньше) и выборка частых записей:
+# из строк «Update id=... is handled», которые aiogram пишет на каждый апдейт, выводим каждую N-ю
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+
+# Журнал записей и отмен (audit_log): сколько дней хранить
+AUDIT_KEEP_DAYS = int(os.getenv("AUDIT_KEEP_DAYS", "365"))
+
+# ================= ЛОГИ =================
+
+# больше записей в очереди не держим: лучше потерять строку лога, чем память или цикл событий
+LOG_QUEUE_SIZE = 10_000
+# логгеры, которые пишут по записи на каждый апдейт
+LOG_SAMPLED_LOGGERS = ("aiogram.event",)
+# стандартные атрибуты LogRecord; всё остальное пришло через extra= и попадает в JSON полями
+_LOG_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """Запись — одна строка JSON: время, уровень, логгер, сообщение, поля из extra= и трассировка."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str, separators=(",", ":"))
+
+class SamplingFilter(logging.Filter):
+    """
+    Из INFO-записей частых логгеров пропускает каждую every-ю и помечает её полем
+    sample=every; WARNING и выше проходят всегда.
+    """
+
+    def __init__(self, loggers: Tuple[str, ...], every: int):
+        super().__init__()
+        self.loggers = frozenset(loggers)
+        self.every = max(1, every)
+        self.dropped = 0
+        self._seen = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1 or record.levelno >= logging.WARNING or record.name not in self.loggers:
+            return True
+        self._seen += 1
+        if self._seen % self.every != 1:
+            self.dropped += 1
+            return False
+        record.sample = self.every
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь и не ждёт: если очередь полна, запись отбрасывается и считается."""
+
+    def __init__(self, q: "queue.Queue[logging.LogRecord]"):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # в цикле событий только подставляем аргументы; JSON и трассировку собирает поток-слушатель
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    """
+    Корневой логгер не пишет в консоль сам: записи уходят в очередь, а в stderr их
+    выводит отдельный поток QueueListener. Медленный терминал или перенаправленный
+    вывод больше не тормозят хендлеры.
+    """
+
+    def __init__(self, level: str, fmt: str, sample_every: int):
+        self.level = level
+        self.queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+        self.sampler = SamplingFilter(LOG_SAMPLED_LOGGERS, sample_every)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.handler.addFilter(self.sampler)
+        out = logging.StreamHandler()
+        out.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(logging.BASIC_FORMAT))
+        self.listener = logging.handlers.QueueListener(self.queue, out)
+        self._started = False
+
+    def start(self) -> None:
+        if self._started:
+            return
+        root = logging.getLogger()
+        root.handlers[:] = [self.handler]
+        root.setLevel(self.level)
+        self.listener.start()
+        self._started = True
+        # при выходе дописываем всё, что осталось в очереди
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        if self._started:
+            self._started = False
+            self.listener.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.queue.qsize(), "sampled_out": self.sampler.dropped, "dropped": self.handler.dropped}
+
+# запускается из main() и worker_main(): импорт модуля (тесты, loadtest) не трогает логирование и не заводит поток
+log_pipeline = LogPipeline(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_EVERY)
+
+# ================= FSM =================
+
+class BookingStates(StatesGroup):
+    choosing_service = State()
+    choosing_date = State()
+    choosing_master = State()
+    choosing_time = State()
+    waiting_phone = State()
+    waiting_username = State()
+
+# ================= МЕТРИКИ =================
+
+# границы бакетов гистограмм, секунды
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    __slots__ = ("buckets", "total", "count")
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """
+    Счётчики и гистограммы в памяти процесса; render() отдаёт их в текстовом формате Prometheus.
+    Запись — пара операций со словарём, так что в проде метрики можно не выключать.
+    """
+
+    def __init__(self):
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._collected: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._meta[name] = ("counter", help_text)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str) -> None:
+        self._meta[name] = ("histogram", help_text)
+        self._histograms[name] = {}
+
+    def collected(self, name: str, kind: str, help_text: str, collect: Callable[[], Dict[Labels, float]]) -> None:
+        """Значения снимаются в момент запроса /metrics (глубина очереди, размеры кэшей)."""
+        self._meta[name] = (kind, help_text)
+        self._collected[name] = collect
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1.0) -> None:
+        series = self._counters[name]
+        series[labels] = series.get(labels, 0.0) + value
+
+    def observe(self, name: str, seconds: float, labels: Labels = ()) -> None:
+        series = self._histograms[name]
+        h = series.get(labels)
+        if h is None:
+            h = series[labels] = Histogram()
+        h.observe(seconds)
+
+    @staticmethod
+    def _labels(labels: Labels, extra: Labels = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        out: List[str] = []
+        for name, (kind, help_text) in self._meta.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            if name in self._histograms:
+                for labels, h in list(self._histograms[name].items()):
+                    acc = 0
+                    for le, n in zip(METRIC_BUCKETS, h.buckets):
+                        acc += n
+                        out.append(f"{name}_bucket{self._labels(labels, (('le', str(le)),))} {acc}")
+                    out.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {h.count}")
+                    out.append(f"{name}_sum{self._labels(labels)} {h.total}")
+                    out.append(f"{name}_count{self._labels(labels)} {h.count}")
+                continue
+            if name in self._counters:
+                series = dict(self._counters[name])
+            else:
+                try:
+                    series = self._collected[name]()
+                except Exception:
+                    logging.exception("Metrics: collecting %s failed", name)
+                    continue
+            for labels, value in series.items():
+                out.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.histogram("bot_handler_seconds", "Время работы хендлера по префиксу колбэка")
+metrics.counter("bot_handler_errors_total", "Исключения в хендлерах")
+metrics.histogram("bot_db_helper_seconds", "Время DB-хелпера целиком")
+metrics.histogram("bot_db_query_seconds", "Запросы и транзакции к SQLite по хелперам")
+metrics.histogram("bot_db_write_lock_wait_seconds", "Ожидание соединения-писателя")
+metrics.histogram("bot_api_seconds", "Вызовы Bot API")
+metrics.counter("bot_api_errors_total", "Ошибки вызовов Bot API")
+metrics.counter("bot_fsm_transitions_total", "Переходы между состояниями FSM")
+metrics.counter("bot_flood_shed_total", "Апдейты, отброшенные антифлудом")
+metrics.counter("bot_cluster_hold_conflicts_total", "Брони воркеров, отклонённые фронтом кластера")
+metrics.counter("bot_api_calls_saved_total", "Вызовы Bot API, которые не понадобилось делать")
+
+# какой DB-хелпер сейчас выполняется — этим помечаются запросы внутри него
+_current_db_helper: ContextVar[str] = ContextVar("current_db_helper", default="other")
+# сценарий, в котором идёт запрос к API: имя хендлера или фоновой задачи
+_current_flow: ContextVar[str] = ContextVar("current_flow", default="background")
+
+def timed_db_helper(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    name = func.__name__
+    labels = (("helper", name),)
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = _current_db_helper.set(name)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.observe("bot_db_helper_seconds", time.perf_counter() - started, labels)
+            _current_db_helper.reset(token)
+
+    return wrapper
+
+def _db_labels(op: str) -> Labels:
+    return (("helper", _current_db_helper.get()), ("op", op))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Время каждого хендлера. Колбэки группируются по маршруту CallbackRouter ("m:", "d:", "t:", "c:", ...,
+    "stale" для устаревших кнопок), сообщения — по имени хендлера.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if isinstance(event, types.CallbackQuery):
+            route = data.get("callback_route", CallbackRouter.STALE_ROUTE)
+        else:
+            route = "message"
+        name = data["handler"].callback.__name__
+        labels = (("handler", name), ("route", route))
+        token = _current_flow.set(name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, labels)
+            _current_flow.reset(token)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request: Any, bot: Bot, method: TelegramMethod[Any]) -> Any:
+        labels = (("method", method.__api_method__),)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - started, labels)
+
+# ================= ИСХОДЯЩИЕ ВЫЗОВЫ API =================
+
+# сколько последних сообщений бота и отвеченных колбэков помним
+RENDERED_MESSAGES_SIZE = 20_000
+ANSWERED_CALLBACKS_SIZE = 10_000
+
+class ApiCallReducer(BaseRequestMiddleware):
+    """
+    Не отправляет запросы, результат которых известен заранее:
+    - для каждого сообщения бота помнит отпечаток показанного (текст, разметка) и
+      пропускает editMessageText, который ничего бы не изменил. «message is not modified»
+      от Telegram (отпечатка не было, например после рестарта) тоже считается успехом;
+    - на колбэк отвечает один раз — повторный answerCallbackQuery не уходит. Если повтор
+      нёс текст или алерт, пользователь его не увидит — это ошибка хендлера, она пишется в лог.
+    Сэкономленные вызовы считаются в bot_api_calls_saved_total по сценариям (хендлерам).
+    """
+
+    def __init__(self) -> None:
+        self.saved: Dict[Tuple[str, str], int] = {}
+        self._rendered: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self._answered: "OrderedDict[str, None]" = OrderedDict()
+
+    @staticmethod
+    def fingerprint(text: str, parse_mode: Any, markup: Any) -> int:
+        # у сообщения остаётся только инлайн-клавиатура; reply-клавиатура живёт в чате, а не в нём
+        inline = dump_markup(markup) if isinstance(markup, InlineKeyboardMarkup) else None
+        return hash((text, str(parse_mode), inline))
+
+    def count_saved(self, reason: str, flow: Optional[str] = None, count: int = 1) -> None:
+        key = (flow or _current_flow.get(), reason)
+        self.saved[key] = self.saved.get(key, 0) + count
+        metrics.inc("bot_api_calls_saved_total", (("flow", key[0]), ("reason", reason)), count)
+
+    def _remember(self, key: Tuple[int, int], fp: int) -> None:
+        self._rendered[key] = fp
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > RENDERED_MESSAGES_SIZE:
+            self._rendered.popitem(last=False)
+
+    async def __call__(self, make_request: Any, bot: Bot, method: TelegramMethod[Any]) -> Any:
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            key = (int(method.chat_id), method.message_id)
+            fp = self.fingerprint(method.text, method.parse_mode, method.reply_markup)
+            if self._rendered.get(key) == fp:
+                self.count_saved("edit_unchanged")
+                return True
+            try:
+                result = await make_request(bot, method)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in e.message:
+                    raise
+                result = True
+            self._remember(key, fp)
+            return result
+
+        if isinstance(method, AnswerCallbackQuery):
+            if method.callback_query_id in self._answered:
+                if method.text or method.show_alert:
+                    logging.warning(
+                        "Callback %s: answer %r dropped, the query is already answered (early_answer handler?)",
+                        method.callback_query_id,
+                        method.text,
+                    )
+                    return True
+                self.count_saved("answer_repeated")
+                return True
+            self._answered[method.callback_query_id] = None
+            if len(self._answered) > ANSWERED_CALLBACKS_SIZE:
+                self._answered.popitem(last=False)
+            return await make_request(bot, method)
+
+        result = await make_request(bot, method)
+        if isinstance(method, SendMessage) and isinstance(result, types.Message):
+            self._remember(
+                (result.chat.id, result.message_id),
+                self.fingerprint(method.text, method.parse_mode, method.reply_markup),
+            )
+        return result
+
+api_calls = ApiCallReducer()
+
+class EarlyCallbackAnswer(BaseMiddleware):
+    """
+    Хендлерам с флагом early_answer колбэк подтверждаем сразу, параллельно с их работой:
+    «часики» на кнопке гаснут через один запрос к API, а не после всех обращений к базе.
+    Алертов такие хендлеры не показывают — ответ на колбэк уже ушёл; если всё же покажут,
+    ApiCallReducer не отправит второй ответ и напишет об этом в лог.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if isinstance(event, types.CallbackQuery) and get_flag(data, "early_answer"):
+            task = asyncio.create_task(self._answer(event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await handler(event, data)
+
+    @staticmethod
+    async def _answer(call: types.CallbackQuery) -> None:
+        try:
+            await call.answer()
+        except Exception as e:
+            logging.warning("Early callback answer failed: %s", e)
+
+# ================= БАЗА ДАННЫХ =================
+
+DB_READERS = int(os.getenv("DB_READERS", "2"))
+
+# Сколько подготовленных выражений sqlite3 держит в кеше на одно соединение.
+# Все запросы ниже — константы, поэтому текст совпадает и выражение переиспользуется.
+DB_STATEMENT_CACHE = 256
+
+SQLITE_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",    # ~16 МБ страничного кеша
+    "PRAGMA mmap_size=134217728",  # 128 МБ
+    "PRAGMA temp_store=MEMORY",
+)
+
+class Database:
+    """
+    Долгоживущие соединения с SQLite: один писатель и небольшой пул читателей.
+    Открывается один раз в main() и закрывается при остановке.
+    WAL позволяет читателям не ждать писателя.
+    """
+
+    def __init__(self, path: str, readers: int = 2):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._pool: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        pragmas = SQLITE_PRAGMAS + (("PRAGMA query_only=ON",) if readonly else ())
+        for pragma in pragmas:
+            # курсор закрываем сразу, иначе незавершённый PRAGMA держит блокировку
+            async with conn.execute(pragma):
+                pass
+        return conn
+
+    async def open(self) -> None:
+        if self._writer is not None:
+            return
+        self._writer = await self._connect(readonly=False)
+        try:
+            # journal_mode сохраняется в файле базы, достаточно выставить один раз писателем
+            async with self._writer.execute("PRAGMA journal_mode=WAL"):
+                pass
+
+            self._pool = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._connect(readonly=True)
+                self._readers.append(conn)
+                self._pool.put_nowait(conn)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def close(self) -> None:
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+        self._pool = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._pool is None:
+            raise RuntimeError("Database is not open")
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Транзакция на соединении-писателе: commit при выходе, rollback при ошибке.
+        Писатель один, поэтому доступ к нему сериализуется локом.
+        """
+        if self._writer is None:
+            raise RuntimeError("Database is not open")
+        waited = time.perf_counter()
+        async with self._write_lock:
+            started = time.perf_counter()
+            metrics.observe("bot_db_write_lock_wait_seconds", started - waited)
+            # сразу берём RESERVED-блокировку: проверка и вставка идут в одной транзакции
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+            finally:
+                metrics.observe("bot_db_query_seconds", time.perf_counter() - started, _db_labels("write"))
+
+    async def fetchone(self, sql: str, params: Any = ()) -> Optional[Any]:
+        started = time.perf_counter()
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cur:
+                row = await cur.fetchone()
+        metrics.observe("bot_db_query_seconds", time.perf_counter() - started, _db_labels("fetchone"))
+        return row
+
+    async def fetchall(self, sql: str, params: Any = ()) -> List[Any]:
+        started = time.perf_counter()
+        async with self.read() as conn:
+            # один переход в поток соединения вместо трёх (execute, fetchall, close)
+            rows = list(await conn.execute_fetchall(sql, params))
+        metrics.observe("bot_db_query_seconds", time.perf_counter() - started, _db_labels("fetchall"))
+        return rows
+
+database = Database(DB_PATH, readers=DB_READERS)
+
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS appointments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    username TEXT,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    duration INTEGER NOT NULL DEFAULT 60,
+    service TEXT,
+    master_id INTEGER NOT NULL DEFAULT 1,
+    UNIQUE(master_id, date, time)
+);
+"""
+APPOINTMENT_COLUMNS = "id, user_id, date, time, contact, username, created_at, duration, service, master_id"
+
+CREATE_MASTERS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS masters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    schedule TEXT,
+    active INTEGER NOT NULL DEFAULT 1
+);
+"""
+# мастер №1 — тот, что задан через MASTER_CHAT_ID; чат берём из окружения, имя не трогаем
+SQL_DEFAULT_MASTER_CHAT = "SELECT chat_id FROM masters WHERE id=?"
+SQL_SEED_DEFAULT_MASTER = (
+    "INSERT INTO masters(id, name, chat_id) VALUES(?,?,?) "
+    "ON CONFLICT(id) DO UPDATE SET chat_id=excluded.chat_id"
+)
+
+SQL_BOOKED_IN_RANGE = "SELECT master_id, date, time, duration FROM appointments WHERE date BETWEEN ? AND ?"
+SQL_BOOKED_ON_DATE = "SELECT time, duration FROM appointments WHERE master_id=? AND date=?"
+SQL_INSERT_APPOINTMENT = (
+    "INSERT INTO appointments(user_id, date, time, contact, username, duration, service, master_id) "
+    "VALUES(?,?,?,?,?,?,?,?)"
+)
+SQL_USER_APPOINTMENTS = (
+    "SELECT id, date, time, contact, username, master_id FROM appointments_history WHERE user_id=? "
+    "UNION ALL "
+    "SELECT id, date, time, contact, username, master_id FROM appointments WHERE user_id=? "
+    "ORDER BY 2 ASC, 3 ASC"
+)
+SQL_USER_FUTURE_APPOINTMENTS = (
+    "SELECT id, date, time, contact, username, master_id FROM appointments "
+    "WHERE user_id=? AND date >= ? ORDER BY date ASC, time ASC"
+)
+SQL_USER_APPOINTMENT_BY_ID = (
+    "SELECT id, date, time, contact, username, master_id FROM appointments WHERE id=? AND user_id=? LIMIT 1"
+)
+# проверка владельца, удаление и данные для уведомления — одним запросом
+SQL_DELETE_USER_APPOINTMENT = (
+    "DELETE FROM appointments WHERE id=? AND user_id=? "
+    "RETURNING id, date, time, contact, username, master_id, duration, service"
+)
+
+# прошедшие записи: та же структура плюс время переноса
+CREATE_HISTORY_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS appointments_history (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    username TEXT,
+    created_at TEXT NOT NULL,
+    duration INTEGER NOT NULL,
+    service TEXT,
+    master_id INTEGER NOT NULL,
+    archived_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+"""
+SQL_ARCHIVE_COPY = (
+    f"INSERT OR IGNORE INTO appointments_history({APPOINTMENT_COLUMNS}) "
+    f"SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE date < ?"
+)
+SQL_ARCHIVE_DELETE = "DELETE FROM appointments WHERE date < ?"
+
+CREATE_TABLE_VERSIONS_SQL = """
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+SQL_TABLE_VERSION = "SELECT version FROM table_versions WHERE name=?"
+
+# агрегаты для /stats по дате и часу начала: сколько записей сделано, сколько отменено
+# и сколько минут занято сейчас. Ведут их create_appointment/delete_appointment в своих
+# транзакциях, а не триггеры: архивация тоже удаляет из appointments, но это не отмена
+CREATE_STATS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS appointment_stats (
+    date TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    booked INTEGER NOT NULL DEFAULT 0,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    minutes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, hour)
+) WITHOUT ROWID;
+"""
+SQL_STATS_BOOKED = (
+    "INSERT INTO appointment_stats(date, hour, booked, minutes) VALUES(?, ?, 1, ?) "
+    "ON CONFLICT(date, hour) DO UPDATE SET booked = booked + 1, minutes = minutes + excluded.minutes"
+)
+SQL_STATS_CANCELLED = (
+    "INSERT INTO appointment_stats(date, hour, cancelled) VALUES(?, ?, 1) "
+    "ON CONFLICT(date, hour) DO UPDATE SET cancelled = cancelled + 1, minutes = max(minutes - ?, 0)"
+)
+SQL_STATS_RANGE = "SELECT date, hour, booked, cancelled, minutes FROM appointment_stats WHERE date BETWEEN ? AND ?"
+SQL_STATS_COUNT = "SELECT count(*) FROM appointment_stats"
+# пересчёт из живых записей и архива; отменённых записей в базе уже нет,
+# поэтому счётчик отмен сохраняем, а каждая отмена — это ещё и сделанная когда-то запись
+SQL_STATS_REBUILD = (
+    "UPDATE appointment_stats SET booked = cancelled, minutes = 0",
+    "INSERT INTO appointment_stats(date, hour, booked, minutes) "
+    "SELECT date, CAST(substr(time, 1, 2) AS INTEGER), count(*), sum(duration) FROM ("
+    "SELECT date, time, duration FROM appointments "
+    "UNION ALL SELECT date, time, duration FROM appointments_history"
+    ") GROUP BY 1, 2 "
+    "ON CONFLICT(date, hour) DO UPDATE SET booked = booked + excluded.booked, minutes = excluded.minutes",
+    "DELETE FROM appointment_stats WHERE booked = 0",
+)
+# раз в сутки; записи моложе ARCHIVE_AFTER_DAYS остаются в рабочей таблице
+ARCHIVE_INTERVAL = 24 * 3600
+# первый прогон откладываем: пишущая транзакция на старте мешала бы первым апдейтам
+ARCHIVE_START_DELAY = 120
+
+AppointmentRow = Tuple[int, str, str, str, Optional[str], int]
+
+# сколько пользователей держим в кэше будущих записей
+USER_APPOINTMENTS_CACHE_SIZE = 4096
+
+def _appointment_row(r: Any) -> AppointmentRow:
+    return (int(r[0]), str(r[1]), str(r[2]), str(r[3]), (str(r[4]) if r[4] is not None else None), int(r[5]))
+
+class UserAppointmentsCache:
+    """
+    LRU будущих записей по пользователям: «Мои записи» и списки для отмены отвечают из памяти.
+    create_appointment/delete_appointment правят закэшированный список сразу после commit,
+    а результат чтения, начатого до такой правки, в кэш уже не кладётся.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # user_id -> (день, на который список «будущих», записи по дате и времени)
+        self._items: "OrderedDict[int, Tuple[str, List[AppointmentRow]]]" = OrderedDict()
+        self._writes = 0
+
+    def get(self, user_id: int, today_iso: str) -> Optional[List[AppointmentRow]]:
+        entry = self._items.get(user_id)
+        if entry is None or entry[0] != today_iso:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(user_id)
+        return list(entry[1])
+
+    def snapshot(self) -> int:
+        return self._writes
+
+    def put(self, user_id: int, today_iso: str, rows: List[AppointmentRow], snapshot: int) -> None:
+        if snapshot != self._writes:
+            return
+        self._items[user_id] = (today_iso, list(rows))
+        self._items.move_to_end(user_id)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def added(self, user_id: int, row: AppointmentRow) -> None:
+        self._writes += 1
+        entry = self._items.get(user_id)
+        if entry is not None and row[1] >= entry[0]:
+            bisect.insort(entry[1], row, key=lambda r: (r[1], r[2]))
+
+    def removed(self, user_id: int, appointment_id: int) -> None:
+        self._writes += 1
+        entry = self._items.get(user_id)
+        if entry is not None:
+            entry[1][:] = [r for r in entry[1] if r[0] != appointment_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+user_appointments_cache = UserAppointmentsCache(USER_APPOINTMENTS_CACHE_SIZE)
+
+CREATE_AUDIT_LOG_SQL = """
+CREATE TABLE IF NOT EXISTS audit_log (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    event TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    appointment_id INTEGER,
+    master_id INTEGER,
+    date TEXT,
+    time TEXT,
+    service TEXT,
+    elapsed_ms REAL
+);
+"""
+SQL_AUDIT_INSERT = (
+    "INSERT INTO audit_log(ts, event, user_id, appointment_id, master_id, date, time, service, elapsed_ms) "
+    "VALUES(?,?,?,?,?,?,?,?,?)"
+)
+# id растёт вместе с ts: режем всё до первой свежей строки, не читая таблицу целиком
+SQL_AUDIT_PRUNE = (
+    "DELETE FROM audit_log WHERE id < coalesce("
+    "(SELECT id FROM audit_log WHERE ts >= ? ORDER BY id LIMIT 1), (SELECT max(id) + 1 FROM audit_log))"
+)
+
+# журнал уходит в базу раз в столько секунд или сразу, как набралось AUDIT_BATCH событий
+AUDIT_FLUSH_DELAY = 1.0
+AUDIT_BATCH = 200
+
+class AuditLog:
+    """
+    Журнал записей и отмен: кто, что, когда и сколько заняла операция.
+    Хендлер не ждёт отдельного commit — события копятся в памяти и пишутся одной
+    транзакцией на пачку (group commit). Если процесс упадёт, теряется не больше
+    последней секунды журнала; сами записи в appointments от этого не зависят.
+    """
+
+    def __init__(self, db: Database, flush_delay: float = AUDIT_FLUSH_DELAY, batch: int = AUDIT_BATCH):
+        self.db = db
+        self.flush_delay = flush_delay
+        self.batch = batch
+        self.written = 0
+        self._pending: List[Tuple[Any, ...]] = []
+        self._full = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(
+        self,
+        event: str,
+        user_id: int,
+        started: float,
+        appointment_id: Optional[int] = None,
+        master_id: Optional[int] = None,
+        date_iso: Optional[str] = None,
+        time_str: Optional[str] = None,
+        service: Optional[str] = None,
+    ) -> None:
+        """started — time.perf_counter() в начале операции."""
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        self._pending.append(
+            (time.time(), event, user_id, appointment_id, master_id, date_iso, time_str, service, elapsed_ms)
+        )
+        if len(self._pending) >= self.batch:
+            self._full.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._full.wait(), self.flush_delay)
+        self._full.clear()
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending or not self.db.is_open:
+            return
+        rows = self._pending
+        self._pending = []
+        try:
+            async with self.db.write() as db:
+                await db.executemany(SQL_AUDIT_INSERT, rows)
+        except asyncio.CancelledError:
+            self._pending[:0] = rows
+            raise
+        except Exception:
+            logging.exception("Audit log flush failed, will retry")
+            self._pending[:0] = rows
+            if self._flush_task is None or self._flush_task.done() or self._flush_task is asyncio.current_task():
+                self._flush_task = asyncio.create_task(self._flush_later())
+            return
+        self.written += len(rows)
+
+    async def prune(self, keep_days: int = AUDIT_KEEP_DAYS) -> int:
+        deadline = time.time() - keep_days * 86400
+        async with self.db.write() as db:
+            async with db.execute(SQL_AUDIT_PRUNE, (deadline,)) as cur:
+                return cur.rowcount
+
+    async def close(self) -> None:
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flush_task
+        await self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._pending), "written": self.written}
+
+audit_log = AuditLog(database)
+
+async def _has_legacy_unique(db: aiosqlite.Connection) -> bool:
+    async with db.execute("PRAGMA index_list(appointments)") as cur:
+        indexes = await cur.fetchall()
+    for _, name, unique, *_ in indexes:
+        if not unique:
+            continue
+        async with db.execute(f"PRAGMA index_info('{name}')") as cur:
+            cols = [r[2] for r in await cur.fetchall()]
+        if cols == ["date", "time"]:
+            return True
+    return False
+
+async def _table_columns(db: aiosqlite.Connection, table: str) -> Set[str]:
+    async with db.execute(f"PRAGMA table_info({table})") as cur:
+        return {str(r[1]) for r in await cur.fetchall()}
+
+async def _migration_1_base(db: aiosqlite.Connection) -> None:
+    """
+    Базовая схема. Базы, созданные до появления версий (user_version = 0), могут быть
+    в любом промежуточном виде — поэтому здесь всё идемпотентно.
+    """
+    await db.execute(CREATE_TABLE_SQL)
+    await db.execute(CREATE_MASTERS_TABLE_SQL)
+    await db.execute(CREATE_FSM_TABLE_SQL)
+    await db.execute(CREATE_FSM_INDEX_SQL)
+    await db.execute(CREATE_OUTBOX_TABLE_SQL)
+    await db.execute(CREATE_OUTBOX_INDEX_SQL)
+    await db.execute(CREATE_REMINDERS_SENT_SQL)
+    await db.execute(CREATE_REMINDERS_SENT_INDEX_SQL)
+
+    # колонки, которых не было в самых старых базах
+    columns = await _table_columns(db, "appointments")
+    for name, ddl in (
+        ("username", "ALTER TABLE appointments ADD COLUMN username TEXT;"),
+        ("duration", "ALTER TABLE appointments ADD COLUMN duration INTEGER NOT NULL DEFAULT 60;"),
+        ("service", "ALTER TABLE appointments ADD COLUMN service TEXT;"),
+        ("master_id", "ALTER TABLE appointments ADD COLUMN master_id INTEGER NOT NULL DEFAULT 1;"),
+    ):
+        if name not in columns:
+            await db.execute(ddl)
+
+    # UNIQUE(date, time) из старой схемы в SQLite не снять — пересобираем таблицу
+    if await _has_legacy_unique(db):
+        await db.execute(CREATE_TABLE_SQL.replace("IF NOT EXISTS appointments", "appointments_new"))
+        await db.execute(
+            f"INSERT INTO appointments_new({APPOINTMENT_COLUMNS}) SELECT {APPOINTMENT_COLUMNS} FROM appointments"
+        )
+        await db.execute("DROP TABLE appointments")
+        await db.execute("ALTER TABLE appointments_new RENAME TO appointments")
+
+    # выборка месяца по всем мастерам сразу идёт по дате
+    await db.execute("CREATE INDEX IF NOT EXISTS appointments_date ON appointments(date);")
+
+async def _migration_2_user_index_and_history(db: aiosqlite.Connection) -> None:
+    # «мои записи»: фильтр по user_id и date, сортировка по date, time — всё из индекса
+    await db.execute("CREATE INDEX IF NOT EXISTS appointments_user ON appointments(user_id, date, time);")
+    await db.execute(CREATE_HISTORY_TABLE_SQL)
+    await db.execute("CREATE INDEX IF NOT EXISTS appointments_history_user ON appointments_history(user_id, date);")
+
+async def _migration_3_change_counter(db: aiosqlite.Connection) -> None:
+    # счётчик изменений appointments ведут триггеры — так его не обойдёт ни один путь записи
+    await db.execute(CREATE_TABLE_VERSIONS_SQL)
+    await db.execute("INSERT OR IGNORE INTO table_versions(name, version) VALUES('appointments', 0);")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        await db.execute(
+            f"CREATE TRIGGER IF NOT EXISTS appointments_version_{event.lower()} AFTER {event} ON appointments "
+            "BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'appointments'; END;"
+        )
+    # выгрузка за период читает обе таблицы в порядке (date, time) прямо из индекса;
+    # индекс по одной дате новый покрывает, поэтому заменяется, а не дополняется
+    await db.execute("CREATE INDEX IF NOT EXISTS appointments_history_date ON appointments_history(date, time);")
+    await db.execute("DROP INDEX IF EXISTS appointments_date;")
+    await db.execute("CREATE INDEX IF NOT EXISTS appointments_date_time ON appointments(date, time);")
+
+async def _migration_4_stats(db: aiosqlite.Connection) -> None:
+    await db.execute(CREATE_STATS_TABLE_SQL)
+    await _rebuild_stats(db)
+
+async def _migration_5_waitlist(db: aiosqlite.Connection) -> None:
+    await db.execute(CREATE_WAITLIST_SQL)
+    await db.execute(CREATE_WAITLIST_INDEX_SQL)
+
+async def _migration_6_users_and_broadcasts(db: aiosqlite.Connection) -> None:
+    await db.execute(CREATE_USERS_SQL)
+    await db.execute(CREATE_BROADCASTS_SQL)
+    # все, кто уже записывался, попадают в реестр сразу — не дожидаясь их следующего визита
+    await db.execute(SQL_USERS_BACKFILL)
+
+async def _migration_7_audit_log(db: aiosqlite.Connection) -> None:
+    await db.execute(CREATE_AUDIT_LOG_SQL)
+    # «что было с записями клиента» — по пользователю в порядке событий
+    await db.execute("CREATE INDEX IF NOT EXISTS audit_log_user ON audit_log(user_id, id);")
+
+# порядок менять нельзя: номер шага = user_version после него; новые шаги — только в конец
+MIGRATIONS: List[Callable[[aiosqlite.Connection], Awaitable[None]]] = [
+    _migration_1_base,
+    _migration_2_user_index_and_history,
+    _migration_3_change_counter,
+    _migration_4_stats,
+    _migration_5_waitlist,
+    _migration_6_users_and_broadcasts,
+    _migration_7_audit_log,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+async def init_db() -> None:
+    """
+    Миграции и сид мастера №1. На уже обновлённой базе это два чтения без единой
+    пишущей транзакции: схема совпадает по user_version, сид не изменился.
+    """
+    row = await database.fetchone("PRAGMA user_version")
+    if int(row[0]) >= SCHEMA_VERSION:
+        seeded = await database.fetchone(SQL_DEFAULT_MASTER_CHAT, (DEFAULT_MASTER_ID,))
+        if seeded is not None and int(seeded[0]) == MASTER_CHAT_ID:
+            return
+    else:
+        async with database.write() as db:
+            # версию перечитываем под блокировкой: схему мог уже обновить другой процесс
+            async with db.execute("PRAGMA user_version") as cur:
+                version = int((await cur.fetchone())[0])
+            for step in MIGRATIONS[version:]:
+                await step(db)
+                version += 1
+                await db.execute(f"PRAGMA user_version = {version}")
+                logging.info("DB schema migrated to version %d", version)
+
+    # чат мастера №1 берём из окружения — он может меняться между запусками
+    async with database.write() as db:
+        await db.execute(SQL_SEED_DEFAULT_MASTER, (DEFAULT_MASTER_ID, MASTER_NAME, MASTER_CHAT_ID))
+
+@timed_db_helper
+async def archive_past_appointments(keep_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """
+    Переносит записи старше keep_days дней в appointments_history, чтобы рабочая таблица
+    оставалась маленькой. Возвращает число перенесённых записей.
+    """
+    before_iso = (datetime.date.today() - datetime.timedelta(days=keep_days)).isoformat()
+    async with database.write() as db:
+        await db.execute(SQL_ARCHIVE_COPY, (before_iso,))
+        async with db.execute(SQL_ARCHIVE_DELETE, (before_iso,)) as cur:
+            return cur.rowcount
+
+async def _rebuild_stats(db: aiosqlite.Connection) -> None:
+    for sql in SQL_STATS_REBUILD:
+        await db.execute(sql)
+
+@timed_db_helper
+async def rebuild_stats() -> int:
+    """Пересчитывает appointment_stats по appointments и архиву. Возвращает число строк агрегатов."""
+    async with database.write() as db:
+        await _rebuild_stats(db)
+        async with db.execute(SQL_STATS_COUNT) as cur:
+            return int((await cur.fetchone())[0])
+
+async def archive_loop() -> None:
+    await asyncio.sleep(ARCHIVE_START_DELAY)
+    while True:
+        try:
+            moved = await archive_past_appointments()
+            if moved:
+                logging.info("Archived %d past appointments", moved)
+            # там же раз в сутки чистим лист ожидания от прошедших дат
+            pruned = await waitlist.prune()
+            if pruned:
+                logging.info("Pruned %d expired waitlist entries", pruned)
+            pruned = await audit_log.prune()
+            if pruned:
+                logging.info("Pruned %d audit log entries older than %d days", pruned, AUDIT_KEEP_DAYS)
+        except Exception:
+            logging.exception("Archive job failed")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+@timed_db_helper
+async def is_slot_free(master_id: int, date_iso: str, time_str: str, duration: int) -> bool:
+    start = parse_hhmm(time_str)
+    if start not in masters.get(master_id).schedule.candidates(date_iso, duration):
+        return False
+    await availability.ensure_date(date_iso)
+    return not availability.overlaps(master_id, date_iso, start, start + duration)
+
+def _without_held(
+    master_id: int,
+    date_iso: str,
+    starts: List[int],
+    duration: int,
+    user_id: Optional[int],
+) -> List[str]:
+    held = slot_holds.held_by_others(master_id, date_iso, user_id)
+    return [
+        format_hhmm(s)
+        for s in starts
+        if not any(intervals_overlap(s, s + duration, hs, he) for hs, he in held)
+    ]
+
+@timed_db_helper
+async def list_free_times(
+    master_id: int,
+    date_iso: str,
+    duration: int,
+    user_id: Optional[int] = None,
+) -> List[str]:
+    """
+    Свободные начала у мастера по его расписанию; забронированные другими (см. SlotHolds) тоже заняты.
+    """
+    await availability.ensure_date(date_iso)
+    starts = availability.free_starts(masters.get(master_id), date_iso, duration)
+    return _without_held(master_id, date_iso, starts, duration, user_id)
+
+@timed_db_helper
+async def list_free_times_by_master(
+    date_iso: str,
+    duration: int,
+    user_id: Optional[int] = None,
+) -> Dict[int, List[str]]:
+    """
+    {master_id: свободные времена} по всем активным мастерам за один проход; мастера без слотов не попадают.
+    """
+    await availability.ensure_date(date_iso)
+    out: Dict[int, List[str]] = {}
+    for master in masters.active():
+        starts = availability.free_starts(master, date_iso, duration)
+        free = _without_held(master.id, date_iso, starts, duration, user_id)
+        if free:
+            out[master.id] = free
+    return out
+
+@timed_db_helper
+async def create_appointment(
+    user_id: int,
+    date_iso: str,
+    time_str: str,
+    contact: str,
+    username: str,
+    service: Optional["Service"] = None,
+    master_id: int = 1,
+    notices: Sequence["OutboxMessage"] = (),
+) -> bool:
+    """
+    True если запись создана.
+    False если слот уже занят (защита от гонок/двойных кликов).
+    notices — уведомления о записи: кладутся в outbox той же транзакцией, что и сама запись.
+    """
+    started = time.perf_counter()
+    service = service or schedule.default_service
+    start = parse_hhmm(time_str)
+    end = start + service.duration
+    try:
+        async with database.write() as db:
+            # UNIQUE(master_id, date, time) ловит только совпадающее начало — пересечения проверяем
+            # в той же транзакции писателя, до вставки
+            booked = [(str(t), int(d)) for t, d in await db.execute_fetchall(SQL_BOOKED_ON_DATE, (master_id, date_iso))]
+            if any(intervals_overlap(start, end, parse_hhmm(t), parse_hhmm(t) + d) for t, d in booked):
+                availability.replace_date(master_id, date_iso, booked)
+                audit_log.record("conflict", user_id, started, None, master_id, date_iso, time_str, service.code)
+                return False
+            (appointment_id,) = await db.execute_insert(
+                SQL_INSERT_APPOINTMENT,
+                (user_id, date_iso, time_str, contact, username, service.duration, service.code, master_id),
+            )
+            await db.execute(SQL_STATS_BOOKED, (date_iso, start // 60, service.duration))
+            # записался — ждать этот день больше не нужно; фронт знает ждущих по листу в памяти
+            was_waiting = (cluster.is_worker or waitlist.entry(user_id, date_iso) is not None) and bool(
+                await db.execute_fetchall(SQL_WAITLIST_REMOVE, (user_id, date_iso))
+            )
+            queued = await outbox.enqueue_in(db, list(notices)) if notices else 0
+    except aiosqlite.IntegrityError:
+        # база знает лучше: индекс мог отстать — перечитываем день мастера
+        rows = await database.fetchall(SQL_BOOKED_ON_DATE, (master_id, date_iso))
+        availability.replace_date(master_id, date_iso, rows)
+        audit_log.record("conflict", user_id, started, None, master_id, date_iso, time_str, service.code)
+        return False
+    # индекс трогаем только после успешного commit
+    if queued:
+        outbox.kick(queued)
+    availability.mark_busy(master_id, date_iso, time_str, service.duration)
+    reminders.schedule(Reminder(appointment_id, user_id, date_iso, time_str, service.code, master_id))
+    user_appointments_cache.added(user_id, (appointment_id, date_iso, time_str, contact, username, master_id))
+    if was_waiting:
+        waitlist.discard(user_id, date_iso)
+    audit_log.record("create", user_id, started, appointment_id, master_id, date_iso, time_str, service.code)
+    return True
+
+@timed_db_helper
+async def list_user_appointments(
+    user_id: int,
+    only_future: bool = True
+) -> List[AppointmentRow]:
+    """
+    (id, date_iso, time_str, contact, username, master_id)
+    """
+    if not only_future:
+        rows = await database.fetchall(SQL_USER_APPOINTMENTS, (user_id, user_id))
+        return [_appointment_row(r) for r in rows]
+
+    today_iso = datetime.date.today().isoformat()
+    cached = user_appointments_cache.get(user_id, today_iso)
+    if cached is not None:
+        return cached
+    snapshot = user_appointments_cache.snapshot()
+    rows = await database.fetchall(SQL_USER_FUTURE_APPOINTMENTS, (user_id, today_iso))
+    apps = [_appointment_row(r) for r in rows]
+    user_appointments_cache.put(user_id, today_iso, apps, snapshot)
+    return apps
+
+@timed_db_helper
+async def get_user_appointment_by_id(user_id: int, appointment_id: int) -> Optional[AppointmentRow]:
+    """
+    Возвращает (id, date, time, contact, username, master_id) если принадлежит user_id
+    """
+    r = await database.fetchone(SQL_USER_APPOINTMENT_BY_ID, (appointment_id, user_id))
+    if not r:
+        return None
+    return _appointment_row(r)
+
+@timed_db_helper
+async def delete_appointment(
+    user_id: int,
+    appointment_id: int,
+    notices: Optional[Callable[[AppointmentRow], List["OutboxMessage"]]] = None,
+) -> Optional[AppointmentRow]:
+    """
+    Удаляет запись, только если принадлежит этому user_id.
+    Возвращает данные удалённой записи (id, date, time, contact, username, master_id) или None.
+    notices(запись) собирает уведомления об отмене — они уходят в outbox той же транзакцией.
+    """
+    started = time.perf_counter()
+    queued = 0
+    async with database.write() as db:
+        deleted = await db.execute_fetchall(SQL_DELETE_USER_APPOINTMENT, (appointment_id, user_id))
+        r = deleted[0] if deleted else None
+        if r:
+            await db.execute(SQL_STATS_CANCELLED, (r[1], parse_hhmm(r[2]) // 60, int(r[6])))
+            if notices is not None:
+                queued = await outbox.enqueue_in(db, notices(_appointment_row(r)))
+    if not r:
+        return None
+
+    if queued:
+        outbox.kick(queued)
+    appt = _appointment_row(r)
+    availability.mark_free(appt[5], appt[1], appt[2])
+    reminders.cancel(appt[0])
+    user_appointments_cache.removed(user_id, appt[0])
+    waitlist.freed(appt[1])
+    audit_log.record("cancel", user_id, started, appt[0], appt[5], appt[1], appt[2], r[7])
+    return appt
+
+# ================= FSM STORAGE =================
+
+CREATE_FSM_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS fsm_state (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    updated_at INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+CREATE_FSM_INDEX_SQL = "CREATE INDEX IF NOT EXISTS fsm_state_updated ON fsm_state(updated_at);"
+
+SQL_FSM_GET = "SELECT state, data, updated_at FROM fsm_state WHERE key=?"
+SQL_FSM_KEYS = "SELECT key FROM fsm_state WHERE updated_at >= ?"
+SQL_FSM_UPSERT = (
+    "INSERT INTO fsm_state(key, state, data, updated_at) VALUES(?,?,?,?) "
+    "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at"
+)
+SQL_FSM_DELETE = "DELETE FROM fsm_state WHERE key=?"
+SQL_FSM_EXPIRE = "DELETE FROM fsm_state WHERE updated_at < ?"
+
+# как часто чистим просроченные состояния в базе
+FSM_SWEEP_INTERVAL = 600
+
+class _FSMRecord:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], touched: float):
+        self.state = state
+        self.data = data
+        self.touched = touched
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в той же базе SQLite — незаконченная запись переживает рестарт.
+
+    Изменения копятся в памяти и пишутся пачкой через flush_delay секунд,
+    так что несколько update_data за один шаг записи дают одну запись в базу.
+    Состояния, не трогавшиеся дольше ttl, считаются брошенными и удаляются.
+
+    При первом обращении читаются ключи всех живых состояний: у нового пользователя
+    ключа там нет, и его первый апдейт не идёт в базу за заведомо пустым состоянием.
+    Хранилище — единственный, кто пишет fsm_state (в кластере пользователь закреплён
+    за одним воркером), поэтому набор ключей в памяти не отстаёт от базы.
+    """
+
+    def __init__(self, db: Database, ttl: int = FSM_STATE_TTL, flush_delay: float = FSM_FLUSH_DELAY):
+        self.db = db
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self._cache: Dict[str, _FSMRecord] = {}
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_sweep = 0.0
+        # ключи состояний, которые есть в базе, но ещё не подняты в _cache; None — не загружены
+        self._stored: Optional[Set[str]] = None
+        self._stored_lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        # "bot:chat:user" — thread/destiny дописываем только если они не по умолчанию
+        parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id is not None or key.destiny != DEFAULT_DESTINY:
+            parts.append("" if key.thread_id is None else str(key.thread_id))
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    async def _record(self, key: StorageKey) -> Tuple[str, _FSMRecord]:
+        k = self._key(key)
+        now = time.time()
+        rec = self._cache.get(k)
+        if rec is None:
+            if self._stored is None:
+                await self._load_stored(now)
+            row = await self.db.fetchone(SQL_FSM_GET, (k,)) if k in self._stored else None
+            self._stored.discard(k)
+            # пока ждали базу, запись могла появиться из соседнего апдейта
+            rec = self._cache.get(k)
+            if rec is None:
+                if row is not None and now - row[2] <= self.ttl:
+                    rec = _FSMRecord(row[0], json.loads(row[1]) if row[1] else {}, row[2])
+                else:
+                    rec = _FSMRecord(None, {}, now)
+                self._cache[k] = rec
+        elif now - rec.touched > self.ttl:
+            rec.state = None
+            rec.data = {}
+            self._mark_dirty(k, rec)
+        return k, rec
+
+    async def _load_stored(self, now: float) -> None:
+        async with self._stored_lock:
+            if self._stored is None:
+                rows = await self.db.fetchall(SQL_FSM_KEYS, (int(now - self.ttl),))
+                self._stored = {str(r[0]) for r in rows}
+
+    def _mark_dirty(self, k: str, rec: _FSMRecord) -> None:
+        rec.touched = time.time()
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._dirty or not self.db.is_open:
+            return
+        keys = self._dirty
+        self._dirty = set()
+
+        upserts: List[Tuple[str, Optional[str], Optional[str], int]] = []
+        deletes: List[Tuple[str]] = []
+        for k in keys:
+            rec = self._cache.get(k)
+            if rec is None or (rec.state is None and not rec.data):
+                deletes.append((k,))
+                continue
+            data = json.dumps(rec.data, ensure_ascii=False, separators=(",", ":")) if rec.data else None
+            upserts.append((k, rec.state, data, int(rec.touched)))
+
+        try:
+            async with self.db.write() as db:
+                if upserts:
+                    await db.executemany(SQL_FSM_UPSERT, upserts)
+                if deletes:
+                    await db.executemany(SQL_FSM_DELETE, deletes)
+        except asyncio.CancelledError:
+            self._dirty |= keys
+            raise
+        except Exception:
+            logging.exception("FSM flush failed, will retry")
+            self._dirty |= keys
+            if self._flush_task is None or self._flush_task.done() or self._flush_task is asyncio.current_task():
+                self._flush_task = asyncio.create_task(self._flush_later())
+            return
+
+        # пустые записи в памяти не нужны — в базе их уже нет
+        for (k,) in deletes:
+            rec = self._cache.get(k)
+            if rec is not None and k not in self._dirty and rec.state is None and not rec.data:
+                del self._cache[k]
+
+        await self._sweep()
+
+    async def _sweep(self) -> None:
+        now = time.time()
+        if now - self._last_sweep < FSM_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        deadline = now - self.ttl
+        for k in [k for k, rec in self._cache.items() if rec.touched < deadline and k not in self._dirty]:
+            del self._cache[k]
+        async with self.db.write() as db:
+            await db.execute(SQL_FSM_EXPIRE, (int(deadline),))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._record(key)
+        new_state = state.state if isinstance(state, State) else state
+        if new_state != rec.state:
+            metrics.inc("bot_fsm_transitions_total", (("from", rec.state or "none"), ("to", new_state or "none")))
+        rec.state = new_state
+        self._mark_dirty(k, rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, rec = await self._record(key)
+        return rec.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, rec = await self._record(key)
+        rec.data = data.copy()
+        self._mark_dirty(k, rec)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, rec = await self._record(key)
+        return rec.data.copy()
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        k, rec = await self._record(key)
+        rec.data.update(data)
+        self._mark_dirty(k, rec)
+        return rec.data.copy()
+
+    async def close(self) -> None:
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+def make_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    # первым — пропущенные вызовы не попадают в метрики API
+    session.middleware(api_calls)
+    session.middleware(ApiMetricsMiddleware())
+    return Bot(token=API_TOKEN, session=session)
+
+# Бот создаётся на старте (open_bot), а не при импорте: AiohttpSession в конструкторе
+# разбирает CA-бандл (ssl.create_default_context, ~35 мс). Фоновым службам
+# экземпляр передаётся явно, хендлеры получают его от aiogram.
+bot: Optional[Bot] = None
+
+async def open_bot() -> Bot:
+    """Собирает бота в потоке, параллельно с миграциями; повторный вызов возвращает того же."""
+    global bot
+    if bot is None:
+        bot = await asyncio.to_thread(make_bot)
+    return bot
+dp = Dispatcher(storage=SQLiteStorage(database))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(EarlyCallbackAnswer())
+
+# ================= ДАТЫ/МЕСЯЦЫ =================
+
+RU_MONTHS = [
+    "январь", "февраль", "март", "апрель", "май", "июнь",
+    "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"
+]
+
+def next_months(count: int = 6) -> List[Tuple[int, int, str]]:
+    today = datetime.date.today()
+    y, m = today.year, today.month
+    out: List[Tuple[int, int, str]] = []
+    for i in range(count):
+        mm = m + i
+        yy = y + (mm - 1) // 12
+        m2 = ((mm - 1) % 12) + 1
+        out.append((yy, m2, RU_MONTHS[m2 - 1]))
+    return out
+
+def days_in_month(year: int, month: int) -> int:
+    next_m = month + 1
+    next_y = year
+    if next_m == 13:
+        next_m = 1
+        next_y += 1
+    last_day = (datetime.date(next_y, next_m, 1) - datetime.timedelta(days=1)).day
+    return last_day
+
+def format_date_iso(year: int, month: int, day: int) -> str:
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+def human_date(date_iso: str) -> str:
+    d = datetime.date.fromisoformat(date_iso)
+    return f"{d.day:02d}.{d.month:02d}.{d.year}"
+
+def normalize_username(text: str) -> str:
+    t = (text or "").strip()
+    if not t:
+        return ""
+    if t.startswith("@"):
+        return t
+    if " " in t:
+        return t
+    return "@" + t
+
+# ================= КОЛБЭКИ =================
+
+# Telegram режет callback_data длиннее 64 байт
+CALLBACK_DATA_LIMIT = 64
+_B36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _b36(n: int) -> str:
+    if n < 0:
+        raise ValueError(f"отрицательное число в колбэке: {n}")
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36_DIGITS[r] + out
+        if not n:
+            return out
+
+def _unb36(raw: str, max_len: int) -> int:
+    # int(raw, 36) сам по себе пропускает пробелы, знак и "_" — проверяем алфавит явно
+    if not raw or len(raw) > max_len or raw.strip(_B36_DIGITS):
+        raise ValueError(f"плохое число в колбэке: {raw!r}")
+    return int(raw, 36)
+
+class CallbackField(NamedTuple):
+    """Одно поле колбэка: pack — значение в компактный токен, unpack — обратно с проверкой (ValueError)."""
+    pack: Callable[[Any], str]
+    unpack: Callable[[str], Any]
+
+def _int_field(lo: int, hi: int) -> CallbackField:
+    max_len = len(_b36(hi))
+
+    def unpack(raw: str) -> int:
+        value = _unb36(raw, max_len)
+        if not lo <= value <= hi:
+            raise ValueError(f"число вне диапазона в колбэке: {value}")
+        return value
+
+    return CallbackField(_b36, unpack)
+
+def _pack_date(date_iso: str) -> str:
+    return _b36(datetime.date.fromisoformat(date_iso).toordinal())
+
+def _unpack_date(raw: str) -> str:
+    # порядковый номер дня: 4 символа вместо 10 у YYYY-MM-DD
+    return datetime.date.fromordinal(_unb36(raw, 5)).isoformat()
+
+def _pack_time(time_str: str) -> str:
+    h, m = time_str.split(":")
+    return _b36(int(h) * 60 + int(m))
+
+def _unpack_time(raw: str) -> str:
+    minutes = _unb36(raw, 2)
+    if minutes >= 24 * 60:
+        raise ValueError(f"время вне суток в колбэке: {minutes}")
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def _pack_token(value: str) -> str:
+    if not value or ":" in value:
+        raise ValueError(f"код нельзя положить в колбэк: {value!r}")
+    return value
+
+def _unpack_token(raw: str) -> str:
+    if not raw or len(raw) > 32:
+        raise ValueError(f"плохой код в колбэке: {raw!r}")
+    return raw
+
+def _pack_window(window: Optional[int]) -> str:
+    return "x" if window is None else _b36(window)
+
+def _unpack_window(raw: str) -> Optional[int]:
+    # "x" — отписаться, иначе номер окна из WAITLIST_WINDOWS
+    if raw == "x":
+        return None
+    window = _unb36(raw, 1)
+    if window >= len(WAITLIST_WINDOWS):
+        raise ValueError(f"нет такого окна ожидания: {window}")
+    return window
+
+CB_ID = _int_field(1, 36 ** 8 - 1)
+CB_YEAR = _int_field(2000, 2999)
+CB_MONTH = _int_field(1, 12)
+CB_DATE = CallbackField(_pack_date, _unpack_date)
+CB_TIME = CallbackField(_pack_time, _unpack_time)
+CB_TOKEN = CallbackField(_pack_token, _unpack_token)
+CB_WINDOW = CallbackField(_pack_window, _unpack_window)
+
+class ServiceCb(NamedTuple):
+    code: str
+
+class MonthCb(NamedTuple):
+    year: int
+    month: int
+
+class DayCb(NamedTuple):
+    date_iso: str
+
+class MasterCb(NamedTuple):
+    date_iso: str
+    master_id: int
+
+class TimeCb(NamedTuple):
+    date_iso: str
+    time_str: str
+
+class WaitCb(NamedTuple):
+    date_iso: str
+    window: Optional[int]  # None — отписаться
+
+class CancelCb(NamedTuple):
+    app_id: int
+
+class CallbackCodec:
+    """
+    Формат callback_data одной кнопки: "<префикс>:<поле>:<поле>...".
+    pack проверяет лимит Telegram ещё при сборке клавиатуры, unpack разбирает
+    данные один раз в типизированный NamedTuple и бросает ValueError на мусор.
+    """
+
+    __slots__ = ("prefix", "head", "payload", "fields")
+
+    def __init__(self, prefix: str, payload: Optional[type] = None, *fields: CallbackField) -> None:
+        if payload is not None and len(payload._fields) != len(fields):
+            raise ValueError(f"{payload.__name__}: полей {len(payload._fields)}, кодеков {len(fields)}")
+        self.prefix = prefix
+        # с этого начинаются данные кнопок с полями — по нему их ищет loadtest
+        self.head = prefix + ":"
+        self.payload = payload
+        self.fields = fields
+
+    def pack(self, *values: Any) -> str:
+        if len(values) != len(self.fields):
+            raise ValueError(f"колбэк {self.prefix}: ждали {len(self.fields)} значений, пришло {len(values)}")
+        if not values:
+            return self.prefix
+        data = self.head + ":".join(f.pack(v) for f, v in zip(self.fields, values))
+        if len(data.encode()) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data!r}")
+        return data
+
+    def unpack(self, raw: str) -> Any:
+        """raw — всё после первого ":" (у кнопок без полей — пустая строка)."""
+        if not self.fields:
+            if raw:
+                raise ValueError(f"лишние данные в колбэке {self.prefix}: {raw!r}")
+            return None
+        parts = raw.split(":")
+        if len(parts) != len(self.fields):
+            raise ValueError(f"колбэк {self.prefix}: ждали {len(self.fields)} полей, пришло {len(parts)}")
+        return self.payload(*(f.unpack(p) for f, p in zip(self.fields, parts)))
+
+HOME_CB = CallbackCodec("h")
+BOOK_CB = CallbackCodec("b")
+MY_CB = CallbackCodec("my")
+MY_CANCEL_CB = CallbackCodec("mc")
+SERVICE_CB = CallbackCodec("s", ServiceCb, CB_TOKEN)
+MONTH_CB = CallbackCodec("m", MonthCb, CB_YEAR, CB_MONTH)
+DAY_CB = CallbackCodec("d", DayCb, CB_DATE)
+WAIT_CB = CallbackCodec("w", WaitCb, CB_DATE, CB_WINDOW)
+MASTER_CB = CallbackCodec("p", MasterCb, CB_DATE, CB_ID)
+TIME_CB = CallbackCodec("t", TimeCb, CB_DATE, CB_TIME)
+UNAME_KEEP_CB = CallbackCodec("u")
+CANCEL_CB = CallbackCodec("c", CancelCb, CB_ID)
+BACK_MONTHS_CB = CallbackCodec("bm")
+BACK_DAYS_CB = CallbackCodec("bd", DayCb, CB_DATE)
+
+class CallbackRouter:
+    """
+    Разбор колбэков за O(1): префикс до первого ":" ищется в словаре, данные
+    разбираются кодеком один раз и приходят в хендлер аргументом cb.
+
+    В aiogram весь роутер — один хендлер dp.callback_query: фильтр resolve подменяет
+    data["handler"] на HandlerObject найденного маршрута, поэтому флаги (early_answer)
+    и имя хендлера в метриках работают как у обычных хендлеров. Неизвестный префикс
+    и битые данные (кнопки старых версий бота) уходят в хендлер stale.
+    """
+
+    STALE_ROUTE = "stale"
+
+    def __init__(self) -> None:
+        self._routes: Dict[str, Tuple[CallbackCodec, HandlerObject]] = {}
+        self._stale: Optional[HandlerObject] = None
+
+    def route(self, codec: CallbackCodec, flags: Optional[Dict[str, Any]] = None) -> Callable[[Any], Any]:
+        def wrapper(callback: Any) -> Any:
+            if codec.prefix in self._routes:
+                raise ValueError(f"префикс колбэка {codec.prefix!r} уже занят")
+            self._routes[codec.prefix] = (codec, HandlerObject(callback=callback, flags=dict(flags or {})))
+            return callback
+        return wrapper
+
+    def stale(self, callback: Any) -> Any:
+        self._stale = HandlerObject(callback=callback)
+        return callback
+
+    async def resolve(self, call: types.CallbackQuery) -> Dict[str, Any]:
+        # корутина: синхронный фильтр aiogram запускает в пуле потоков
+        prefix, _, raw = (call.data or "").partition(":")
+        route = self._routes.get(prefix)
+        if route is not None:
+            codec, handler = route
+            try:
+                return {"handler": handler, "cb": codec.unpack(raw), "callback_route": codec.head}
+            except ValueError:
+                pass
+        return {"handler": self._stale, "cb": None, "callback_route": self.STALE_ROUTE}
+
+    async def dispatch(self, call: types.CallbackQuery, **data: Any) -> Any:
+        return await data["handler"].call(call, **data)
+
+callbacks = CallbackRouter()
+dp.callback_query.register(callbacks.dispatch, callbacks.resolve)
+
+# ================= КЛАВИАТУРЫ (UI) =================
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """
+    Клавиатуры из кеша отдаются всем пользователям сразу — менять их нельзя.
+    """
+    model_config = ConfigDict(frozen=True)
+
+class KeyboardCache:
+    """
+    Ограниченный LRU-кеш готовых клавиатур со счётчиками попаданий/промахов.
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Any, InlineKeyboardMarkup]" = OrderedDict()
+
+    def get(self, key: Any, build: Callable[[], InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+        kb = self._items.get(key)
+        if kb is not None:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return kb
+        self.misses += 1
+        kb = build()
+        self._items[key] = kb
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return kb
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+# ключи календарных клавиатур содержат сегодняшнюю дату — после полуночи они сами становятся новыми
+_months_kb_cache = KeyboardCache("months", maxsize=4)
+_days_kb_cache = KeyboardCache("days", maxsize=128)
+_times_kb_cache = KeyboardCache("times", maxsize=512)
+_services_kb_cache = KeyboardCache("services", maxsize=1)
+_masters_kb_cache = KeyboardCache("masters", maxsize=128)
+
+def keyboard_cache_stats() -> Dict[str, Dict[str, int]]:
+    caches = (_months_kb_cache, _days_kb_cache, _times_kb_cache, _services_kb_cache, _masters_kb_cache)
+    return {c.name: c.stats() for c in caches}
+
+def _build_main_menu_kb() -> InlineKeyboardMarkup:
+    return FrozenInlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🗓 Записаться", callback_data=BOOK_CB.pack())],
+            [
+                InlineKeyboardButton(text="📋 Мои записи", callback_data=MY_CB.pack()),
+                InlineKeyboardButton(text="❌ Отменить", callback_data=MY_CANCEL_CB.pack()),
+            ],
+            [InlineKeyboardButton(text="📢 Телеграмм канал", url=CHANNEL_URL)],
+        ]
+    )
+
+MAIN_MENU_KB = _build_main_menu_kb()
+
+def main_menu_kb() -> InlineKeyboardMarkup:
+    return MAIN_MENU_KB
+
+def months_kb() -> InlineKeyboardMarkup:
+    today = datetime.date.today()
+    return _months_kb_cache.get(today, _build_months_kb)
+
+def _build_months_kb() -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    row: List[InlineKeyboardButton] = []
+    for (yy, mm, name) in next_months(6):
+        cb = MONTH_CB.pack(yy, mm)
+        row.append(InlineKeyboardButton(text=f"{name} {yy}", callback_data=cb))
+        if len(row) == 2:
+            rows.append(row)
+            row = []
+    if row:
+        rows.append(row)
+
+    rows.append([InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack())])
+    return FrozenInlineKeyboardMarkup(inline_keyboard=rows)
+
+def days_kb(year: int, month: int, free_counts: Dict[int, int]) -> InlineKeyboardMarkup:
+    """
+    На днях — число свободных слотов; полностью занятые рабочие дни помечены 🔔
+    (лист ожидания), выходные не показываем.
+    """
+    key = (datetime.date.today(), year, month, tuple(free_counts.items()))
+    return _days_kb_cache.get(key, lambda: _build_days_kb(year, month, free_counts))
+
+def _build_days_kb(year: int, month: int, free_counts: Dict[int, int]) -> InlineKeyboardMarkup:
+    max_day = days_in_month(year, month)
+    today = datetime.date.today()
+
+    rows: List[List[InlineKeyboardButton]] = []
+    row: List[InlineKeyboardButton] = []
+
+    for day in range(1, max_day + 1):
+        d = datetime.date(year, month, day)
+        if d < today:
+            continue
+        free = free_counts.get(day, 0)
+        if free <= 0 and not is_working_day(d.isoformat()):
+            continue
+
+        cb = DAY_CB.pack(d.isoformat())
+        row.append(InlineKeyboardButton(text=f"{day:02d}·{free if free > 0 else '🔔'}", callback_data=cb))
+        if len(row) == 5:
+            rows.append(row)
+            row = []
+    if row:
+        rows.append(row)
+
+    rows.append([
+        InlineKeyboardButton(text="⬅️ Назад к месяцам", callback_data=BACK_MONTHS_CB.pack()),
+        InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack()),
+    ])
+    return FrozenInlineKeyboardMarkup(inline_keyboard=rows)
+
+def days_text(year: int, month: int, free_counts: Dict[int, int]) -> str:
+    today = datetime.date.today()
+    upcoming = [
+        (day, free) for day, free in free_counts.items()
+        if datetime.date(year, month, day) >= today
+    ]
+    has_free = any(free > 0 for _, free in upcoming)
+    has_full = any(
+        free <= 0 and is_working_day(format_date_iso(year, month, day))
+        for day, free in upcoming
+    )
+    hint = "\n🔔 — всё занято, можно встать в лист ожидания" if has_full else ""
+    if not has_free:
+        return f"В этом месяце ({RU_MONTHS[month-1]} {year}) свободных дней нет 😔{hint}"
+    return f"Выбери день ({RU_MONTHS[month-1]} {year}):\nрядом с датой — число свободных слотов{hint}"
+
+def times_kb(date_iso: str, free_times: List[str]) -> InlineKeyboardMarkup:
+    key = (date_iso, tuple(free_times))
+    return _times_kb_cache.get(key, lambda: _build_times_kb(date_iso, free_times))
+
+def _build_times_kb(date_iso: str, free_times: List[str]) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    row: List[InlineKeyboardButton] = []
+    for t in free_times:
+        cb = TIME_CB.pack(date_iso, t)
+        row.append(InlineKeyboardButton(text=t, callback_data=cb))
+        if len(row) == 3:
+            rows.append(row)
+            row = []
+    if row:
+        rows.append(row)
+
+    rows.append([
+        InlineKeyboardButton(text="⬅️ Назад к дням", callback_data=BACK_DAYS_CB.pack(date_iso)),
+        InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack()),
+    ])
+    return FrozenInlineKeyboardMarkup(inline_keyboard=rows)
+
+def services_kb() -> InlineKeyboardMarkup:
+    return _services_kb_cache.get(tuple(schedule.services), _build_services_kb)
+
+def _build_services_kb() -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    for svc in schedule.services:
+        rows.append([InlineKeyboardButton(text=f"{svc.title} · {svc.duration} мин", callback_data=SERVICE_CB.pack(svc.code))])
+    rows.append([InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack())])
+    return FrozenInlineKeyboardMarkup(inline_keyboard=rows)
+
+def masters_kb(date_iso: str, free_by_master: Dict[int, List[str]]) -> InlineKeyboardMarkup:
+    key = (date_iso, tuple((m, len(t)) for m, t in free_by_master.items()))
+    return _masters_kb_cache.get(key, lambda: _build_masters_kb(date_iso, free_by_master))
+
+def _build_masters_kb(date_iso: str, free_by_master: Dict[int, List[str]]) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    for master_id, free_times in free_by_master.items():
+        master = masters.get(master_id)
+        rows.append([
+            InlineKeyboardButton(
+                text=f"{master.name} · свободно {len(free_times)}",
+                callback_data=MASTER_CB.pack(date_iso, master_id),
+            )
+        ])
+    rows.append([
+        InlineKeyboardButton(text="⬅️ Назад к дням", callback_data=BACK_DAYS_CB.pack(date_iso)),
+        InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack()),
+    ])
+    return FrozenInlineKeyboardMarkup(inline_keyboard=rows)
+
+def _build_contact_kb() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="📞 Отправить телефон (контакт)", request_contact=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+        input_field_placeholder="Нажми кнопку, чтобы отправить телефон",
+    )
+
+def _build_username_confirm_kb() -> InlineKeyboardMarkup:
+    return FrozenInlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Оставить как есть", callback_data=UNAME_KEEP_CB.pack())],
+            [InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack())],
+        ]
+    )
+
+CONTACT_KB = _build_contact_kb()
+USERNAME_CONFIRM_KB = _build_username_confirm_kb()
+
+def contact_kb() -> ReplyKeyboardMarkup:
+    return CONTACT_KB
+
+def username_confirm_kb() -> InlineKeyboardMarkup:
+    return USERNAME_CONFIRM_KB
+
+def cancel_list_kb(appointments: List[AppointmentRow]) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    for (app_id, date_iso, time_str, _, _, _) in appointments:
+        rows.append([
+            InlineKeyboardButton(
+                text=f"❌ {human_date(date_iso)} {time_str}",
+                callback_data=CANCEL_CB.pack(app_id),
+            )
+        ])
+    rows.append([InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def waitlist_kb(date_iso: str, subscribed: bool) -> InlineKeyboardMarkup:
+    if subscribed:
+        rows = [[InlineKeyboardButton(text="🔕 Больше не ждать", callback_data=WAIT_CB.pack(date_iso, None))]]
+    else:
+        rows = [
+            [InlineKeyboardButton(text=f"🔔 {label}", callback_data=WAIT_CB.pack(date_iso, i))]
+            for i, (label, _, _) in enumerate(WAITLIST_WINDOWS)
+        ]
+    rows.append([
+        InlineKeyboardButton(text="⬅️ Назад к дням", callback_data=BACK_DAYS_CB.pack(date_iso)),
+        InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack()),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def waitlist_offer_kb(d: datetime.date) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📅 Выбрать время", callback_data=DAY_CB.pack(d.isoformat()))],
+        [InlineKeyboardButton(text="🏠 Меню", callback_data=HOME_CB.pack())],
+    ])
+
+# ================= СЛОТЫ =================
+
+def parse_hhmm(value: str) -> int:
+    h, m = value.split(":")
+    return int(h) * 60 + int(m)
+
+def format_hhmm(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def intervals_overlap(a_start: int, a_end: int, b_start: int, b_end: int) -> bool:
+    return a_start < b_end and b_start < a_end
+
+class DayRule(NamedTuple):
+    start: int  # минуты от полуночи
+    end: int
+    breaks: Tuple[Tuple[int, int], ...] = ()
+
+class Service(NamedTuple):
+    code: str
+    title: str
+    duration: int  # минуты
+
+DEFAULT_SCHEDULE: Dict[str, Any] = {
+    "step": 60,
+    "weekdays": {str(wd): {"start": "10:00", "end": "19:00"} for wd in range(7)},
+    "days_off": [],
+    "services": [{"code": "mani", "title": "Маникюр", "duration": 60}],
+}
+
+class ScheduleEngine:
+    """
+    Расписание из правил: часы работы по дням недели, перерывы, выходные даты, услуги.
+    Сетка возможных начал для (правило дня, длительность) считается один раз и кешируется.
+    """
+
+    def __init__(
+        self,
+        weekdays: Dict[int, Optional[DayRule]],
+        days_off: Set[str],
+        step: int,
+        services: List[Service],
+    ):
+        if not services:
+            raise RuntimeError("Schedule has no services")
+        self.weekdays = weekdays
+        self.days_off = days_off
+        self.step = step
+        self.services = services
+        self._services_by_code = {s.code: s for s in services}
+        self._grids: Dict[Tuple[DayRule, int], Tuple[int, ...]] = {}
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "ScheduleEngine":
+        weekdays: Dict[int, Optional[DayRule]] = {}
+        for wd in range(7):
+            rule = cfg.get("weekdays", {}).get(str(wd))
+            if not rule:
+                weekdays[wd] = None  # выходной
+                continue
+            weekdays[wd] = DayRule(
+                start=parse_hhmm(rule["start"]),
+                end=parse_hhmm(rule["end"]),
+                breaks=tuple((parse_hhmm(a), parse_hhmm(b)) for a, b in rule.get("breaks", [])),
+            )
+        services = [Service(str(s["code"]), str(s["title"]), int(s["duration"])) for s in cfg.get("services", [])]
+        return cls(weekdays, set(cfg.get("days_off", [])), int(cfg.get("step", 60)), services)
+
+    @property
+    def default_service(self) -> Service:
+        return self.services[0]
+
+    def service(self, code: Optional[str]) -> Service:
+        return self._services_by_code.get(code or "", self.default_service)
+
+    def grid(self, rule: DayRule, duration: int) -> Tuple[int, ...]:
+        key = (rule, duration)
+        grid = self._grids.get(key)
+        if grid is None:
+            starts: List[int] = []
+            t = rule.start
+            while t + duration <= rule.end:
+                if not any(intervals_overlap(t, t + duration, a, b) for a, b in rule.breaks):
+                    starts.append(t)
+                t += self.step
+            grid = self._grids[key] = tuple(starts)
+        return grid
+
+    def candidates(self, date_iso: str, duration: int) -> Tuple[int, ...]:
+        if date_iso in self.days_off:
+            return ()
+        rule = self.weekdays.get(datetime.date.fromisoformat(date_iso).weekday())
+        if rule is None:
+            return ()
+        return self.grid(rule, duration)
+
+    def works(self, date_iso: str) -> bool:
+        if date_iso in self.days_off:
+            return False
+        return self.weekdays.get(datetime.date.fromisoformat(date_iso).weekday()) is not None
+
+    def work_minutes(self, date_iso: str) -> int:
+        """Рабочие минуты дня без перерывов — знаменатель загрузки в /stats."""
+        if date_iso in self.days_off:
+            return 0
+        rule = self.weekdays.get(datetime.date.fromisoformat(date_iso).weekday())
+        if rule is None:
+            return 0
+        return rule.end - rule.start - sum(b - a for a, b in rule.breaks)
+
+def load_schedule() -> ScheduleEngine:
+    if not SCHEDULE_JSON:
+        return ScheduleEngine.from_config(DEFAULT_SCHEDULE)
+    try:
+        cfg = json.loads(SCHEDULE_JSON)
+        return ScheduleEngine.from_config({**DEFAULT_SCHEDULE, **cfg})
+    except (ValueError, KeyError, TypeError) as e:
+        raise RuntimeError(f"ENV SCHEDULE_JSON is invalid: {e}")
+
+schedule = load_schedule()
+
+class Master(NamedTuple):
+    id: int
+    name: str
+    chat_id: int
+    schedule: ScheduleEngine
+
+SQL_ACTIVE_MASTERS = "SELECT id, name, chat_id, schedule FROM masters WHERE active=1 ORDER BY id"
+SQL_INSERT_MASTER = "INSERT INTO masters(name, chat_id, schedule) VALUES(?,?,?)"
+
+class MasterRegistry:
+    """
+    Активные мастера в памяти. У мастера может быть своё расписание (JSON в masters.schedule)
+    поверх общего SCHEDULE_JSON; услуги общие.
+    """
+
+    def __init__(self) -> None:
+        default = Master(DEFAULT_MASTER_ID, MASTER_NAME, MASTER_CHAT_ID, schedule)
+        self._by_id: Dict[int, Master] = {default.id: default}
+        self._active: List[Master] = [default]
+
+    @staticmethod
+    def _schedule_for(raw: Optional[str]) -> ScheduleEngine:
+        if not raw:
+            return schedule
+        base = json.loads(SCHEDULE_JSON) if SCHEDULE_JSON else {}
+        return ScheduleEngine.from_config({**DEFAULT_SCHEDULE, **base, **json.loads(raw)})
+
+    async def load(self) -> None:
+        rows = await database.fetchall(SQL_ACTIVE_MASTERS)
+        active: List[Master] = []
+        for master_id, name, chat_id, raw_schedule in rows:
+            try:
+                master_schedule = self._schedule_for(raw_schedule)
+            except (ValueError, KeyError, TypeError):
+                logging.exception("Bad schedule for master %s, using the default one", master_id)
+                master_schedule = schedule
+            active.append(Master(int(master_id), str(name), int(chat_id), master_schedule))
+        if active:
+            self._active = active
+            self._by_id = {m.id: m for m in active}
+
+    async def add(self, name: str, chat_id: int, raw_schedule: Optional[str] = None) -> Master:
+        self._schedule_for(raw_schedule)  # проверяем JSON до записи
+        async with database.write() as db:
+            await db.execute(SQL_INSERT_MASTER, (name, chat_id, raw_schedule))
+        await self.load()
+        cluster.publish("masters")
+        return self._active[-1]
+
+    def active(self) -> List[Master]:
+        return self._active
+
+    def get(self, master_id: Optional[int]) -> Master:
+        # мастер мог быть отключён, пока клиент записывался — тогда первый активный
+        return self._by_id.get(master_id or DEFAULT_MASTER_ID) or self._active[0]
+
+    def chat_id(self, master_id: int) -> int:
+        master = self._by_id.get(master_id)
+        return master.chat_id if master is not None else MASTER_CHAT_ID
+
+masters = MasterRegistry()
+
+def is_working_day(date_iso: str) -> bool:
+    return any(m.schedule.works(date_iso) for m in masters.active())
+
+def month_bounds(year: int, month: int) -> Tuple[str, str]:
+    return format_date_iso(year, month, 1), format_date_iso(year, month, days_in_month(year, month))
+
+class AvailabilityIndex:
+    """
+    Занятость в памяти: для каждого (мастер, дата) — отсортированный список интервалов [начало, конец) в минутах.
+    Месяц подгружается из SQLite одним запросом сразу по всем мастерам при первом обращении,
+    дальше проверки пересечений — bisect по списку без базы.
+    Источником истины при конфликтах остаётся база (см. create_appointment).
+    """
+
+    def __init__(self) -> None:
+        # записи одного мастера за дату не пересекаются, поэтому концы тоже отсортированы
+        self._busy: Dict[Tuple[int, str], List[Tuple[int, int]]] = {}
+        self._loaded: Set[Tuple[int, int]] = set()
+        self._locks: Dict[Tuple[int, int], asyncio.Lock] = {}
+        # счётчик изменений по месяцу: если во время загрузки пришла запись/отмена — перечитываем
+        self._versions: Dict[Tuple[int, int], int] = {}
+        # (год, месяц, длительность) -> {день: свободных слотов у всех мастеров}; сбрасывается при записи/отмене
+        self._overview: Dict[Tuple[int, int, int], Dict[int, int]] = {}
+
+    @staticmethod
+    def _month_key(date_iso: str) -> Tuple[int, int]:
+        return int(date_iso[0:4]), int(date_iso[5:7])
+
+    def is_loaded(self, year: int, month: int) -> bool:
+        return (year, month) in self._loaded
+
+    async def ensure_date(self, date_iso: str) -> None:
+        await self.ensure_month(*self._month_key(date_iso))
+
+    async def ensure_month(self, year: int, month: int) -> None:
+        key = (year, month)
+        if key in self._loaded:
+            return
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key in self._loaded:
+                return
+            first, last = month_bounds(year, month)
+            while True:
+                version = self._versions.get(key, 0)
+                rows = await database.fetchall(SQL_BOOKED_IN_RANGE, (first, last))
+                if self._versions.get(key, 0) == version:
+                    break
+
+            prefix = first[:8]
+            for k in [k for k in self._busy if k[1].startswith(prefix)]:
+                del self._busy[k]
+            by_key: Dict[Tuple[int, str], List[Tuple[int, int]]] = {}
+            for master_id, date_iso, time_str, duration in rows:
+                start = parse_hhmm(time_str)
+                by_key.setdefault((int(master_id), date_iso), []).append((start, start + int(duration)))
+            for k, intervals in by_key.items():
+                self._busy[k] = sorted(intervals)
+            self._drop_overview(key)
+            self._loaded.add(key)
+        self._locks.pop(key, None)
+
+    def _drop_overview(self, key: Tuple[int, int]) -> None:
+        for k in [k for k in self._overview if k[:2] == key]:
+            del self._overview[k]
+
+    def _touch(self, date_iso: str) -> None:
+        key = self._month_key(date_iso)
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._drop_overview(key)
+
+    def replace_date(self, master_id: int, date_iso: str, rows: List[Tuple[str, int]]) -> None:
+        """
+        Перезаписывает день мастера по данным из базы (когда индекс отстал).
+        """
+        self._touch(date_iso)
+        intervals = sorted((parse_hhmm(t), parse_hhmm(t) + int(d)) for t, d in rows)
+        if intervals:
+            self._busy[(master_id, date_iso)] = intervals
+        else:
+            self._busy.pop((master_id, date_iso), None)
+
+    def mark_busy(self, master_id: int, date_iso: str, time_str: str, duration: int) -> None:
+        cluster.publish("busy", master_id, date_iso, time_str, duration)
+        self._touch(date_iso)
+        start = parse_hhmm(time_str)
+        bisect.insort(self._busy.setdefault((master_id, date_iso), []), (start, start + duration))
+
+    def mark_free(self, master_id: int, date_iso: str, time_str: str) -> None:
+        cluster.publish("free", master_id, date_iso, time_str)
+        self._touch(date_iso)
+        key = (master_id, date_iso)
+        intervals = self._busy.get(key)
+        if not intervals:
+            return
+        # (master_id, date, time) уникальны — интервал однозначно определяется началом
+        start = parse_hhmm(time_str)
+        i = bisect.bisect_left(intervals, (start,))
+        if i < len(intervals) and intervals[i][0] == start:
+            del intervals[i]
+        if not intervals:
+            del self._busy[key]
+
+    def overlaps(self, master_id: int, date_iso: str, start: int, end: int) -> bool:
+        intervals = self._busy.get((master_id, date_iso))
+        if not intervals:
+            return False
+        # последний интервал, начавшийся до нашего конца, — единственный кандидат на пересечение
+        i = bisect.bisect_left(intervals, (end,))
+        return i > 0 and intervals[i - 1][1] > start
+
+    def free_starts(self, master: Master, date_iso: str, duration: int) -> List[int]:
+        return [
+            s for s in master.schedule.candidates(date_iso, duration)
+            if not self.overlaps(master.id, date_iso, s, s + duration)
+        ]
+
+    def month_overview(self, year: int, month: int, duration: int) -> Dict[int, int]:
+        """
+        {день: число свободных слотов у всех активных мастеров} для загруженного месяца.
+        Считается по интервалам в памяти и кешируется до первой записи/отмены в этом месяце.
+        """
+        key = (year, month, duration)
+        cached = self._overview.get(key)
+        if cached is None:
+            active = masters.active()
+            cached = {}
+            for day in range(1, days_in_month(year, month) + 1):
+                date_iso = format_date_iso(year, month, day)
+                cached[day] = sum(len(self.free_starts(m, date_iso, duration)) for m in active)
+            self._overview[key] = cached
+        return cached
+
+    def invalidate_overviews(self) -> None:
+        self._overview.clear()
+
+availability = AvailabilityIndex()
+
+HoldKey = Tuple[int, str, str]  # (master_id, date, time)
+
+class SlotHolds:
+    """
+    Временная бронь слота: выбрал время — слот закреплён за тобой на ttl секунд,
+    другим он в times_kb не показывается. Один пользователь держит не больше одного слота.
+    Истечение — через min-heap и один таймер loop.call_at на ближайший срок, без опроса.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        # (master_id, date, time) -> (user_id, expires_at, длительность)
+        self._holds: Dict[HoldKey, Tuple[int, float, int]] = {}
+        self._by_user: Dict[int, HoldKey] = {}
+        self._by_date: Dict[Tuple[int, str], Set[str]] = {}
+        # записи в куче не удаляем при отмене — устаревшие отбрасываются при срабатывании
+        self._heap: List[Tuple[float, HoldKey]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at = float("inf")
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def holder(self, master_id: int, date_iso: str, time_str: str) -> Optional[int]:
+        h = self._holds.get((master_id, date_iso, time_str))
+        if h is None or h[1] <= self._now():
+            return None
+        return h[0]
+
+    def acquire(self, user_id: int, master_id: int, date_iso: str, time_str: str, duration: int) -> bool:
+        """
+        Берёт или продлевает бронь. False — пересекается с бронью другого пользователя.
+        """
+        slot = (master_id, date_iso, time_str)
+        start = parse_hhmm(time_str)
+        for s, e in self.held_by_others(master_id, date_iso, user_id):
+            if intervals_overlap(start, start + duration, s, e):
+                return False
+
+        self._hold(user_id, slot, duration)
+        cluster.publish("hold", user_id, master_id, date_iso, time_str, duration)
+        return True
+
+    def assign(self, user_id: int, master_id: int, date_iso: str, time_str: str, duration: int) -> None:
+        """
+        Бронь, которую принял фронт кластера: она главнее здешних, пересекающиеся брони
+        других пользователей снимаются.
+        """
+        start = parse_hhmm(time_str)
+        for t in list(self._by_date.get((master_id, date_iso), ())):
+            h = self._holds[(master_id, date_iso, t)]
+            s = parse_hhmm(t)
+            if h[0] != user_id and intervals_overlap(start, start + duration, s, s + h[2]):
+                self._drop((master_id, date_iso, t))
+        self._hold(user_id, (master_id, date_iso, time_str), duration)
+
+    def revoke(self, user_id: int, master_id: int, date_iso: str, time_str: str) -> None:
+        """Фронт отклонил бронь: снимаем, если пользователь всё ещё держит именно этот слот."""
+        slot = (master_id, date_iso, time_str)
+        if self._by_user.get(user_id) == slot:
+            self._drop(slot)
+
+    def release(self, user_id: int) -> None:
+        slot = self._by_user.get(user_id)
+        if slot is not None:
+            self._drop(slot)
+            cluster.publish("release", user_id)
+
+    def _hold(self, user_id: int, slot: HoldKey, duration: int) -> None:
+        prev = self._by_user.get(user_id)
+        if prev is not None and prev != slot:
+            self._drop(prev)
+
+        expires_at = self._now() + self.ttl
+        self._holds[slot] = (user_id, expires_at, duration)
+        self._by_user[user_id] = slot
+        self._by_date.setdefault((slot[0], slot[1]), set()).add(slot[2])
+        heapq.heappush(self._heap, (expires_at, slot))
+        self._arm(expires_at)
+
+    def held_by_others(self, master_id: int, date_iso: str, user_id: Optional[int]) -> List[Tuple[int, int]]:
+        """
+        Интервалы [начало, конец) в минутах, которые у мастера на эту дату держат другие пользователи.
+        """
+        times = self._by_date.get((master_id, date_iso))
+        if not times:
+            return []
+        now = self._now()
+        out: List[Tuple[int, int]] = []
+        for t in times:
+            h = self._holds[(master_id, date_iso, t)]
+            if h[0] != user_id and h[1] > now:
+                start = parse_hhmm(t)
+                out.append((start, start + h[2]))
+        return out
+
+    def _drop(self, slot: HoldKey) -> None:
+        h = self._holds.pop(slot, None)
+        if h is None:
+            return
+        if self._by_user.get(h[0]) == slot:
+            del self._by_user[h[0]]
+        day = (slot[0], slot[1])
+        times = self._by_date.get(day)
+        if times is not None:
+            times.discard(slot[2])
+            if not times:
+                del self._by_date[day]
+
+    def _arm(self, when: float) -> None:
+        if when >= self._timer_at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = when
+        self._timer = asyncio.get_running_loop().call_at(when, self._expire)
+
+    def _expire(self) -> None:
+        self._timer = None
+        self._timer_at = float("inf")
+        now = self._now()
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, slot = heapq.heappop(self._heap)
+            h = self._holds.get(slot)
+            # бронь могли продлить или отпустить — тогда эта запись кучи устарела
+            if h is not None and h[1] == expires_at:
+                self._drop(slot)
+        if self._heap:
+            self._arm(self._heap[0][0])
+
+slot_holds = SlotHolds(SLOT_HOLD_TTL)
+
+@timed_db_helper
+async def month_free_counts(year: int, month: int, duration: int) -> Dict[int, int]:
+    await availability.ensure_month(year, month)
+    return availability.month_overview(year, month, duration)
+
+# ================= УВЕДОМЛЕНИЯ (OUTBOX) =================
+
+CREATE_OUTBOX_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    reply_markup TEXT,
+    parse_mode TEXT,
+    digest INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+CREATE_OUTBOX_INDEX_SQL = "CREATE INDEX IF NOT EXISTS outbox_next_at ON outbox(next_at);"
+
+SQL_OUTBOX_INSERT = (
+    "INSERT INTO outbox(chat_id, text, reply_markup, parse_mode, digest, next_at, created_at) "
+    "VALUES(?,?,?,?,?,?,?)"
+)
+# вместе с созревшими забираем все ожидающие сводки тех же чатов — они уйдут одним сообщением
+SQL_OUTBOX_DUE = """
+SELECT id, chat_id, text, reply_markup, parse_mode, digest, attempts, created_at FROM outbox
+WHERE next_at <= ?1
+   OR (digest = 1 AND chat_id IN (SELECT chat_id FROM outbox WHERE digest = 1 AND next_at <= ?1))
+ORDER BY id LIMIT ?2
+"""
+SQL_OUTBOX_NEXT_AT = "SELECT MIN(next_at) FROM outbox"
+SQL_OUTBOX_COUNT = "SELECT COUNT(*) FROM outbox"
+SQL_OUTBOX_DELETE = "DELETE FROM outbox WHERE id=?"
+SQL_OUTBOX_RETRY = "UPDATE outbox SET attempts=?, next_at=? WHERE id=?"
+
+OUTBOX_BATCH = 100
+OUTBOX_CONCURRENCY = 8
+TELEGRAM_TEXT_LIMIT = 4096
+
+Markup = Union[InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove]
+
+class OutboxMessage(NamedTuple):
+    chat_id: int
+    text: str
+    reply_markup: Optional[Markup] = None
+    parse_mode: Optional[str] = None
+    # True — можно склеить с соседними в одну сводку (уведомления мастеру)
+    digest: bool = False
+
+class _OutboxRow(NamedTuple):
+    id: int
+    chat_id: int
+    text: str
+    reply_markup: Optional[str]
+    parse_mode: Optional[str]
+    digest: int
+    attempts: int
+    created_at: float
+
+def dump_markup(markup: Optional[Markup]) -> Optional[str]:
+    if markup is None:
+        return None
+    return markup.model_dump_json(exclude_none=True)
+
+def load_markup(raw: Optional[str]) -> Optional[Markup]:
+    if not raw:
+        return None
+    data = json.loads(raw)
+    if "inline_keyboard" in data:
+        return InlineKeyboardMarkup.model_validate(data)
+    if "keyboard" in data:
+        return ReplyKeyboardMarkup.model_validate(data)
+    return ReplyKeyboardRemove.model_validate(data)
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity про запас.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def take(self) -> None:
+        while True:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float) -> None:
+        # после flood-wait от Telegram ведро уходит в минус — следующий токен появится через seconds
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1.0) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class NotificationOutbox:
+    """
+    Надёжная очередь исходящих сообщений в таблице outbox.
+    Хендлеры только кладут сообщения в очередь, фоновый воркер отправляет их
+    с учётом лимитов Telegram (общий и на чат), повторяет с backoff при ошибках
+    и склеивает пачки уведомлений мастеру в сводки.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.depth = 0
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._latencies: deque = deque(maxlen=1000)
+        # общий лимит бота: из этого же ведра берёт токены рассылка
+        self.global_rate = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._wake = asyncio.Event()
+        self.bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def enqueue(self, messages: List[OutboxMessage]) -> None:
+        async with self.db.write() as db:
+            count = await self.enqueue_in(db, messages)
+        self.kick(count)
+
+    async def enqueue_in(self, db: aiosqlite.Connection, messages: List[OutboxMessage]) -> int:
+        """
+        Кладёт сообщения в уже открытую транзакцию писателя — вместе с изменениями вызывающего.
+        После commit нужно вызвать kick(), иначе воркер узнает о них только по таймеру.
+        """
+        now = time.time()
+        rows = [
+            (
+                m.chat_id,
+                m.text,
+                dump_markup(m.reply_markup),
+                m.parse_mode,
+                int(m.digest),
+                now + OUTBOX_DIGEST_WINDOW if m.digest else now,
+                now,
+            )
+            for m in messages
+        ]
+        await db.executemany(SQL_OUTBOX_INSERT, rows)
+        return len(rows)
+
+    def kick(self, count: int) -> None:
+        # в кластере очередь разбирает фронт — будим его
+        if cluster.publish("outbox", count):
+            return
+        self.depth += count
+        self._wake.set()
+
+    async def start(self, bot: Bot) -> None:
+        self.bot = bot
+        row = await self.db.fetchone(SQL_OUTBOX_COUNT)
+        self.depth = int(row[0]) if row else 0
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        lat = sorted(self._latencies)
+
+        def pct(p: float) -> float:
+            return lat[min(len(lat) - 1, int(p * len(lat)))] if lat else 0.0
+
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "latency_p50": pct(0.50),
+            "latency_p95": pct(0.95),
+        }
+
+    async def _run(self) -> None:
+        last_report = time.monotonic()
+        while not self._stopping:
+            self._wake.clear()
+            timeout: Optional[float] = None
+            try:
+                rows = [_OutboxRow(*r) for r in await self.db.fetchall(SQL_OUTBOX_DUE, (time.time(), OUTBOX_BATCH))]
+                if rows:
+                    await self._deliver(rows)
+                    continue
+                row = await self.db.fetchone(SQL_OUTBOX_NEXT_AT)
+                if row and row[0] is not None:
+                    timeout = max(0.0, row[0] - time.time())
+            except Exception:
+                logging.exception("Outbox worker error")
+                timeout = 5.0
+
+            if time.monotonic() - last_report >= 60 and self.sent:
+                logging.info("Outbox stats: %s", self.stats())
+                last_report = time.monotonic()
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, rows: List[_OutboxRow]) -> None:
+        by_chat: Dict[int, List[_OutboxRow]] = {}
+        for r in rows:
+            by_chat.setdefault(r.chat_id, []).append(r)
+
+        done: List[int] = []
+        retry: List[Tuple[int, float, int]] = []
+        slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+
+        async def deliver_chat(chat_id: int, chat_rows: List[_OutboxRow]) -> None:
+            async with slots:
+                await self._deliver_chat(chat_id, chat_rows, done, retry)
+
+        await asyncio.gather(*(deliver_chat(c, rs) for c, rs in by_chat.items()))
+
+        async with self.db.write() as db:
+            if done:
+                await db.executemany(SQL_OUTBOX_DELETE, [(i,) for i in done])
+            if retry:
+                await db.executemany(SQL_OUTBOX_RETRY, retry)
+        self.depth = max(0, self.depth - len(done))
+
+        # вёдра простаивающих чатов не держим
+        if len(self._chats) > 1000:
+            for chat_id in [c for c, b in self._chats.items() if b.is_idle()]:
+                del self._chats[chat_id]
+
+    @staticmethod
+    def _units(chat_rows: List[_OutboxRow]) -> List[List[_OutboxRow]]:
+        """
+        Сообщения чата в порядке очереди; сводки склеиваются, пока влезают в лимит длины.
+        Подряд идущие обычные сообщения тоже уходят одним, если клавиатура есть только
+        у последнего из них и разметка текста одна и та же.
+        """
+        units: List[List[_OutboxRow]] = []
+        digest: List[_OutboxRow] = []
+        plain: List[_OutboxRow] = []
+        size = 0
+        plain_size = 0
+        for r in chat_rows:
+            if not r.digest:
+                if (
+                    plain
+                    and plain[-1].reply_markup is None
+                    and plain[-1].parse_mode == r.parse_mode
+                    and plain_size + len(r.text) + 2 <= TELEGRAM_TEXT_LIMIT
+                ):
+                    plain.append(r)
+                    plain_size += len(r.text) + 2
+                    continue
+                plain = [r]
+                plain_size = len(r.text)
+                units.append(plain)
+                continue
+            # между склеенными сообщениями не должно оказаться чужого
+            plain = []
+            if digest and size + len(r.text) + 2 > TELEGRAM_TEXT_LIMIT - 100:
+                digest = []
+            if not digest:
+                units.append(digest)
+                size = 0
+            digest.append(r)
+            size += len(r.text) + 2
+        return units
+
+    async def _deliver_chat(
+        self,
+        chat_id: int,
+        chat_rows: List[_OutboxRow],
+        done: List[int],
+        retry: List[Tuple[int, float, int]],
+    ) -> None:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 3)
+
+        units = self._units(chat_rows)
+        for i, unit in enumerate(units):
+            first = unit[0]
+            if len(unit) == 1:
+                text = first.text
+            elif first.digest:
+                text = f"📬 Сводка ({len(unit)}):\n\n" + "\n\n".join(r.text for r in unit)
+            else:
+                text = "\n\n".join(r.text for r in unit)
+
+            await bucket.take()
+            await self.global_rate.take()
+            try:
+                await self.bot.send_message(
+                    chat_id,
+                    text,
+                    reply_markup=load_markup(unit[-1].reply_markup),
+                    parse_mode=first.parse_mode,
+                )
+            except TelegramRetryAfter as e:
+                # flood-wait: переносим всё оставшееся в этом чате, попытку не считаем
+                bucket.penalize(e.retry_after)
+                next_at = time.time() + e.retry_after
+                for rest in units[i:]:
+                    retry.extend((r.attempts, next_at, r.id) for r in rest)
+                self.retried += 1
+                return
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # бот заблокирован / чат не найден — повторять бессмысленно
+                logging.warning("Outbox: dropping message to %s: %s", chat_id, e)
+                done.extend(r.id for r in unit)
+                self.dropped += len(unit)
+                continue
+            except Exception as e:
+                attempts = first.attempts + 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logging.error("Outbox: giving up on message to %s: %s", chat_id, e)
+                    done.extend(r.id for r in unit)
+                    self.dropped += len(unit)
+                    continue
+                # порядок сообщений в чате важен — откладываем и всё, что за этим
+                next_at = time.time() + min(300.0, 2.0 ** attempts)
+                for rest in units[i:]:
+                    retry.extend((max(r.attempts, attempts), next_at, r.id) for r in rest)
+                self.retried += 1
+                return
+
+            now = time.time()
+            for r in unit:
+                done.append(r.id)
+                self._latencies.append(now - r.created_at)
+            self.sent += len(unit)
+            if len(unit) > 1:
+                api_calls.count_saved("digest" if first.digest else "merged_send", "outbox", len(unit) - 1)
+
+outbox = NotificationOutbox(database)
+
+# ================= НАПОМИНАНИЯ =================
+
+CREATE_REMINDERS_SENT_SQL = """
+CREATE TABLE IF NOT EXISTS reminders_sent (
+    appointment_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    sent_at REAL NOT NULL,
+    PRIMARY KEY(appointment_id, kind)
+) WITHOUT ROWID;
+"""
+CREATE_REMINDERS_SENT_INDEX_SQL = "CREATE INDEX IF NOT EXISTS reminders_sent_at ON reminders_sent(sent_at);"
+
+# будущие записи и уже отправленные по ним напоминания ("24h,2h"); идёт по индексу appointments_date_time
+SQL_REMINDERS_UPCOMING = """
+SELECT a.id, a.user_id, a.date, a.time, a.service, a.master_id, group_concat(r.kind)
+FROM appointments a LEFT JOIN reminders_sent r ON r.appointment_id = a.id
+WHERE a.date >= ?
+GROUP BY a.id
+"""
+SQL_REMINDER_APPOINTMENT_EXISTS = "SELECT 1 FROM appointments WHERE id=?"
+SQL_REMINDER_MARK = "INSERT OR IGNORE INTO reminders_sent(appointment_id, kind, sent_at) VALUES(?,?,?)"
+SQL_REMINDERS_EXPIRE = "DELETE FROM reminders_sent WHERE sent_at < ?"
+
+# пропущенное за время простоя напоминание досылаем, если опоздали не больше чем на столько
+REMINDER_GRACE = 30 * 60
+# метки об отправке храним неделю — записи к тому времени уже в прошлом
+REMINDER_MARK_TTL = 7 * 24 * 3600
+# даже при пустой очереди просыпаемся раз в час: сверить часы и почистить метки
+REMINDER_MAX_SLEEP = 3600.0
+
+class Reminder(NamedTuple):
+    appointment_id: int
+    user_id: int
+    date: str
+    time: str
+    service: Optional[str]
+    master_id: int
+
+def reminder_kind(hours: int) -> str:
+    return f"{hours}h"
+
+class ReminderScheduler:
+    """
+    Напоминания клиентам за REMINDER_HOURS часов до записи.
+    Все будущие напоминания лежат в min-куче по времени срабатывания: на старте куча
+    строится одним запросом, дальше create_appointment/delete_appointment правят её сами.
+    Воркер спит ровно до ближайшего срока, а не опрашивает базу.
+    Метка в reminders_sent пишется в одной транзакции с сообщением в outbox,
+    поэтому после перезапуска одно и то же напоминание не уйдёт дважды.
+    """
+
+    def __init__(self, db: Database, out: NotificationOutbox, hours: List[int]):
+        self.db = db
+        self.outbox = out
+        self.hours = sorted(set(hours), reverse=True)
+        self.sent = 0
+        # (срок, id записи, за сколько часов); отменённые записи остаются в куче и пропускаются
+        self._heap: List[Tuple[float, int, int]] = []
+        self._pending: Dict[int, Reminder] = {}
+        self._left: Dict[int, int] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @staticmethod
+    def starts_at(r: Reminder) -> float:
+        return datetime.datetime.fromisoformat(f"{r.date}T{r.time}").timestamp()
+
+    def schedule(self, r: Reminder, sent: Set[int] = frozenset(), catch_up: bool = False) -> None:
+        """
+        Ставит напоминания по записи. Просроченные пропускаем: только что записавшемуся
+        «завтра у тебя запись» не нужно. С catch_up=True (старт после простоя) досылаем
+        самое позднее из недавно пропущенных.
+        """
+        # в кластере напоминания шлёт фронт — воркер только сообщает ему о записи
+        if cluster.publish("remind", *r):
+            return
+        now = time.time()
+        start = self.starts_at(r)
+        if start <= now or not self.hours:
+            return
+        missed: Optional[int] = None
+        pushed = 0
+        for hours in self.hours:
+            if hours in sent:
+                continue
+            due = start - hours * 3600
+            if due > now:
+                heapq.heappush(self._heap, (due, r.appointment_id, hours))
+                pushed += 1
+            elif catch_up and now - due <= REMINDER_GRACE:
+                missed = hours
+        if missed is not None:
+            heapq.heappush(self._heap, (now, r.appointment_id, missed))
+            pushed += 1
+        if not pushed:
+            return
+        self._pending[r.appointment_id] = r
+        self._left[r.appointment_id] = self._left.get(r.appointment_id, 0) + pushed
+        self._wake.set()
+
+    def cancel(self, appointment_id: int) -> None:
+        if cluster.publish("unremind", appointment_id):
+            return
+        self._pending.pop(appointment_id, None)
+        self._left.pop(appointment_id, None)
+        # мусор из отменённых чистим, когда его становится больше живых
+        if len(self._heap) > 64 and len(self._heap) > 2 * sum(self._left.values()):
+            self._heap = [e for e in self._heap if e[1] in self._pending]
+            heapq.heapify(self._heap)
+
+    async def start(self) -> None:
+        self._heap.clear()
+        self._pending.clear()
+        self._left.clear()
+        today_iso = datetime.date.today().isoformat()
+        for row in await self.db.fetchall(SQL_REMINDERS_UPCOMING, (today_iso,)):
+            *fields, kinds = row
+            sent = {int(k[:-1]) for k in kinds.split(",")} if kinds else set()
+            self.schedule(Reminder(*fields), sent, catch_up=True)
+        logging.info("Reminders: %d scheduled", len(self._heap))
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = None
+
+    def _pop_due(self, now: float) -> List[Tuple[Reminder, int]]:
+        due: List[Tuple[Reminder, int]] = []
+        while self._heap and self._heap[0][0] <= now:
+            _, appointment_id, hours = heapq.heappop(self._heap)
+            r = self._pending.get(appointment_id)
+            if r is None:
+                continue
+            due.append((r, hours))
+            self._left[appointment_id] -= 1
+            if not self._left[appointment_id]:
+                del self._left[appointment_id]
+                del self._pending[appointment_id]
+        return due
+
+    async def _run(self) -> None:
+        last_sweep = 0.0
+        while not self._stopping:
+            self._wake.clear()
+            now = time.time()
+            due = self._pop_due(now)
+            if due:
+                try:
+                    await self._fire(due, now)
+                except Exception:
+                    logging.exception("Reminders: send failed, retrying later")
+                    for r, hours in due:
+                        heapq.heappush(self._heap, (now + 30, r.appointment_id, hours))
+                        self._pending[r.appointment_id] = r
+                        self._left[r.appointment_id] = self._left.get(r.appointment_id, 0) + 1
+
+            if now - last_sweep >= REMINDER_MAX_SLEEP:
+                try:
+                    async with self.db.write() as db:
+                        await db.execute(SQL_REMINDERS_EXPIRE, (now - REMINDER_MARK_TTL,))
+                    last_sweep = now
+                except Exception:
+                    logging.exception("Reminders: sweep failed")
+
+            timeout = REMINDER_MAX_SLEEP
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+    async def _fire(self, due: List[Tuple[Reminder, int]], now: float) -> None:
+        count = 0
+        async with self.db.write() as db:
+            for r, hours in due:
+                # запись могли удалить между отменой в базе и cancel() — проверяем в той же транзакции
+                async with db.execute(SQL_REMINDER_APPOINTMENT_EXISTS, (r.appointment_id,)) as cur:
+                    if await cur.fetchone() is None:
+                        continue
+                async with db.execute(SQL_REMINDER_MARK, (r.appointment_id, reminder_kind(hours), now)) as cur:
+                    if not cur.rowcount:
+                        continue
+                count += await self.outbox.enqueue_in(db, [self._message(r, hours)])
+        self.outbox.kick(count)
+        self.sent += count
 
-# ================= FSM =================
+    @staticmethod
+    def _message(r: Reminder, hours: int) -> OutboxMessage:
+        when = "завтра" if hours == 24 else f"через {hours} ч."
+        return OutboxMessage(
+            r.user_id,
+            f"⏰ Напоминание: {when} у тебя запись.\n"
+            f"{service_line(schedule.service(r.service))}"
+            f"{master_line(masters.get(r.master_id))}"
+            f"Дата: {human_date(r.date)}\n"
+            f"Время: {r.time}\n\n"
+            "Если планы изменились — отмени запись в меню 👇",
+            reply_markup=main_menu_kb(),
+        )
 
-class BookingStates(StatesGroup):
-    choosing_date = State()
-    choosing_time = State()
-    waiting_phone = State()
-    waiting_username = State()
+reminders = ReminderScheduler(database, outbox, REMINDER_HOURS)
 
-# ================= БАЗА ДАННЫХ =================
+# ================= ЛИСТ ОЖИДАНИЯ =================
 
-CREATE_TABLE_SQL = """
-CREATE TABLE IF NOT EXISTS appointments (
+CREATE_WAITLIST_SQL = """
+CREATE TABLE IF NOT EXISTS waitlist (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     date TEXT NOT NULL,
-    time TEXT NOT NULL,
-    contact TEXT NOT NULL,
-    username TEXT,
-    created_at TEXT NOT NULL DEFAULT (datetime('now')),
-    UNIQUE(date, time)
+    time_from INTEGER NOT NULL,
+    time_to INTEGER NOT NULL,
+    service TEXT,
+    created_at REAL NOT NULL,
+    UNIQUE(user_id, date)
 );
 """
+# id растёт с каждой подпиской — по нему и идёт очередь
+CREATE_WAITLIST_INDEX_SQL = "CREATE INDEX IF NOT EXISTS waitlist_date ON waitlist(date, id);"
 
-async def init_db() -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(CREATE_TABLE_SQL)
-
-        # мягкая миграция для старых баз
-        try:
-            await db.execute("ALTER TABLE appointments ADD COLUMN username TEXT;")
-        except Exception:
-            pass
+SQL_WAITLIST_GET = "SELECT id, user_id, date, time_from, time_to, service FROM waitlist WHERE user_id=? AND date=?"
+# повторная подписка на ту же дату меняет окно, но не место в очереди; лимит дат на пользователя
+# проверяется тем же запросом — сверх лимита строка не вставляется и RETURNING пуст
+SQL_WAITLIST_JOIN = (
+    "INSERT INTO waitlist(user_id, date, time_from, time_to, service, created_at) SELECT ?,?,?,?,?,? "
+    "WHERE (SELECT count(*) FROM waitlist WHERE user_id=? AND date >= ? AND date != ?) < ? "
+    "ON CONFLICT(user_id, date) DO UPDATE SET "
+    "time_from=excluded.time_from, time_to=excluded.time_to, service=excluded.service "
+    "RETURNING id"
+)
+SQL_WAITLIST_REMOVE = "DELETE FROM waitlist WHERE user_id=? AND date=? RETURNING id"
+SQL_WAITLIST_DONE = "DELETE FROM waitlist WHERE id=?"
+SQL_WAITLIST_UPCOMING = (
+    "SELECT id, user_id, date, time_from, time_to, service FROM waitlist WHERE date >= ? ORDER BY id"
+)
+SQL_WAITLIST_PRUNE = "DELETE FROM waitlist WHERE date < ?"
 
-        await db.commit()
+WAITLIST_MAX_PER_USER = 5
+# окна времени, которые предлагаем при подписке: (подпись, с, до) в минутах от полуночи
+WAITLIST_WINDOWS = (
+    ("Весь день", 0, 24 * 60),
+    ("До 13:00", 0, 13 * 60),
+    ("После 13:00", 13 * 60, 24 * 60),
+)
 
-async def is_slot_free(date_iso: str, time_str: str) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT 1 FROM appointments WHERE date=? AND time=? LIMIT 1",
-            (date_iso, time_str),
-        ) as cur:
-            row = await cur.fetchone()
-            return row is None
+class WaitEntry(NamedTuple):
+    id: int
+    user_id: int
+    date: str
+    time_from: int
+    time_to: int
+    service: Optional[str]
 
-async def list_free_times(date_iso: str, times: List[str]) -> List[str]:
-    free: List[str] = []
-    async with aiosqlite.connect(DB_PATH) as db:
-        for t in times:
-            async with db.execute(
-                "SELECT 1 FROM appointments WHERE date=? AND time=? LIMIT 1",
-                (date_iso, t),
-            ) as cur:
-                row = await cur.fetchone()
-                if row is None:
-                    free.append(t)
-    return free
+def waitlist_window_label(entry: WaitEntry) -> str:
+    for label, start, end in WAITLIST_WINDOWS:
+        if (start, end) == (entry.time_from, entry.time_to):
+            return label.lower()
+    return f"{format_hhmm(entry.time_from)}–{format_hhmm(entry.time_to)}"
 
-async def create_appointment(user_id: int, date_iso: str, time_str: str, contact: str, username: str) -> bool:
+class WaitList:
     """
-    True если запись создана.
-    False если слот уже занят (защита от гонок/двойных кликов).
+    Лист ожидания на занятые дни. Подписки лежат в таблице waitlist, а в памяти —
+    словарь дата → подписки по порядку id, поэтому отмена записи проверяет только
+    ждущих своей даты, а не всю таблицу.
+    Освободилось время — пишем первым WAITLIST_BATCH подходящим по окну; если через
+    WAITLIST_BATCH_DELAY слот ещё свободен, пишем следующим. Кому написали, тех из листа
+    убираем в одной транзакции с сообщениями в outbox.
+    Подписки, пришедшие, пока писатель занят, пишутся одной транзакцией (групповой commit):
+    на каждую приходится один запрос, а не своя пара BEGIN/COMMIT и своя очередь к локу.
     """
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT INTO appointments(user_id, date, time, contact, username) VALUES(?,?,?,?,?)",
-                (user_id, date_iso, time_str, contact, username),
+
+    def __init__(self, db: Database, out: NotificationOutbox):
+        self.db = db
+        self.outbox = out
+        self.notified = 0
+        self._by_date: Dict[str, List[WaitEntry]] = {}
+        self._dirty: Set[str] = set()
+        self._running: Dict[str, asyncio.Task] = {}
+        self._joins: List[Tuple[tuple, asyncio.Future]] = []
+        self._join_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._by_date.values())
+
+    async def join(self, params: tuple) -> Optional[int]:
+        """id подписки по параметрам SQL_WAITLIST_JOIN; None — лимит дат исчерпан."""
+        fut = asyncio.get_running_loop().create_future()
+        self._joins.append((params, fut))
+        if self._join_task is None or self._join_task.done():
+            self._join_task = asyncio.create_task(self._write_joins())
+        return await fut
+
+    async def _write_joins(self) -> None:
+        while self._joins:
+            batch, self._joins = self._joins, []
+            try:
+                async with self.db.write() as db:
+                    results = [await db.execute_fetchall(SQL_WAITLIST_JOIN, params) for params, _ in batch]
+            except BaseException as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                continue
+            for (_, fut), rows in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(int(rows[0][0]) if rows else None)
+
+    def entry(self, user_id: int, date_iso: str) -> Optional[WaitEntry]:
+        return next((e for e in self._by_date.get(date_iso, ()) if e.user_id == user_id), None)
+
+    async def start(self) -> None:
+        self._by_date.clear()
+        for row in await self.db.fetchall(SQL_WAITLIST_UPCOMING, (datetime.date.today().isoformat(),)):
+            entry = WaitEntry(*row)
+            self._by_date.setdefault(entry.date, []).append(entry)
+
+    async def stop(self) -> None:
+        # подписки, уже отданные в групповой commit, дописываем — их ждут хендлеры
+        if self._join_task is not None:
+            with suppress(asyncio.CancelledError):
+                await self._join_task
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+
+    def add(self, entry: WaitEntry) -> None:
+        # в кластере лист ведёт фронт — воркер только сообщает о подписке
+        if cluster.publish("wait", *entry):
+            return
+        entries = self._by_date.setdefault(entry.date, [])
+        entries[:] = [e for e in entries if e.user_id != entry.user_id]
+        bisect.insort(entries, entry)
+
+    def discard(self, user_id: int, date_iso: str) -> None:
+        if cluster.publish("unwait", user_id, date_iso):
+            return
+        entries = self._by_date.get(date_iso)
+        if entries is None:
+            return
+        entries[:] = [e for e in entries if e.user_id != user_id]
+        if not entries:
+            del self._by_date[date_iso]
+
+    def freed(self, date_iso: str) -> None:
+        """На дату освободилось время (отмена записи)."""
+        if cluster.publish("freed", date_iso):
+            return
+        if date_iso not in self._by_date:
+            return
+        self._dirty.add(date_iso)
+        if date_iso not in self._running:
+            self._running[date_iso] = asyncio.create_task(self._fan_out(date_iso))
+
+    async def prune(self) -> int:
+        today_iso = datetime.date.today().isoformat()
+        async with self.db.write() as db:
+            async with db.execute(SQL_WAITLIST_PRUNE, (today_iso,)) as cur:
+                removed = cur.rowcount
+        for date_iso in [d for d in self._by_date if d < today_iso]:
+            del self._by_date[date_iso]
+        return removed
+
+    async def _fan_out(self, date_iso: str) -> None:
+        try:
+            while date_iso in self._dirty:
+                self._dirty.discard(date_iso)
+                batch = await self._next_batch(date_iso)
+                if not batch:
+                    continue
+                await self._send(date_iso, batch)
+                # пока слот свободен, через паузу пишем следующим в очереди
+                self._dirty.add(date_iso)
+                await asyncio.sleep(WAITLIST_BATCH_DELAY)
+        except Exception:
+            logging.exception("Waitlist fan-out for %s failed", date_iso)
+        finally:
+            self._running.pop(date_iso, None)
+
+    async def _next_batch(self, date_iso: str) -> List[Tuple[WaitEntry, int]]:
+        """Первые по очереди подписки, в чьё окно попадает свободное сейчас время."""
+        now = datetime.datetime.now()
+        earliest = now.hour * 60 + now.minute if date_iso == now.date().isoformat() else -1
+        free_by_duration: Dict[int, List[int]] = {}
+        batch: List[Tuple[WaitEntry, int]] = []
+        for entry in list(self._by_date.get(date_iso, ())):
+            duration = schedule.service(entry.service).duration
+            if duration not in free_by_duration:
+                by_master = await list_free_times_by_master(date_iso, duration)
+                free_by_duration[duration] = sorted(
+                    {s for times in by_master.values() for s in map(parse_hhmm, times) if s > earliest}
+                )
+            start = next((s for s in free_by_duration[duration] if entry.time_from <= s < entry.time_to), None)
+            if start is not None:
+                batch.append((entry, start))
+                if len(batch) >= WAITLIST_BATCH:
+                    break
+        return batch
+
+    async def _send(self, date_iso: str, batch: List[Tuple[WaitEntry, int]]) -> None:
+        d = datetime.date.fromisoformat(date_iso)
+        messages = [
+            OutboxMessage(
+                entry.user_id,
+                f"🔔 Освободилось время: {human_date(date_iso)} в {format_hhmm(start)}!\n"
+                "Успей записаться — слот достанется тому, кто подтвердит первым.",
+                reply_markup=waitlist_offer_kb(d),
             )
-            await db.commit()
-        return True
-    except aiosqlite.IntegrityError:
-        return False
+            for entry, start in batch
+        ]
+        async with self.db.write() as db:
+            await db.executemany(SQL_WAITLIST_DONE, [(entry.id,) for entry, _ in batch])
+            count = await self.outbox.enqueue_in(db, messages)
+        self.outbox.kick(count)
+        for entry, _ in batch:
+            self.discard(entry.user_id, entry.date)
+        self.notified += len(batch)
 
-async def list_user_appointments(
-    user_id: int,
-    only_future: bool = True
-) -> List[Tuple[int, str, str, str, Optional[str]]]:
+    def stats(self) -> Dict[str, int]:
+        return {"waiting": len(self), "dates": len(self._by_date), "notified": self.notified}
+
+waitlist = WaitList(database, outbox)
+
+@timed_db_helper
+async def get_waitlist_entry(user_id: int, date_iso: str) -> Optional[WaitEntry]:
+    # лист в памяти ведёт процесс с очередью уведомлений; воркер кластера его не держит и спрашивает базу
+    if not cluster.is_worker:
+        return waitlist.entry(user_id, date_iso)
+    row = await database.fetchone(SQL_WAITLIST_GET, (user_id, date_iso))
+    return WaitEntry(*row) if row else None
+
+@timed_db_helper
+async def join_waitlist(user_id: int, date_iso: str, window: int, service: Optional[str]) -> Optional[WaitEntry]:
     """
-    (id, date_iso, time_str, contact, username)
+    Подписка на дату в окне WAITLIST_WINDOWS[window]. None — у пользователя уже
+    WAITLIST_MAX_PER_USER других дат в ожидании.
     """
-    query = "SELECT id, date, time, contact, username FROM appointments WHERE user_id=?"
-    params: List[Any] = [user_id]
+    _, time_from, time_to = WAITLIST_WINDOWS[window]
+    today_iso = datetime.date.today().isoformat()
+    entry_id = await waitlist.join(
+        (user_id, date_iso, time_from, time_to, service, time.time(), user_id, today_iso, date_iso, WAITLIST_MAX_PER_USER)
+    )
+    if entry_id is None:
+        return None
+    entry = WaitEntry(entry_id, user_id, date_iso, time_from, time_to, service)
+    waitlist.add(entry)
+    return entry
 
-    if only_future:
-        today_iso = datetime.date.today().isoformat()
-        query += " AND date >= ?"
-        params.append(today_iso)
+@timed_db_helper
+async def leave_waitlist(user_id: int, date_iso: str) -> bool:
+    async with database.write() as db:
+        removed = bool(await db.execute_fetchall(SQL_WAITLIST_REMOVE, (user_id, date_iso)))
+    if removed:
+        waitlist.discard(user_id, date_iso)
+    return removed
 
-    query += " ORDER BY date ASC, time ASC"
+# ================= АНТИФЛУД =================
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(query, params) as cur:
-            rows = await cur.fetchall()
-            out: List[Tuple[int, str, str, str, Optional[str]]] = []
-            for r in rows:
-                out.append((int(r[0]), str(r[1]), str(r[2]), str(r[3]), (str(r[4]) if r[4] is not None else None)))
-            return out
+# выше этого числа вёдер чистим простаивающие
+FLOOD_SWEEP_SIZE = 4096
 
-async def get_user_appointment_by_id(user_id: int, appointment_id: int) -> Optional[Tuple[int, str, str, str, Optional[str]]]:
+class AntiFloodMiddleware(BaseMiddleware):
     """
-    Возвращает (id, date, time, contact, username) если принадлежит user_id
+    Внешний middleware на сообщения и колбэки, до фильтров и хендлеров:
+    - у каждого пользователя своё ведро токенов (FLOOD_RATE в секунду, запас FLOOD_BURST);
+    - повторное нажатие той же кнопки, пока первое ещё обрабатывается, отбрасывается.
+    Отброшенному колбэку отвечаем пустым call.answer(), чтобы у клиента погасли «часики».
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT id, date, time, contact, username FROM appointments WHERE id=? AND user_id=? LIMIT 1",
-            (appointment_id, user_id),
-        ) as cur:
-            r = await cur.fetchone()
-            if not r:
-                return None
-            return (int(r[0]), str(r[1]), str(r[2]), str(r[3]), (str(r[4]) if r[4] is not None else None))
 
-async def delete_appointment(user_id: int, appointment_id: int) -> Optional[Tuple[int, str, str, str, Optional[str]]]:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._in_flight: Set[Tuple[int, str]] = set()
+
+    def _allow(self, user_id: int) -> bool:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= FLOOD_SWEEP_SIZE:
+                # полное ведро ничем не отличается от отсутствующего
+                for uid in [u for u, b in self._buckets.items() if b.is_idle()]:
+                    del self._buckets[uid]
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket.try_take()
+
+    async def _shed(self, event: types.TelegramObject, reason: str) -> None:
+        kind = "callback" if isinstance(event, types.CallbackQuery) else "message"
+        metrics.inc("bot_flood_shed_total", (("event", kind), ("reason", reason)))
+        if isinstance(event, types.CallbackQuery):
+            with suppress(TelegramBadRequest):
+                await event.answer()
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+
+        if not isinstance(event, types.CallbackQuery):
+            if not self._allow(user.id):
+                return await self._shed(event, "rate")
+            return await handler(event, data)
+
+        key = (user.id, event.data or "")
+        if key in self._in_flight:
+            return await self._shed(event, "duplicate")
+        if not self._allow(user.id):
+            return await self._shed(event, "rate")
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+
+anti_flood = AntiFloodMiddleware(FLOOD_RATE, FLOOD_BURST)
+dp.message.outer_middleware(anti_flood)
+dp.callback_query.outer_middleware(anti_flood)
+
+# ================= ПОЛЬЗОВАТЕЛИ И РАССЫЛКИ =================
+
+CREATE_USERS_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    blocked INTEGER NOT NULL DEFAULT 0
+);
+"""
+CREATE_BROADCASTS_SQL = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT,
+    from_chat_id INTEGER,
+    message_id INTEGER,
+    status TEXT NOT NULL DEFAULT 'running',
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+"""
+
+# вернулся — значит, снова принимает сообщения
+SQL_USERS_TOUCH = (
+    "INSERT INTO users(user_id, username, first_seen, last_seen) VALUES(?,?,?,?) "
+    "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, last_seen=excluded.last_seen, blocked=0"
+)
+SQL_USERS_SET_BLOCKED = (
+    "INSERT INTO users(user_id, username, first_seen, last_seen, blocked) VALUES(?,?,?,?,?) "
+    "ON CONFLICT(user_id) DO UPDATE SET blocked=excluded.blocked"
+)
+SQL_USERS_MARK_BLOCKED = "UPDATE users SET blocked=1 WHERE user_id=?"
+SQL_USERS_BACKFILL = (
+    "INSERT OR IGNORE INTO users(user_id, first_seen, last_seen) "
+    "SELECT user_id, coalesce(min(ts), strftime('%s', 'now')), coalesce(max(ts), strftime('%s', 'now')) FROM ("
+    "SELECT user_id, CAST(strftime('%s', created_at) AS REAL) AS ts FROM appointments UNION ALL "
+    "SELECT user_id, CAST(strftime('%s', created_at) AS REAL) FROM appointments_history"
+    ") GROUP BY user_id"
+)
+# получатели рассылки по возрастанию user_id: следующая пачка начинается после последнего отправленного
+SQL_USERS_RECIPIENTS = "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?"
+SQL_USERS_ACTIVE_COUNT = "SELECT count(*) FROM users WHERE blocked = 0"
+
+BROADCAST_COLUMNS = (
+    "id, text, from_chat_id, message_id, status, last_user_id, sent, blocked, failed, total, created_at, finished_at"
+)
+SQL_BROADCAST_INSERT = (
+    "INSERT INTO broadcasts(text, from_chat_id, message_id, total, created_at) VALUES(?,?,?,?,?) RETURNING id"
+)
+SQL_BROADCAST_RUNNING = f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1"
+SQL_BROADCAST_LAST = f"SELECT {BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT 1"
+SQL_BROADCAST_CHECKPOINT = (
+    "UPDATE broadcasts SET last_user_id=?, sent=sent+?, blocked=blocked+?, failed=failed+? WHERE id=? RETURNING status"
+)
+SQL_BROADCAST_FINISH = (
+    "UPDATE broadcasts SET status='done', finished_at=? WHERE id=? AND status='running' RETURNING sent, blocked, failed"
+)
+SQL_BROADCAST_CANCEL = "UPDATE broadcasts SET status='cancelled', finished_at=? WHERE status='running' RETURNING id"
+
+# реестр: как долго копим визиты перед записью, как часто обновляем last_seen постоянного
+# пользователя и скольких уже записанных помним, чтобы не писать их снова
+USERS_FLUSH_DELAY = 5.0
+USERS_TOUCH_INTERVAL = 3600.0
+USERS_SEEN_SIZE = 100_000
+BROADCAST_MAX_ATTEMPTS = 3
+
+class UserRegistry:
     """
-    Удаляет запись, только если принадлежит этому user_id.
-    Возвращает данные удалённой записи (id, date, time, contact, username) или None.
+    Реестр всех, кто пользовался ботом (таблица users) — по нему идут рассылки.
+    Пополняется из каждого сообщения и колбэка, но в базу визиты уходят пачкой раз в
+    USERS_FLUSH_DELAY секунд, а уже записанного пользователя повторно пишем не чаще
+    раза в USERS_TOUCH_INTERVAL или когда сменился username. Постоянный клиент,
+    листающий календарь, не даёт ни одной лишней записи.
     """
-    appt = await get_user_appointment_by_id(user_id, appointment_id)
-    if appt is None:
-        return None
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM appointments WHERE id=? AND user_id=?", (appointment_id, user_id))
-        await db.commit()
+    def __init__(self, db: Database, flush_delay: float = USERS_FLUSH_DELAY):
+        self.db = db
+        self.flush_delay = flush_delay
+        self.written = 0
+        self._pending: Dict[int, Tuple[Optional[str], float]] = {}
+        self._seen: "OrderedDict[int, Tuple[Optional[str], float]]" = OrderedDict()
+        self._flush_task: Optional[asyncio.Task] = None
 
-    return appt
+    def touch(self, user: types.User) -> None:
+        now = time.time()
+        seen = self._seen.get(user.id)
+        if seen is not None and seen[0] == user.username and now - seen[1] < USERS_TOUCH_INTERVAL:
+            return
+        self._pending[user.id] = (user.username, now)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
 
-# ================= ДАТЫ/МЕСЯЦЫ =================
+    async def set_blocked(self, user: types.User, blocked: bool) -> None:
+        # отложенный визит не должен затереть блокировку
+        self._pending.pop(user.id, None)
+        self._seen.pop(user.id, None)
+        now = time.time()
+        async with self.db.write() as db:
+            await db.execute(SQL_USERS_SET_BLOCKED, (user.id, user.username, now, now, int(blocked)))
 
-RU_MONTHS = [
-    "январь", "февраль", "март", "апрель", "май", "июнь",
-    "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"
-]
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
 
-def next_months(count: int = 6) -> List[Tuple[int, int, str]]:
-    today = datetime.date.today()
-    y, m = today.year, today.month
-    out: List[Tuple[int, int, str]] = []
-    for i in range(count):
-        mm = m + i
-        yy = y + (mm - 1) // 12
-        m2 = ((mm - 1) % 12) + 1
-        out.append((yy, m2, RU_MONTHS[m2 - 1]))
-    return out
+    async def flush(self) -> None:
+        if not self._pending or not self.db.is_open:
+            return
+        pending = self._pending
+        self._pending = {}
+        try:
+            async with self.db.write() as db:
+                await db.executemany(
+                    SQL_USERS_TOUCH, [(uid, name, seen, seen) for uid, (name, seen) in pending.items()]
+                )
+        except asyncio.CancelledError:
+            self._restore(pending)
+            raise
+        except Exception:
+            logging.exception("Users flush failed, will retry")
+            self._restore(pending)
+            if self._flush_task is None or self._flush_task.done() or self._flush_task is asyncio.current_task():
+                self._flush_task = asyncio.create_task(self._flush_later())
+            return
+        self.written += len(pending)
+        for uid, visit in pending.items():
+            self._seen[uid] = visit
+            self._seen.move_to_end(uid)
+        while len(self._seen) > USERS_SEEN_SIZE:
+            self._seen.popitem(last=False)
 
-def days_in_month(year: int, month: int) -> int:
-    next_m = month + 1
-    next_y = year
-    if next_m == 13:
-        next_m = 1
-        next_y += 1
-    last_day = (datetime.date(next_y, next_m, 1) - datetime.timedelta(days=1)).day
-    return last_day
+    def _restore(self, pending: Dict[int, Tuple[Optional[str], float]]) -> None:
+        # более свежие визиты, пришедшие во время записи, не затираем
+        for uid, visit in pending.items():
+            self._pending.setdefault(uid, visit)
 
-def format_date_iso(year: int, month: int, day: int) -> str:
-    return f"{year:04d}-{month:02d}-{day:02d}"
+    async def close(self) -> None:
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flush_task
+        await self.flush()
 
-def human_date(date_iso: str) -> str:
-    d = datetime.date.fromisoformat(date_iso)
-    return f"{d.day:02d}.{d.month:02d}.{d.year}"
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._pending), "seen": len(self._seen), "written": self.written}
 
-def normalize_username(text: str) -> str:
-    t = (text or "").strip()
-    if not t:
-        return ""
-    if t.startswith("@"):
-        return t
-    if " " in t:
-        return t
-    return "@" + t
+user_registry = UserRegistry(database)
 
-# ================= КЛАВИАТУРЫ (UI) =================
+async def track_users(
+    handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+    event: types.TelegramObject,
+    data: Dict[str, Any],
+) -> Any:
+    user = getattr(event, "from_user", None)
+    if user is not None and not user.is_bot:
+        user_registry.touch(user)
+    return await handler(event, data)
 
-def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🗓 Записаться", callback_data="menu:book")],
-            [
-                InlineKeyboardButton(text="📋 Мои записи", callback_data="menu:my"),
-                InlineKeyboardButton(text="❌ Отменить", callback_data="menu:cancel"),
-            ],
-            [InlineKeyboardButton(text="📢 Телеграмм канал", url=CHANNEL_URL)],
-        ]
-    )
+# после антифлуда: отброшенные апдейты в реестр не пишем
+dp.message.outer_middleware(track_users)
+dp.callback_query.outer_middleware(track_users)
 
-def months_kb() -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
-    for (yy, mm, name) in next_months(6):
-        cb = f"m:{yy}:{mm}"
-        row.append(InlineKeyboardButton(text=f"{name} {yy}", callback_data=cb))
-        if len(row) == 2:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
+@dp.my_chat_member()
+async def on_my_chat_member(event: types.ChatMemberUpdated):
+    # личный чат: Telegram сам сообщает, что бота заблокировали или разблокировали
+    if event.chat.type != "private":
+        return
+    status = event.new_chat_member.status
+    if status == "kicked":
+        await user_registry.set_blocked(event.from_user, True)
+    elif status == "member":
+        await user_registry.set_blocked(event.from_user, False)
 
-    rows.append([InlineKeyboardButton(text="🏠 Меню", callback_data="menu:home")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+class Broadcast(NamedTuple):
+    id: int
+    text: Optional[str]
+    from_chat_id: Optional[int]
+    message_id: Optional[int]
+    status: str
+    last_user_id: int
+    sent: int
+    blocked: int
+    failed: int
+    total: int
+    created_at: float
+    finished_at: Optional[float]
 
-def days_kb(year: int, month: int) -> InlineKeyboardMarkup:
-    max_day = days_in_month(year, month)
-    today = datetime.date.today()
+class BroadcastRunner:
+    """
+    Рассылка по реестру пользователей. Получателей читаем из базы пачками по
+    BROADCAST_BATCH в порядке user_id и шлём не больше BROADCAST_CONCURRENCY
+    одновременно, не быстрее BROADCAST_RATE и в пределах общего лимита бота,
+    который делим с очередью уведомлений.
+    После каждой пачки в broadcasts сохраняется последний user_id и счётчики: после
+    рестарта рассылка продолжается с этого места, а не начинается заново. Заблокировавших
+    бота помечаем в users — в следующие рассылки они не попадают.
+    В кластере рассылку ведёт фронт, воркер только будит его.
+    """
 
-    rows: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
+    def __init__(self, db: Database, out: NotificationOutbox):
+        self.db = db
+        self.outbox = out
+        self.current: Optional[int] = None
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self._rate = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
 
-    for day in range(1, max_day + 1):
-        d = datetime.date(year, month, day)
-        if d < today:
-            continue
+    async def start(self, bot: Bot) -> None:
+        # незаконченная до рестарта рассылка продолжается сама
+        self.bot = bot
+        self.kick()
 
-        cb = f"d:{year}:{month}:{day}"
-        row.append(InlineKeyboardButton(text=f"{day:02d}", callback_data=cb))
-        if len(row) == 7:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
+    def kick(self) -> None:
+        if cluster.publish("broadcast"):
+            return
+        # до start() не запускаем: рассылка уже в базе, start() её подхватит
+        if self.bot is None:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
 
-    rows.append([
-        InlineKeyboardButton(text="⬅️ Назад к месяцам", callback_data="back:months"),
-        InlineKeyboardButton(text="🏠 Меню", callback_data="menu:home"),
-    ])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
 
-def times_kb(date_iso: str, free_times: List[str]) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
-    for t in free_times:
-        cb = f"t:{date_iso}:{t}"
-        row.append(InlineKeyboardButton(text=t, callback_data=cb))
-        if len(row) == 3:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
+    async def _run(self) -> None:
+        try:
+            while True:
+                row = await self.db.fetchone(SQL_BROADCAST_RUNNING)
+                if row is None:
+                    return
+                self.current = row[0]
+                await self._broadcast(Broadcast(*row))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Broadcast worker error")
+        finally:
+            self.current = None
 
-    rows.append([
-        InlineKeyboardButton(text="⬅️ Назад к дням", callback_data=f"back:days:{date_iso}"),
-        InlineKeyboardButton(text="🏠 Меню", callback_data="menu:home"),
-    ])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+    async def _broadcast(self, b: Broadcast) -> None:
+        logging.info("Broadcast #%s: resuming after user %s", b.id, b.last_user_id)
+        after = b.last_user_id
+        while True:
+            rows = await self.db.fetchall(SQL_USERS_RECIPIENTS, (after, BROADCAST_BATCH))
+            if not rows:
+                await self._finish(b)
+                return
+            user_ids = [int(r[0]) for r in rows]
+            outcomes: Dict[int, str] = {}
+            try:
+                await self._send_batch(b, user_ids, outcomes)
+            except asyncio.CancelledError:
+                # остановка посреди пачки: сохраняем начало пачки, где всё уже отправлено,
+                # — после рестарта повторно получат не больше BROADCAST_CONCURRENCY человек
+                done: List[int] = []
+                for user_id in user_ids:
+                    if user_id not in outcomes:
+                        break
+                    done.append(user_id)
+                if done:
+                    await self._checkpoint(b.id, done, outcomes)
+                raise
+            if await self._checkpoint(b.id, user_ids, outcomes) != "running":
+                logging.info("Broadcast #%s cancelled", b.id)
+                return
+            after = user_ids[-1]
 
-def contact_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="📞 Отправить телефон (контакт)", request_contact=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-        input_field_placeholder="Нажми кнопку, чтобы отправить телефон",
-    )
+    async def _send_batch(self, b: Broadcast, user_ids: List[int], outcomes: Dict[int, str]) -> None:
+        slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
 
-def username_confirm_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Оставить как есть", callback_data="uname:keep")],
-            [InlineKeyboardButton(text="🏠 Меню", callback_data="menu:home")],
-        ]
-    )
+        async def send(user_id: int) -> None:
+            async with slots:
+                outcomes[user_id] = await self._send_one(b, user_id)
 
-def cancel_list_kb(appointments: List[Tuple[int, str, str, str, Optional[str]]]) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    for (app_id, date_iso, time_str, _, _) in appointments:
-        rows.append([
-            InlineKeyboardButton(
-                text=f"❌ {human_date(date_iso)} {time_str}",
-                callback_data=f"cancel:{app_id}",
-            )
-        ])
-    rows.append([InlineKeyboardButton(text="🏠 Меню", callback_data="menu:home")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+        await asyncio.gather(*(send(u) for u in user_ids))
 
-# ================= СЛОТЫ =================
+    async def _send_one(self, b: Broadcast, user_id: int) -> str:
+        attempts = 0
+        while True:
+            await self._rate.take()
+            await self.outbox.global_rate.take()
+            try:
+                if b.message_id is not None:
+                    await self.bot.copy_message(user_id, b.from_chat_id, b.message_id)
+                else:
+                    await self.bot.send_message(user_id, b.text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                # flood-wait касается всего бота: притормаживаем и рассылку, и уведомления
+                self._rate.penalize(e.retry_after)
+                self.outbox.global_rate.penalize(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                # не помечаем заблокированным: причина может быть и в самом сообщении
+                logging.warning("Broadcast #%s: failed for %s: %s", b.id, user_id, e)
+                return "failed"
+            except Exception as e:
+                attempts += 1
+                if attempts >= BROADCAST_MAX_ATTEMPTS:
+                    logging.warning("Broadcast #%s: giving up on %s: %s", b.id, user_id, e)
+                    return "failed"
+                await asyncio.sleep(2 ** attempts)
 
-DEFAULT_TIMES = [
-    "10:00", "11:00", "12:00",
-    "13:00", "14:00", "15:00",
-    "16:00", "17:00", "18:00",
-]
+    async def _checkpoint(self, broadcast_id: int, user_ids: List[int], outcomes: Dict[int, str]) -> Optional[str]:
+        counts = {"sent": 0, "blocked": 0, "failed": 0}
+        for user_id in user_ids:
+            counts[outcomes[user_id]] += 1
+        blocked = [(u,) for u in user_ids if outcomes[u] == "blocked"]
+        async with self.db.write() as db:
+            if blocked:
+                await db.executemany(SQL_USERS_MARK_BLOCKED, blocked)
+            async with db.execute(
+                SQL_BROADCAST_CHECKPOINT,
+                (user_ids[-1], counts["sent"], counts["blocked"], counts["failed"], broadcast_id),
+            ) as cur:
+                row = await cur.fetchone()
+        self.sent += counts["sent"]
+        self.blocked += counts["blocked"]
+        self.failed += counts["failed"]
+        return row[0] if row else None
+
+    async def _finish(self, b: Broadcast) -> None:
+        async with self.db.write() as db:
+            async with db.execute(SQL_BROADCAST_FINISH, (time.time(), b.id)) as cur:
+                row = await cur.fetchone()
+            if row is None:
+                return
+            sent, blocked, failed = row
+            count = await self.outbox.enqueue_in(db, [OutboxMessage(
+                MASTER_CHAT_ID,
+                f"📣 Рассылка #{b.id} завершена: доставлено {sent}, заблокировали бота {blocked}, ошибок {failed}.",
+            )])
+        self.outbox.kick(count)
+        logging.info("Broadcast #%s done: sent=%s blocked=%s failed=%s", b.id, sent, blocked, failed)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": int(self.current is not None),
+            "sent": self.sent,
+            "blocked": self.blocked,
+            "failed": self.failed,
+        }
+
+broadcaster = BroadcastRunner(database, outbox)
+
+@timed_db_helper
+async def create_broadcast(text: Optional[str], from_chat_id: Optional[int], message_id: Optional[int]) -> Optional[int]:
+    """id новой рассылки; None — предыдущая ещё идёт (одновременно идёт только одна)."""
+    async with database.write() as db:
+        async with db.execute(SQL_BROADCAST_RUNNING) as cur:
+            if await cur.fetchone() is not None:
+                return None
+        async with db.execute(SQL_USERS_ACTIVE_COUNT) as cur:
+            total = int((await cur.fetchone())[0])
+        async with db.execute(SQL_BROADCAST_INSERT, (text, from_chat_id, message_id, total, time.time())) as cur:
+            broadcast_id = int((await cur.fetchone())[0])
+    broadcaster.kick()
+    return broadcast_id
+
+@timed_db_helper
+async def cancel_broadcast() -> Optional[int]:
+    # раннер увидит отмену, сохраняя прогресс после текущей пачки
+    async with database.write() as db:
+        async with db.execute(SQL_BROADCAST_CANCEL, (time.time(),)) as cur:
+            row = await cur.fetchone()
+    return int(row[0]) if row else None
+
+@timed_db_helper
+async def last_broadcast() -> Optional[Broadcast]:
+    row = await database.fetchone(SQL_BROADCAST_LAST)
+    return Broadcast(*row) if row else None
 
 # ================= ОБЩЕЕ: ПОКАЗ МЕНЮ =================
 
@@ -326,109 +3770,208 @@ async def show_home(message_or_call: Any):
         await message_or_call.answer(text, reply_markup=main_menu_kb(), parse_mode="Markdown")
     else:
         await message_or_call.message.edit_text(text, reply_markup=main_menu_kb(), parse_mode="Markdown")
-        await message_or_call.answer()
 
 # ================= START =================
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
+    slot_holds.release(message.from_user.id)
     await show_home(message)
 
 # ================= МЕНЮ CALLBACKS =================
 
-@dp.callback_query(lambda c: c.data == "menu:home")
+@callbacks.route(HOME_CB, flags={"early_answer": True})
 async def cb_home(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
+    slot_holds.release(call.from_user.id)
     await show_home(call)
 
-@dp.callback_query(lambda c: c.data == "menu:book")
+@callbacks.stale
+async def cb_stale(call: types.CallbackQuery, state: FSMContext):
+    # кнопка из старого сообщения (другой формат данных) или мусор от клиента — возвращаем в меню
+    await call.answer("Эта кнопка устарела — вот актуальное меню.")
+    await state.clear()
+    slot_holds.release(call.from_user.id)
+    await show_home(call)
+
+# навигация без алертов: колбэк подтверждается сразу, до работы хендлера (EarlyCallbackAnswer)
+@callbacks.route(BOOK_CB, flags={"early_answer": True})
 async def cb_menu_book(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await call.message.edit_text("Выбери месяц:", reply_markup=months_kb())
-    await state.set_state(BookingStates.choosing_date)
-    await call.answer()
+    if len(schedule.services) > 1:
+        await call.message.edit_text("Выбери услугу:", reply_markup=services_kb())
+        await state.set_state(BookingStates.choosing_service)
+    else:
+        await call.message.edit_text("Выбери месяц:", reply_markup=months_kb())
+        await state.set_state(BookingStates.choosing_date)
 
-@dp.callback_query(lambda c: c.data == "menu:my")
+@callbacks.route(MY_CB, flags={"early_answer": True})
 async def cb_menu_my(call: types.CallbackQuery):
     apps = await list_user_appointments(call.from_user.id, only_future=True)
     if not apps:
         await call.message.edit_text("У тебя нет будущих записей 🙂", reply_markup=main_menu_kb())
-        await call.answer()
         return
 
     lines = ["📋 *Твои записи:*"]
-    for _, date_iso, time_str, contact, username in apps:
+    for _, date_iso, time_str, contact, username, master_id in apps:
         uname = username or "-"
-        lines.append(f"• *{human_date(date_iso)}* в *{time_str}*\n  телефон: `{contact}`\n  username: `{uname}`")
+        lines.append(
+            f"• *{human_date(date_iso)}* в *{time_str}*\n"
+            f"{master_line(masters.get(master_id), label='мастер', indent='  ')}"
+            f"  телефон: `{contact}`\n  username: `{uname}`"
+        )
 
     await call.message.edit_text("\n".join(lines), reply_markup=main_menu_kb(), parse_mode="Markdown")
-    await call.answer()
 
-@dp.callback_query(lambda c: c.data == "menu:cancel")
+@callbacks.route(MY_CANCEL_CB, flags={"early_answer": True})
 async def cb_menu_cancel(call: types.CallbackQuery):
     apps = await list_user_appointments(call.from_user.id, only_future=True)
     if not apps:
         await call.message.edit_text("Нечего отменять — будущих записей нет 🙂", reply_markup=main_menu_kb())
-        await call.answer()
         return
 
     await call.message.edit_text("Выбери запись для отмены:", reply_markup=cancel_list_kb(apps))
-    await call.answer()
 
 # ================= ПРОЦЕСС ЗАПИСИ =================
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("m:"))
-async def cb_month(call: types.CallbackQuery, state: FSMContext):
-    _, yy, mm = call.data.split(":")
-    year = int(yy)
-    month = int(mm)
+def service_line(service: Service) -> str:
+    # при единственной услуге не загромождаем сообщения
+    return f"Услуга: {service.title}\n" if len(schedule.services) > 1 else ""
+
+def master_line(master: Master, label: str = "Мастер", indent: str = "") -> str:
+    return f"{indent}{label}: {master.name}\n" if len(masters.active()) > 1 else ""
+
+@callbacks.route(SERVICE_CB, flags={"early_answer": True})
+async def cb_service(call: types.CallbackQuery, state: FSMContext, cb: ServiceCb):
+    service = schedule.service(cb.code)
+    await state.update_data(service=service.code)
+    await call.message.edit_text(f"{service.title}. Выбери месяц:", reply_markup=months_kb())
+    await state.set_state(BookingStates.choosing_date)
+
+@callbacks.route(MONTH_CB, flags={"early_answer": True})
+async def cb_month(call: types.CallbackQuery, state: FSMContext, cb: MonthCb):
+    year, month = cb
 
-    await state.update_data(year=year, month=month)
+    data = await state.update_data(year=year, month=month)
+    service = schedule.service(data.get("service"))
+    # один запрос на весь месяц — дальше cb_day/cb_time отвечают из памяти
+    free_counts = await month_free_counts(year, month, service.duration)
     await call.message.edit_text(
-        f"Выбери день ({RU_MONTHS[month-1]} {year}):",
-        reply_markup=days_kb(year, month),
+        days_text(year, month, free_counts),
+        reply_markup=days_kb(year, month, free_counts),
     )
-    await call.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("d:"))
-async def cb_day(call: types.CallbackQuery, state: FSMContext):
-    _, yy, mm, dd = call.data.split(":")
-    date_iso = format_date_iso(int(yy), int(mm), int(dd))
+@callbacks.route(DAY_CB, flags={"early_answer": True})
+async def cb_day(call: types.CallbackQuery, state: FSMContext, cb: DayCb):
+    date_iso = cb.date_iso
 
-    free_times = await list_free_times(date_iso, DEFAULT_TIMES)
-    if not free_times:
-        await call.answer("На этот день свободных слотов нет 😔", show_alert=True)
+    service = schedule.service((await state.get_data()).get("service"))
+    # свободное время всех мастеров на дату — за один проход по индексу
+    free_by_master = await list_free_times_by_master(date_iso, service.duration, user_id=call.from_user.id)
+    if not free_by_master:
+        # вместо алерта и повторных тычков в календарь — предлагаем лист ожидания
+        entry = await get_waitlist_entry(call.from_user.id, date_iso)
+        await call.message.edit_text(waitlist_text(date_iso, entry), reply_markup=waitlist_kb(date_iso, entry is not None))
         return
 
     await state.update_data(date_iso=date_iso)
+    if len(masters.active()) > 1:
+        await call.message.edit_text(
+            f"Дата: {human_date(date_iso)}\nВыбери мастера:",
+            reply_markup=masters_kb(date_iso, free_by_master),
+        )
+        await state.set_state(BookingStates.choosing_master)
+        return
+
+    master_id, free_times = next(iter(free_by_master.items()))
+    await state.update_data(master_id=master_id)
     await call.message.edit_text(
         f"Дата: {human_date(date_iso)}\nВыбери время:",
         reply_markup=times_kb(date_iso, free_times),
     )
     await state.set_state(BookingStates.choosing_time)
+
+def waitlist_text(date_iso: str, entry: Optional[WaitEntry]) -> str:
+    if entry is None:
+        return (
+            f"На {human_date(date_iso)} всё занято 😔\n"
+            "Могу написать, как только освободится время. Когда тебе удобно?"
+        )
+    return (
+        f"Ты в листе ожидания на {human_date(date_iso)} ({waitlist_window_label(entry)}) 🔔\n"
+        "Напишу, как только освободится время."
+    )
+
+@callbacks.route(WAIT_CB)
+async def cb_waitlist(call: types.CallbackQuery, state: FSMContext, cb: WaitCb):
+    # номер окна — подписаться, None — отписаться; номер уже проверен кодеком
+    date_iso = cb.date_iso
+    if date_iso < datetime.date.today().isoformat():
+        await call.answer("Этот день уже прошёл.", show_alert=True)
+        return
+
+    if cb.window is None:
+        await leave_waitlist(call.from_user.id, date_iso)
+        entry = None
+        note = "Больше не жду 🔕"
+    else:
+        service = (await state.get_data()).get("service")
+        entry = await join_waitlist(call.from_user.id, date_iso, cb.window, service)
+        if entry is None:
+            await call.answer(f"Ждать можно не больше {WAITLIST_MAX_PER_USER} дней одновременно.", show_alert=True)
+            return
+        note = "Записал в лист ожидания ✅"
+
+    await call.message.edit_text(waitlist_text(date_iso, entry), reply_markup=waitlist_kb(date_iso, entry is not None))
+    await call.answer(note)
+
+@callbacks.route(MASTER_CB)
+async def cb_master(call: types.CallbackQuery, state: FSMContext, cb: MasterCb):
+    date_iso = cb.date_iso
+    master = masters.get(cb.master_id)
+    service = schedule.service((await state.get_data()).get("service"))
+
+    free_times = await list_free_times(master.id, date_iso, service.duration, user_id=call.from_user.id)
+    if not free_times:
+        await call.answer("У этого мастера на этот день свободных слотов нет 😔", show_alert=True)
+        return
+
     await call.answer()
+    await state.update_data(date_iso=date_iso, master_id=master.id)
+    await call.message.edit_text(
+        f"Дата: {human_date(date_iso)}\nМастер: {master.name}\nВыбери время:",
+        reply_markup=times_kb(date_iso, free_times),
+    )
+    await state.set_state(BookingStates.choosing_time)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("t:"))
-async def cb_time(call: types.CallbackQuery, state: FSMContext):
-    # FIX: время содержит ":", поэтому split ограничиваем до 3 частей
-    # "t:YYYY-MM-DD:HH:MM" -> ["t", "YYYY-MM-DD", "HH:MM"]
-    _, date_iso, time_str = call.data.split(":", 2)
+@callbacks.route(TIME_CB)
+async def cb_time(call: types.CallbackQuery, state: FSMContext, cb: TimeCb):
+    date_iso, time_str = cb
+    data = await state.get_data()
+    service = schedule.service(data.get("service"))
+    master = masters.get(data.get("master_id"))
+
+    if not await is_slot_free(master.id, date_iso, time_str, service.duration):
+        await call.answer("Этот слот уже занят, выбери другое время.", show_alert=True)
+        return
 
-    if not await is_slot_free(date_iso, time_str):
-        await call.answer("Этот слот уже занят, выбери другое время.", show_alert=True)
+    if not slot_holds.acquire(call.from_user.id, master.id, date_iso, time_str, service.duration):
+        await call.answer("Этот слот сейчас бронирует другой клиент, выбери другое время.", show_alert=True)
         return
 
+    # проверки пройдены — алертов больше не будет, гасим «часики» до записи в FSM и отправки
+    await call.answer()
     await state.update_data(time_str=time_str)
 
     await call.message.answer(
-        f"Отлично! {human_date(date_iso)} в {time_str}.\n\n"
+        f"Отлично! {human_date(date_iso)} в {time_str}.\n"
+        f"Слот закреплён за тобой на {SLOT_HOLD_TTL // 60} мин.\n\n"
         f"Теперь отправь *телефон* (кнопкой контакта) 👇",
         reply_markup=contact_kb(),
         parse_mode="Markdown",
     )
     await state.set_state(BookingStates.waiting_phone)
-    await call.answer()
 
 @dp.message(BookingStates.waiting_phone)
 async def on_phone(message: types.Message, state: FSMContext):
@@ -453,12 +3996,10 @@ async def on_phone(message: types.Message, state: FSMContext):
         await message.answer("Пожалуйста, отправь телефон (контактом или текстом).")
         return
 
-    await state.update_data(phone=phone)
-
     tg_username = message.from_user.username
     if tg_username:
         uname = "@" + tg_username
-        await state.update_data(username=uname)
+        await state.update_data(phone=phone, username=uname)
         await message.answer(
             f"Теперь нужен *юзернейм*.\n"
             f"Я вижу твой: `{uname}`\n\n"
@@ -467,15 +4008,19 @@ async def on_phone(message: types.Message, state: FSMContext):
             parse_mode="Markdown",
         )
     else:
+        # инлайн-кнопок здесь нет — заодно убираем клавиатуру с контактом,
+        # и подтверждение записи потом придёт одним сообщением вместе с меню
+        await state.update_data(phone=phone, contact_kb_removed=True)
         await message.answer(
             "Теперь отправь *юзернейм* (например `@nickname`).\n"
             "Если юзернейма нет — напиши имя/как к тебе обращаться.",
+            reply_markup=types.ReplyKeyboardRemove(),
             parse_mode="Markdown",
         )
 
     await state.set_state(BookingStates.waiting_username)
 
-@dp.callback_query(lambda c: c.data == "uname:keep")
+@callbacks.route(UNAME_KEEP_CB)
 async def cb_username_keep(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     username = data.get("username")
@@ -483,8 +4028,8 @@ async def cb_username_keep(call: types.CallbackQuery, state: FSMContext):
         await call.answer("Не вижу username — напиши его текстом.", show_alert=True)
         return
 
-    await finalize_booking(call.from_user, state, call.message, via_callback=True)
     await call.answer()
+    await finalize_booking(call.from_user, state, call.message, via_callback=True)
 
 @dp.message(BookingStates.waiting_username)
 async def on_username_text(message: types.Message, state: FSMContext):
@@ -504,79 +4049,100 @@ async def finalize_booking(user: types.User, state: FSMContext, msg_obj: Any, vi
     time_str = data.get("time_str")
     phone = data.get("phone")
     username = data.get("username") or "-"
+    service = schedule.service(data.get("service"))
+    master = masters.get(data.get("master_id"))
 
     if not date_iso or not time_str or not phone:
         await msg_obj.answer("Кажется, запись сбилась. Нажми /start и попробуй снова.")
         await state.clear()
         return
 
-    ok = await create_appointment(
-        user_id=user.id,
-        date_iso=date_iso,
-        time_str=time_str,
-        contact=phone,
-        username=username,
-    )
-
-    if not ok:
-        await msg_obj.answer("Упс — этот слот только что заняли 😔\nВернись в меню и выбери другое время.")
-        await state.clear()
-        return
-
-    await bot.send_message(
-        MASTER_CHAT_ID,
-        "📌 Новая запись!\n"
-        f"Дата: {human_date(date_iso)}\n"
-        f"Время: {time_str}\n"
-        f"Телефон: {phone}\n"
-        f"Username: {username}\n"
-        f"User ID: {user.id}",
-    )
-
-    await bot.send_message(
-        user.id,
+    confirmation = (
         "✅ Запись создана!\n"
+        f"{service_line(service)}"
+        f"{master_line(master)}"
         f"Дата: {human_date(date_iso)}\n"
         f"Время: {time_str}\n"
         f"Телефон: {phone}\n"
         f"Username: {username}\n\n"
-        "Можешь посмотреть/отменить запись в меню 👇",
-        reply_markup=types.ReplyKeyboardRemove(),
+        "Можешь посмотреть/отменить запись в меню 👇"
     )
+    if data.get("contact_kb_removed"):
+        to_user = [OutboxMessage(user.id, confirmation, reply_markup=main_menu_kb())]
+    else:
+        # у одного сообщения одна клавиатура: сначала убираем клавиатуру с контактом, потом меню
+        to_user = [
+            OutboxMessage(user.id, confirmation, reply_markup=types.ReplyKeyboardRemove()),
+            OutboxMessage(user.id, "Выбери действие:", reply_markup=main_menu_kb()),
+        ]
+    notices = [
+        OutboxMessage(
+            master.chat_id,
+            "📌 Новая запись!\n"
+            f"{service_line(service)}"
+            f"Дата: {human_date(date_iso)}\n"
+            f"Время: {time_str}\n"
+            f"Телефон: {phone}\n"
+            f"Username: {username}\n"
+            f"User ID: {user.id}",
+            digest=True,
+        ),
+        *to_user,
+    ]
 
-    await bot.send_message(user.id, "Выбери действие:", reply_markup=main_menu_kb())
-
-    await state.clear()
-
-# ================= ОТМЕНА ЗАПИСИ =================
+    # продлеваем свою бронь на время вставки: пока она у нас, слот никто другой не возьмёт.
+    # Если бронь истекла и слот уже держит другой — он первый.
+    if not slot_holds.acquire(user.id, master.id, date_iso, time_str, service.duration):
+        ok = False
+    else:
+        try:
+            # уведомления пишутся в outbox в транзакции самой записи: падение после commit их не теряет
+            ok = await create_appointment(
+                user_id=user.id,
+                date_iso=date_iso,
+                time_str=time_str,
+                contact=phone,
+                username=username,
+                service=service,
+                master_id=master.id,
+                notices=notices,
+            )
+        finally:
+            slot_holds.release(user.id)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("cancel:"))
-async def cb_cancel(call: types.CallbackQuery):
-    raw = call.data.split(":", 1)[1]
-    try:
-        app_id = int(raw)
-    except ValueError:
-        await call.answer("Ошибка.", show_alert=True)
+    if not ok:
+        await msg_obj.answer("Упс — этот слот только что заняли 😔\nВернись в меню и выбери другое время.")
+        await state.clear()
         return
 
-    deleted = await delete_appointment(call.from_user.id, app_id)
-    if deleted is None:
-        await call.answer("Не удалось отменить (возможно, записи уже нет).", show_alert=True)
-        return
+    if data.get("contact_kb_removed"):
+        api_calls.count_saved("merged_send")
+    await state.clear()
 
-    _, date_iso, time_str, phone, username = deleted
-    username = username or "-"
+# ================= ОТМЕНА ЗАПИСИ =================
 
-    await bot.send_message(
-        MASTER_CHAT_ID,
+def cancel_notices(user_id: int, appt: AppointmentRow) -> List[OutboxMessage]:
+    app_id, date_iso, time_str, phone, username, master_id = appt
+    return [OutboxMessage(
+        masters.chat_id(master_id),
         "❌ Отмена записи!\n"
         f"Дата: {human_date(date_iso)}\n"
         f"Время: {time_str}\n"
         f"Телефон: {phone}\n"
-        f"Username: {username}\n"
-        f"User ID: {call.from_user.id}\n"
+        f"Username: {username or '-'}\n"
+        f"User ID: {user_id}\n"
         f"ID записи: {app_id}",
-    )
+        digest=True,
+    )]
+
+@callbacks.route(CANCEL_CB)
+async def cb_cancel(call: types.CallbackQuery, cb: CancelCb):
+    # уведомление мастеру пишется в outbox той же транзакцией, что и удаление
+    notices = functools.partial(cancel_notices, call.from_user.id)
+    deleted = await delete_appointment(call.from_user.id, cb.app_id, notices)
+    if deleted is None:
+        await call.answer("Не удалось отменить (возможно, записи уже нет).", show_alert=True)
+        return
 
     apps = await list_user_appointments(call.from_user.id, only_future=True)
     if not apps:
@@ -588,24 +4154,29 @@ async def cb_cancel(call: types.CallbackQuery):
 
 # ================= НАЗАД =================
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("back:months"))
+@callbacks.route(BACK_MONTHS_CB, flags={"early_answer": True})
 async def cb_back_months(call: types.CallbackQuery, state: FSMContext):
+    # выбранную услугу сохраняем, остальное сбрасываем
+    service = (await state.get_data()).get("service")
     await state.clear()
+    if service:
+        await state.update_data(service=service)
+    slot_holds.release(call.from_user.id)
     await call.message.edit_text("Выбери месяц:", reply_markup=months_kb())
     await state.set_state(BookingStates.choosing_date)
-    await call.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("back:days:"))
-async def cb_back_days(call: types.CallbackQuery, state: FSMContext):
-    _, _, date_iso = call.data.split(":", 2)
-    d = datetime.date.fromisoformat(date_iso)
-    await state.update_data(year=d.year, month=d.month)
+@callbacks.route(BACK_DAYS_CB, flags={"early_answer": True})
+async def cb_back_days(call: types.CallbackQuery, state: FSMContext, cb: DayCb):
+    d = datetime.date.fromisoformat(cb.date_iso)
+    slot_holds.release(call.from_user.id)
+    data = await state.update_data(year=d.year, month=d.month)
+    service = schedule.service(data.get("service"))
+    free_counts = await month_free_counts(d.year, d.month, service.duration)
     await call.message.edit_text(
-        f"Выбери день ({RU_MONTHS[d.month-1]} {d.year}):",
-        reply_markup=days_kb(d.year, d.month),
+        days_text(d.year, d.month, free_counts),
+        reply_markup=days_kb(d.year, d.month, free_counts),
     )
     await state.set_state(BookingStates.choosing_date)
-    await call.answer()
 
 # ================= (Опционально) Команды как запасной вариант =================
 
@@ -617,8 +4188,9 @@ async def cmd_my(message: types.Message):
         return
 
     lines = ["📋 Твои записи:"]
-    for _, date_iso, time_str, phone, username in apps:
-        lines.append(f"• {human_date(date_iso)} {time_str} — {phone} — {username or '-'}")
+    for _, date_iso, time_str, phone, username, master_id in apps:
+        who = f" — {masters.get(master_id).name}" if len(masters.active()) > 1 else ""
+        lines.append(f"• {human_date(date_iso)} {time_str}{who} — {phone} — {username or '-'}")
     await message.answer("\n".join(lines), reply_markup=main_menu_kb())
 
 @dp.message(Command("cancel"))
@@ -629,11 +4201,1154 @@ async def cmd_cancel(message: types.Message):
         return
     await message.answer("Выбери запись для отмены:", reply_markup=cancel_list_kb(apps))
 
+# ================= МАСТЕРА (для MASTER_CHAT_ID) =================
+
+@dp.message(Command("masters"))
+async def cmd_masters(message: types.Message):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    lines = ["👩‍🎨 Мастера:"]
+    for m in masters.active():
+        lines.append(f"• #{m.id} {m.name} — чат {m.chat_id}")
+    lines.append("\nДобавить: /addmaster <chat_id> <имя>")
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("addmaster"))
+async def cmd_addmaster(message: types.Message, command: CommandObject):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    parts = (command.args or "").split(maxsplit=1)
+    if len(parts) != 2 or not parts[0].lstrip("-").isdigit():
+        await message.answer("Формат: /addmaster <chat_id> <имя>")
+        return
+    master = await masters.add(parts[1].strip(), int(parts[0]))
+    # в обзоре месяца теперь на одного мастера больше
+    availability.invalidate_overviews()
+    await message.answer(f"Мастер #{master.id} {master.name} добавлен ✅")
+
+# ================= ЭКСПОРТ =================
+
+# Сначала архив, потом рабочая таблица, каждая по своему индексу (date, time): в архив
+# уезжают только дни раньше всех оставшихся в appointments, так что порядок общий, а
+# сортировать объединение целиком (temp_store=MEMORY — в памяти) не приходится.
+SQL_EXPORT_RANGE = tuple(
+    "SELECT id, date, time, duration, service, master_id, contact, username, user_id "
+    f"FROM {table} WHERE date BETWEEN ? AND ? ORDER BY date, time"
+    for table in ("appointments_history", "appointments")
+)
+# строк за одно обращение к курсору: память не растёт вместе с историей
+EXPORT_BATCH = 500
+# пусто — подкаталог во временной папке системы
+EXPORT_DIR = os.getenv("EXPORT_DIR", "")
+EXPORT_FORMATS = ("csv", "ics")
+# период по умолчанию: /export без дат и ICS-лента
+EXPORT_DEFAULT_PAST_DAYS = 30
+EXPORT_DEFAULT_FUTURE_DAYS = 90
+
+class ExportRow(NamedTuple):
+    id: int
+    date: str
+    time: str
+    duration: int
+    service: Optional[str]
+    master_id: int
+    contact: str
+    username: Optional[str]
+    user_id: int
+
+async def iter_export_batches(date_from: str, date_to: str) -> AsyncIterator[List[ExportRow]]:
+    """
+    Строки выгрузки пачками по EXPORT_BATCH. Генератор держит соединение из пула читателей —
+    закрывать его нужно явно (aclosing), а не ждать сборщика мусора.
+    """
+    async with database.read() as conn:
+        for sql in SQL_EXPORT_RANGE:
+            async with conn.execute(sql, (date_from, date_to)) as cur:
+                while True:
+                    batch = await cur.fetchmany(EXPORT_BATCH)
+                    if not batch:
+                        break
+                    yield [ExportRow(*r) for r in batch]
+
+class CsvExport:
+    encoding = "utf-8-sig"
+
+    def __init__(self, f: TextIO):
+        import csv
+
+        self._w = csv.writer(f)
+        self._w.writerow(["id", "date", "time", "duration", "service", "master", "contact", "username", "user_id"])
+
+    def write(self, rows: List[ExportRow]) -> None:
+        self._w.writerows(
+            [
+                r.id, r.date, r.time, r.duration, schedule.service(r.service).title,
+                masters.get(r.master_id).name, r.contact, r.username or "", r.user_id,
+            ]
+            for r in rows
+        )
+
+    def finish(self) -> None:
+        pass
+
+def _ics_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_line(name: str, value: str) -> str:
+    # RFC 5545: строки длиннее 75 октетов переносятся, продолжение начинается с пробела
+    line = f"{name}:{value}"
+    parts: List[str] = []
+    chunk = ""
+    for ch in line:
+        if len((chunk + ch).encode()) > (75 if not parts else 74):
+            parts.append(chunk)
+            chunk = ""
+        chunk += ch
+    parts.append(chunk)
+    return "\r\n ".join(parts) + "\r\n"
+
+def _ics_time(date_iso: str, minutes: int) -> str:
+    d = datetime.date.fromisoformat(date_iso)
+    return f"{d.year:04d}{d.month:02d}{d.day:02d}T{minutes // 60:02d}{minutes % 60:02d}00"
+
+class IcsExport:
+    encoding = "utf-8"
+
+    def __init__(self, f: TextIO):
+        self._f = f
+        self._stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        f.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//booking-bot//RU\r\nCALSCALE:GREGORIAN\r\n")
+        f.write(_ics_line("X-WR-CALNAME", "Записи"))
+
+    def write(self, rows: List[ExportRow]) -> None:
+        f = self._f
+        for r in rows:
+            start = parse_hhmm(r.time)
+            # запись, уходящая за полночь, в календаре просто обрезается концом дня
+            end = min(start + r.duration, 24 * 60 - 1)
+            service = schedule.service(r.service)
+            f.write("BEGIN:VEVENT\r\n")
+            f.write(_ics_line("UID", f"appointment-{r.id}@booking-bot"))
+            f.write(_ics_line("DTSTAMP", self._stamp))
+            f.write(_ics_line("DTSTART", _ics_time(r.date, start)))
+            f.write(_ics_line("DTEND", _ics_time(r.date, end)))
+            f.write(_ics_line("SUMMARY", _ics_escape(f"{service.title} — {r.contact}")))
+            f.write(_ics_line("DESCRIPTION", _ics_escape(
+                f"Мастер: {masters.get(r.master_id).name}\n"
+                f"Телефон: {r.contact}\n"
+                f"Username: {r.username or '-'}\n"
+                f"User ID: {r.user_id}"
+            )))
+            f.write("END:VEVENT\r\n")
+
+    def finish(self) -> None:
+        self._f.write("END:VCALENDAR\r\n")
+
+EXPORT_WRITERS = {"csv": CsvExport, "ics": IcsExport}
+
+async def write_export(path: str, fmt: str, batches: AsyncIterator[List[ExportRow]]) -> None:
+    """
+    Пачки читаются из базы на цикле событий, а форматирование и запись на диск идут
+    в потоке — большая выгрузка не останавливает обработку апдейтов.
+    """
+    export = EXPORT_WRITERS[fmt]
+    f = await asyncio.to_thread(open, path, "w", newline="", encoding=export.encoding)
+    try:
+        writer = await asyncio.to_thread(export, f)
+        async for rows in batches:
+            await asyncio.to_thread(writer.write, rows)
+        await asyncio.to_thread(writer.finish)
+    finally:
+        await asyncio.to_thread(f.close)
+
+def _export_tempdir() -> str:
+    import tempfile
+
+    return os.path.join(tempfile.gettempdir(), "booking-bot-exports")
+
+class ExportCache:
+    """
+    Готовые файлы выгрузок. Ключ — формат, период и счётчик изменений appointments:
+    пока таблицу не меняли, повторная выгрузка того же периода отдаётся с диска без запроса.
+    """
+
+    def __init__(self, directory: str, maxsize: int = 16):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._files: "OrderedDict[Tuple[str, str, str, int], str]" = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def get(self, fmt: str, date_from: str, date_to: str) -> str:
+        row = await database.fetchone(SQL_TABLE_VERSION, ("appointments",))
+        key = (fmt, date_from, date_to, int(row[0]) if row else 0)
+        async with self._lock:
+            path = self._files.get(key)
+            if path is not None and os.path.exists(path):
+                self.hits += 1
+                self._files.move_to_end(key)
+                return path
+            self.misses += 1
+            if not self.directory:
+                self.directory = _export_tempdir()
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{fmt}_{date_from}_{date_to}_v{key[3]}.{fmt}")
+            tmp = path + ".part"
+            async with aclosing(iter_export_batches(date_from, date_to)) as batches:
+                await write_export(tmp, fmt, batches)
+            os.replace(tmp, path)
+            self._files[key] = path
+            while len(self._files) > self.maxsize:
+                _, old = self._files.popitem(last=False)
+                with suppress(OSError):
+                    os.remove(old)
+            return path
+
+export_cache = ExportCache(EXPORT_DIR)
+
+def parse_export_date(raw: str) -> Optional[str]:
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.datetime.strptime(raw, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def default_export_range() -> Tuple[str, str]:
+    today = datetime.date.today()
+    return (
+        (today - datetime.timedelta(days=EXPORT_DEFAULT_PAST_DAYS)).isoformat(),
+        (today + datetime.timedelta(days=EXPORT_DEFAULT_FUTURE_DAYS)).isoformat(),
+    )
+
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message, command: CommandObject):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    args = (command.args or "").split()
+    fmt = "csv"
+    if args and args[0].lower() in EXPORT_FORMATS:
+        fmt = args.pop(0).lower()
+    date_from, date_to = default_export_range()
+    if args:
+        dates = [parse_export_date(a) for a in args[:2]]
+        if len(args) > 2 or None in dates:
+            await message.answer(
+                "Формат: /export [csv|ics] [с] [по]\n"
+                "Даты: ГГГГ-ММ-ДД или ДД.ММ.ГГГГ. Без дат — последние "
+                f"{EXPORT_DEFAULT_PAST_DAYS} и ближайшие {EXPORT_DEFAULT_FUTURE_DAYS} дней."
+            )
+            return
+        date_from = dates[0]
+        date_to = dates[1] if len(dates) > 1 else date_from
+        if date_from > date_to:
+            date_from, date_to = date_to, date_from
+
+    path = await export_cache.get(fmt, date_from, date_to)
+    await message.answer_document(
+        types.FSInputFile(path, filename=f"appointments_{date_from}_{date_to}.{fmt}"),
+        caption=f"Записи с {human_date(date_from)} по {human_date(date_to)}",
+    )
+
+async def ics_feed_handler(request: "web.Request") -> "web.StreamResponse":
+    """
+    Подписка на календарь: /calendar/<ICS_FEED_TOKEN>.ics — тот же кэш, что и у /export.
+    """
+    from aiohttp import web
+
+    if not ICS_FEED_TOKEN or not secret_matches(request.match_info["token"], ICS_FEED_TOKEN):
+        raise web.HTTPNotFound()
+    path = await export_cache.get("ics", *default_export_range())
+    return web.FileResponse(path, headers={"Content-Type": "text/calendar; charset=utf-8"})
+
+# ================= СТАТИСТИКА (для MASTER_CHAT_ID) =================
+
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366
+STATS_TOP_DAYS = 5
+RU_WEEKDAYS_SHORT = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+class StatsBucket:
+    __slots__ = ("booked", "cancelled", "minutes", "capacity")
+
+    def __init__(self) -> None:
+        self.booked = 0
+        self.cancelled = 0
+        self.minutes = 0
+        self.capacity = 0
+
+    def add(self, booked: int, cancelled: int, minutes: int) -> None:
+        self.booked += booked
+        self.cancelled += cancelled
+        self.minutes += minutes
+
+    @property
+    def load(self) -> str:
+        return _percent(self.minutes, self.capacity)
+
+    @property
+    def cancel_rate(self) -> str:
+        return _percent(self.cancelled, self.booked)
+
+def _percent(part: int, whole: int) -> str:
+    return f"{part * 100 / whole:.0f}%" if whole else "—"
+
+@timed_db_helper
+async def load_stats(date_from: str, date_to: str) -> List[Tuple[str, int, int, int, int]]:
+    """
+    Строки appointment_stats за период: (date, hour, booked, cancelled, minutes).
+    Их не больше «дней × рабочих часов», сколько бы записей ни накопилось.
+    """
+    rows = await database.fetchall(SQL_STATS_RANGE, (date_from, date_to))
+    return [(str(d), int(h), int(b), int(c), int(m)) for d, h, b, c, m in rows]
+
+def render_stats(rows: List[Tuple[str, int, int, int, int]], date_from: str, date_to: str) -> str:
+    total = StatsBucket()
+    by_day: Dict[str, StatsBucket] = {}
+    by_weekday = [StatsBucket() for _ in range(7)]
+    by_hour: Dict[int, StatsBucket] = {}
+
+    # ёмкость — рабочие минуты всех активных мастеров по их текущему расписанию
+    day = datetime.date.fromisoformat(date_from)
+    last = datetime.date.fromisoformat(date_to)
+    while day <= last:
+        date_iso = day.isoformat()
+        capacity = sum(m.schedule.work_minutes(date_iso) for m in masters.active())
+        by_day[date_iso] = StatsBucket()
+        by_day[date_iso].capacity = capacity
+        by_weekday[day.weekday()].capacity += capacity
+        total.capacity += capacity
+        day += datetime.timedelta(days=1)
+
+    for date_iso, hour, booked, cancelled, minutes in rows:
+        for bucket in (
+            total,
+            by_day[date_iso],
+            by_weekday[datetime.date.fromisoformat(date_iso).weekday()],
+            by_hour.setdefault(hour, StatsBucket()),
+        ):
+            bucket.add(booked, cancelled, minutes)
+
+    lines = [
+        f"📊 Статистика с {human_date(date_from)} по {human_date(date_to)}",
+        "",
+        f"Записей: {total.booked}, отмен: {total.cancelled} ({total.cancel_rate})",
+        f"Загрузка: {total.load} ({total.minutes // 60} из {total.capacity // 60} ч)",
+    ]
+    if not total.booked:
+        return "\n".join(lines)
+
+    lines += ["", "По дням недели (записи · загрузка · отмены):"]
+    for wd, b in enumerate(by_weekday):
+        if b.booked or b.capacity:
+            lines.append(f"{RU_WEEKDAYS_SHORT[wd]} — {b.booked} · {b.load} · {b.cancel_rate}")
+
+    lines += ["", "По часам (записи · отмены):"]
+    for hour in sorted(by_hour):
+        b = by_hour[hour]
+        lines.append(f"{hour:02d}:00 — {b.booked} · {b.cancel_rate}")
+
+    busiest = sorted(
+        (item for item in by_day.items() if item[1].capacity),
+        key=lambda item: item[1].minutes / item[1].capacity,
+        reverse=True,
+    )[:STATS_TOP_DAYS]
+    if busiest and busiest[0][1].minutes:
+        lines += ["", "Самые загруженные дни:"]
+        for date_iso, b in busiest:
+            if not b.minutes:
+                break
+            wd = RU_WEEKDAYS_SHORT[datetime.date.fromisoformat(date_iso).weekday()]
+            lines.append(f"{human_date(date_iso)} ({wd}) — {b.load}")
+    return "\n".join(lines)
+
+def parse_stats_range(args: List[str]) -> Optional[Tuple[str, str]]:
+    """[] — последние STATS_DEFAULT_DAYS дней; [N] — последние N дней; [с] [по] — даты."""
+    today = datetime.date.today()
+    if not args:
+        days = STATS_DEFAULT_DAYS
+    elif len(args) == 1 and args[0].isdigit():
+        days = int(args[0])
+    else:
+        dates = [parse_export_date(a) for a in args[:2]]
+        if len(args) > 2 or None in dates:
+            return None
+        date_from, date_to = sorted((dates[0], dates[-1]))
+        limit = (datetime.date.fromisoformat(date_to) - datetime.timedelta(days=STATS_MAX_DAYS - 1)).isoformat()
+        return max(date_from, limit), date_to
+    days = min(max(days, 1), STATS_MAX_DAYS)
+    return (today - datetime.timedelta(days=days - 1)).isoformat(), today.isoformat()
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message, command: CommandObject):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    period = parse_stats_range((command.args or "").split())
+    if period is None:
+        await message.answer(
+            "Формат: /stats [дней] или /stats [с] [по]\n"
+            f"Даты: ГГГГ-ММ-ДД или ДД.ММ.ГГГГ. Без аргументов — последние {STATS_DEFAULT_DAYS} дней."
+        )
+        return
+    rows = await load_stats(*period)
+    await message.answer(render_stats(rows, *period))
+
+@dp.message(Command("stats_rebuild"))
+async def cmd_stats_rebuild(message: types.Message):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    count = await rebuild_stats()
+    await message.answer(f"Статистика пересчитана по всем записям ✅ (строк: {count})")
+
+# ================= РАССЫЛКА (для MASTER_CHAT_ID) =================
+
+BROADCAST_STATUS_LABELS = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}
+
+def broadcast_status_text(b: Broadcast) -> str:
+    processed = b.sent + b.blocked + b.failed
+    started = datetime.datetime.fromtimestamp(b.created_at).strftime("%d.%m %H:%M")
+    return (
+        f"📣 Рассылка #{b.id} от {started} — {BROADCAST_STATUS_LABELS.get(b.status, b.status)}\n"
+        f"Обработано: {processed} из {b.total} ({_percent(processed, b.total)})\n"
+        f"Доставлено: {b.sent}, заблокировали бота: {b.blocked}, ошибок: {b.failed}"
+    )
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message, command: CommandObject):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    text = (command.args or "").strip()
+    source = message.reply_to_message
+    if source is None and not text:
+        await message.answer(
+            "Формат: /broadcast текст — или ответь командой /broadcast на сообщение, "
+            "чтобы разослать его как есть (с фото и форматированием).\n"
+            "Ход рассылки: /broadcast_status, остановить: /broadcast_stop"
+        )
+        return
+    if source is not None:
+        broadcast_id = await create_broadcast(None, source.chat.id, source.message_id)
+    else:
+        broadcast_id = await create_broadcast(text, None, None)
+    if broadcast_id is None:
+        await message.answer("Предыдущая рассылка ещё идёт. Ход: /broadcast_status, остановить: /broadcast_stop")
+        return
+    await message.answer(
+        f"📣 Рассылка #{broadcast_id} запущена. Когда закончится — пришлю итог.\n"
+        "Ход: /broadcast_status, остановить: /broadcast_stop"
+    )
+
+@dp.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: types.Message):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    b = await last_broadcast()
+    await message.answer(broadcast_status_text(b) if b else "Рассылок ещё не было.")
+
+@dp.message(Command("broadcast_stop"))
+async def cmd_broadcast_stop(message: types.Message):
+    if message.chat.id != MASTER_CHAT_ID:
+        return
+    broadcast_id = await cancel_broadcast()
+    if broadcast_id is None:
+        await message.answer("Сейчас рассылки нет.")
+        return
+    await message.answer(f"Рассылка #{broadcast_id} остановлена — уже начатая пачка ещё дойдёт до адресатов.")
+
+# ================= /metrics =================
+
+metrics.collected("bot_outbox", "gauge", "Очередь уведомлений: глубина и итоги отправки",
+                  lambda: {(("stat", k),): float(v) for k, v in outbox.stats().items()})
+metrics.collected("bot_keyboard_cache", "gauge", "Кэши клавиатур: попадания, промахи, размер",
+                  lambda: {(("cache", name), ("stat", k)): float(v)
+                           for name, st in keyboard_cache_stats().items() for k, v in st.items()})
+metrics.collected("bot_user_appointments_cache", "gauge", "Кэш будущих записей пользователей",
+                  lambda: {(("stat", k),): float(v) for k, v in user_appointments_cache.stats().items()})
+metrics.collected("bot_slot_holds", "gauge", "Слоты, закреплённые за клиентами",
+                  lambda: {(): float(len(slot_holds._holds))})
+metrics.collected("bot_reminders_pending", "gauge", "Записи с ещё не отправленными напоминаниями",
+                  lambda: {(): float(len(reminders._pending))})
+metrics.collected("bot_waitlist", "gauge", "Лист ожидания: подписки, даты, отправленные приглашения",
+                  lambda: {(("stat", k),): float(v) for k, v in waitlist.stats().items()})
+metrics.collected("bot_users_registry", "gauge", "Реестр пользователей: ждут записи, помним, записано",
+                  lambda: {(("stat", k),): float(v) for k, v in user_registry.stats().items()})
+metrics.collected("bot_audit_log", "gauge", "Журнал записей и отмен: ждут записи, записано",
+                  lambda: {(("stat", k),): float(v) for k, v in audit_log.stats().items()})
+metrics.collected("bot_log_records", "gauge", "Логи: в очереди, отсеяно выборкой, потеряно при переполнении",
+                  lambda: {(("stat", k),): float(v) for k, v in log_pipeline.stats().items()})
+metrics.collected("bot_broadcast", "gauge", "Рассылки: идёт ли сейчас и итоги отправки",
+                  lambda: {(("stat", k),): float(v) for k, v in broadcaster.stats().items()})
+
+async def metrics_handler(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+async def start_metrics_server(port: int = METRICS_PORT) -> "Optional[web.AppRunner]":
+    if not port:
+        return None
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    if ICS_FEED_TOKEN:
+        app.router.add_get("/calendar/{token}.ics", ics_feed_handler)
+    runner = web.AppRunner(app, access_log=None, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, host=METRICS_HOST, port=port).start()
+    logging.info("Metrics on http://%s:%s/metrics", METRICS_HOST, port)
+    return runner
+
+# ================= WEBHOOK =================
+
+def secret_matches(given: str, expected: str) -> bool:
+    """
+    Сравнение секрета за постоянное время. compare_digest принимает str только из ASCII,
+    на остальном бросает TypeError — поэтому сравниваются байты.
+    """
+    import hmac
+
+    return hmac.compare_digest(given.encode("utf-8", "surrogateescape"), expected.encode())
+
+@functools.lru_cache(maxsize=None)
+def bounded_request_handler_class() -> type:
+    """Класс собирается при первом вызове: модуль вебхука aiogram тянет за собой aiohttp.web."""
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+    from aiohttp import web
+
+    class BoundedRequestHandler(SimpleRequestHandler):
+        """
+        Обработчик вебхука: отвечает Telegram сразу, а апдейты обрабатывает в фоне,
+        но не больше max_concurrency одновременно. Когда все слоты заняты,
+        новый запрос ждёт — это естественное обратное давление на Telegram.
+        """
+
+        def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int, **kwargs: Any):
+            super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+            self._slots = asyncio.Semaphore(max(1, max_concurrency))
+            self.accepting = True
+
+        async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+            update = await request.json(loads=bot.session.json_loads)
+            await self._slots.acquire()
+            task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+            self._background_feed_update_tasks.add(task)
+            task.add_done_callback(self._background_feed_update_tasks.discard)
+            task.add_done_callback(lambda _: self._slots.release())
+            return web.json_response({}, dumps=bot.session.json_dumps)
+
+        def verify_secret(self, telegram_secret_token: str, bot: Bot) -> bool:
+            return not self.secret_token or secret_matches(telegram_secret_token, self.secret_token)
+
+        async def handle(self, request: web.Request) -> web.Response:
+            if not self.accepting:
+                # Telegram повторит доставку позже — уже другому (новому) процессу
+                return web.Response(status=503)
+            return await super().handle(request)
+
+        async def drain(self, timeout: float) -> None:
+            self.accepting = False
+            tasks = set(self._background_feed_update_tasks)
+            if not tasks:
+                return
+            logging.info("Draining %d in-flight updates", len(tasks))
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                logging.warning("Drain timeout, cancelling %d updates", len(pending))
+                for task in pending:
+                    task.cancel()
+
+    return BoundedRequestHandler
+
+def make_webhook_app(bot: Bot) -> Tuple["web.Application", Any]:
+    """Приложение вебхука с BoundedRequestHandler на WEBHOOK_PATH (и ICS-лентой, если включена)."""
+    from aiogram.webhook.aiohttp_server import setup_application
+    from aiohttp import web
+
+    app = web.Application()
+    handler = bounded_request_handler_class()(
+        dp,
+        bot,
+        max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+        secret_token=WEBHOOK_SECRET or None,
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    if ICS_FEED_TOKEN:
+        app.router.add_get("/calendar/{token}.ics", ics_feed_handler)
+    return app, handler
+
+async def run_webhook(bot: Bot) -> None:
+    from aiohttp import web
+
+    app, handler = make_webhook_app(bot)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    await site.start()
+    logging.info("Webhook server listening on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        # сначала дожидаемся начатых апдейтов, потом гасим сервер (там же закрывается сессия и FSM)
+        await handler.drain(WEBHOOK_DRAIN_TIMEOUT)
+        await runner.cleanup()
+
+# ================= КЛАСТЕР (BOT_WORKERS > 1) =================
+
+# как часто фронт проверяет воркеров и через сколько без ответа считает воркер зависшим
+CLUSTER_HEALTH_INTERVAL = 5.0
+CLUSTER_HEALTH_TIMEOUT = 30.0
+# упавший воркер перезапускаем не чаще, чем раз в столько секунд (растёт при повторных падениях)
+CLUSTER_RESPAWN_BACKOFF_MAX = 60.0
+
+UPDATE_USER_KEYS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request",
+)
+
+def update_user_id(raw: Dict[str, Any]) -> int:
+    for key in UPDATE_USER_KEYS:
+        obj = raw.get(key)
+        if obj:
+            user = obj.get("from") or obj.get("chat") or {}
+            return int(user.get("id", 0))
+    return 0
+
+class ClusterLink:
+    """
+    Связь процесса с остальным кластером.
+    В обычном режиме это пустышка: publish() ничего не делает и возвращает False.
+    В воркере события уходят фронту, а тот раздаёт их остальным воркерам — так кэши
+    (занятость слотов, брони, мастера) не расходятся между процессами. Очередь
+    уведомлений, напоминания и рассылки в кластере обслуживает только фронт.
+    """
+
+    def __init__(self):
+        self.index: Optional[int] = None
+        self._events: Any = None
+        self._muted = False
+
+    @property
+    def is_worker(self) -> bool:
+        return self._events is not None
+
+    def attach(self, index: int, events: Any) -> None:
+        self.index = index
+        self._events = events
+
+    def publish(self, kind: str, *args: Any) -> bool:
+        """True, если процесс — воркер кластера (событие отправлено фронту)."""
+        if self._events is None:
+            return False
+        # события, пришедшие от других воркеров, обратно не рассылаем
+        if not self._muted:
+            self._events.put((self.index, kind) + args)
+        return True
+
+    def apply(self, event: Tuple[Any, ...]) -> None:
+        kind, *args = event
+        self._muted = True
+        try:
+            if kind == "busy":
+                availability.mark_busy(*args)
+            elif kind == "free":
+                availability.mark_free(*args)
+            elif kind == "hold":
+                slot_holds.assign(*args)
+            elif kind == "unhold":
+                slot_holds.revoke(*args)
+            elif kind == "release":
+                slot_holds.release(*args)
+            elif kind == "masters":
+                asyncio.create_task(reload_masters())
+        finally:
+            self._muted = False
+
+cluster = ClusterLink()
+
+async def reload_masters() -> None:
+    await masters.load()
+    availability.invalidate_overviews()
+
+class ClusterWorker:
+    """
+    Процесс-воркер: получает сырые апдейты от фронта через очередь и прогоняет их через dp.
+    Схему базы не трогает — её готовит фронт до запуска воркеров.
+    """
+
+    def __init__(self, index: int, updates: Any, events: Any):
+        self.index = index
+        self.updates = updates
+        self.events = events
+        self.bot: Optional[Bot] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # последняя задача каждого пользователя: его апдейты идут строго по очереди
+        self._tails: Dict[int, asyncio.Task] = {}
+
+    def _reader(self, loop: asyncio.AbstractEventLoop, inbox: asyncio.Queue) -> None:
+        # блокирующий get() держим в отдельном потоке, в цикл событий перекладываем по одному
+        parent = os.getppid()
+        while True:
+            try:
+                item = self.updates.get(timeout=1.0)
+            except queue.Empty:
+                if os.getppid() == parent:
+                    continue
+                item = ("stop",)  # фронт умер — выходим
+            loop.call_soon_threadsafe(inbox.put_nowait, item)
+            if item[0] == "stop":
+                return
+
+    def _submit(self, raw: Dict[str, Any]) -> None:
+        user_id = update_user_id(raw)
+        task = asyncio.create_task(self._feed(raw, self._tails.get(user_id)))
+        self._tails[user_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._done(user_id, t))
+
+    def _done(self, user_id: int, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    async def _feed(self, raw: Dict[str, Any], prev: Optional[asyncio.Task]) -> None:
+        if prev is not None:
+            await asyncio.wait((prev,))
+        try:
+            await dp.feed_raw_update(self.bot, raw)
+        except Exception:
+            logging.exception("Worker %s: update %s failed", self.index, raw.get("update_id"))
+
+    async def run(self) -> None:
+        cluster.attach(self.index, self.events)
+        await database.open()
+        metrics_runner: Optional[web.AppRunner] = None
+        warmer: Optional[asyncio.Task] = None
+        try:
+            _, self.bot = await asyncio.gather(masters.load(), open_bot())
+            metrics_runner = await start_metrics_server(METRICS_PORT + 1 + self.index if METRICS_PORT else 0)
+            loop = asyncio.get_running_loop()
+            inbox: asyncio.Queue = asyncio.Queue()
+            threading.Thread(target=self._reader, args=(loop, inbox), daemon=True).start()
+            warmer = asyncio.create_task(warm_up())
+            logging.info("Worker %s started (pid %s)", self.index, os.getpid())
+
+            while True:
+                item = await inbox.get()
+                kind = item[0]
+                if kind == "update":
+                    self._submit(item[1])
+                elif kind == "event":
+                    cluster.apply(item[1])
+                elif kind == "ping":
+                    self.events.put((self.index, "pong", item[1]))
+                elif kind == "stop":
+                    break
+
+            # дорабатываем начатые апдейты; новые остаются в очереди для следующего воркера
+            if self._tasks:
+                await asyncio.wait(self._tasks, timeout=WEBHOOK_DRAIN_TIMEOUT)
+        finally:
+            if warmer is not None:
+                warmer.cancel()
+            await dp.storage.close()
+            await user_registry.close()
+            await audit_log.close()
+            if self.bot is not None:
+                await self.bot.session.close()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await database.close()
+            logging.info("Worker %s stopped", self.index)
+
+def worker_main(index: int, updates: Any, events: Any) -> None:
+    # Ctrl+C в терминале прилетает всей группе процессов — останавливает воркеров только фронт
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_pipeline.start()
+    asyncio.run(ClusterWorker(index, updates, events).run())
+
+class _WorkerSlot:
+    __slots__ = ("index", "queue", "process", "last_pong", "started", "failures", "respawn_at", "restarting")
+
+    def __init__(self, index: int, q: Any):
+        self.index = index
+        self.queue = q
+        self.process: Any = None
+        self.last_pong = 0.0
+        self.started = 0.0
+        self.failures = 0
+        self.respawn_at = 0.0
+        # слот сейчас перезапускается вручную — супервизор его не трогает
+        self.restarting = False
+
+class ClusterFront:
+    """
+    Фронт многопроцессного режима. Принимает апдейты (polling или webhook), не разбирая
+    их pydantic-моделями, и по from_user.id отправляет каждому пользователю всегда
+    в один и тот же воркер — его FSM и кэши живут в одном процессе.
+    Заодно супервизор: пингует воркеров, перезапускает упавших и зависших;
+    SIGHUP — поочерёдный мягкий перезапуск всех воркеров, SIGTERM/SIGINT — остановка.
+    """
+
+    def __init__(self, size: int):
+        # multiprocessing нужен только фронту кластера — в обычном режиме его не импортируем
+        import multiprocessing
+
+        self.ctx = multiprocessing.get_context("spawn")
+        self.events = self.ctx.Queue()
+        self.slots = [_WorkerSlot(i, self.ctx.Queue()) for i in range(size)]
+        self.routed = 0
+        self._stopping = False
+        self._ping = 0
+
+    # ---- воркеры ----
+
+    def _spawn(self, slot: _WorkerSlot) -> None:
+        slot.process = self.ctx.Process(
+            target=worker_main,
+            args=(slot.index, slot.queue, self.events),
+            name=f"bot-worker-{slot.index}",
+        )
+        slot.process.start()
+        slot.started = slot.last_pong = time.monotonic()
+
+    def _replace_queue(self, slot: _WorkerSlot) -> None:
+        """
+        Убитый процесс мог оставить очередь с захваченной блокировкой — даём слоту новую
+        и переносим в неё всё, что из старой ещё удаётся достать.
+        """
+        old, slot.queue = slot.queue, self.ctx.Queue()
+        moved = 0
+        while True:
+            try:
+                item = old.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                break
+            if item[0] in ("update", "event"):
+                slot.queue.put(item)
+                moved += 1
+        logging.warning("Worker %s: moved %d pending items to a new queue", slot.index, moved)
+
+    async def _stop_worker(self, slot: _WorkerSlot, graceful: bool) -> bool:
+        """True, если воркер вышел сам и его очередь можно отдать следующему."""
+        proc = slot.process
+        if proc is None:
+            return True
+        loop = asyncio.get_running_loop()
+        if graceful and proc.is_alive():
+            slot.queue.put(("stop",))
+            await loop.run_in_executor(None, proc.join, WEBHOOK_DRAIN_TIMEOUT + 5)
+        if proc.is_alive():
+            proc.terminate()
+            await loop.run_in_executor(None, proc.join, 5)
+            if proc.is_alive():
+                proc.kill()
+                await loop.run_in_executor(None, proc.join, 5)
+            return False
+        return graceful and proc.exitcode == 0
+
+    async def _restart(self, slot: _WorkerSlot, graceful: bool) -> None:
+        slot.restarting = True
+        try:
+            if not await self._stop_worker(slot, graceful):
+                self._replace_queue(slot)
+            if not self._stopping:
+                self._spawn(slot)
+        finally:
+            slot.restarting = False
+
+    async def rolling_restart(self) -> None:
+        for slot in self.slots:
+            logging.info("Restarting worker %s", slot.index)
+            await self._restart(slot, graceful=True)
+
+    async def supervise(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(CLUSTER_HEALTH_INTERVAL)
+            now = time.monotonic()
+            self._ping += 1
+            for slot in self.slots:
+                if slot.restarting:
+                    continue
+                proc = slot.process
+                if proc is not None and not proc.is_alive():
+                    # быстрые повторные падения — увеличиваем паузу перед перезапуском
+                    slot.failures = slot.failures + 1 if now - slot.started < 60 else 1
+                    delay = min(CLUSTER_RESPAWN_BACKOFF_MAX, 2.0 ** (slot.failures - 1))
+                    logging.error("Worker %s died (exit %s), respawn in %.0fs", slot.index, proc.exitcode, delay)
+                    slot.process = None
+                    slot.respawn_at = now + delay
+                    self._replace_queue(slot)
+                    continue
+                if proc is None:
+                    if now >= slot.respawn_at:
+                        self._spawn(slot)
+                    continue
+                if now - slot.last_pong > CLUSTER_HEALTH_TIMEOUT:
+                    logging.error("Worker %s is not responding, restarting", slot.index)
+                    await self._restart(slot, graceful=False)
+                    continue
+                slot.queue.put(("ping", self._ping))
+
+    # ---- события от воркеров ----
+
+    def _events_reader(self, loop: asyncio.AbstractEventLoop) -> None:
+        while not self._stopping:
+            try:
+                event = self.events.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            except (OSError, ValueError, EOFError):
+                return
+            loop.call_soon_threadsafe(self._on_event, event)
+
+    def _on_event(self, event: Tuple[Any, ...]) -> None:
+        origin, kind, *args = event
+        if kind == "pong":
+            self.slots[origin].last_pong = time.monotonic()
+        elif kind == "outbox":
+            outbox.kick(args[0])
+        elif kind == "remind":
+            reminders.schedule(Reminder(*args))
+        elif kind == "unremind":
+            reminders.cancel(args[0])
+        elif kind == "wait":
+            waitlist.add(WaitEntry(*args))
+        elif kind == "unwait":
+            waitlist.discard(*args)
+        elif kind == "freed":
+            waitlist.freed(*args)
+        elif kind == "broadcast":
+            broadcaster.kick()
+        elif kind == "hold":
+            # брони разводит фронт: из двух пересекающихся побеждает та, что дошла первой.
+            # Проигравшую остальным не раздаём, а воркер-источник её снимает
+            if slot_holds.acquire(*args):
+                self._forward(origin, kind, args)
+            else:
+                metrics.inc("bot_cluster_hold_conflicts_total")
+                logging.warning("Cluster: hold %s rejected, slot is held by another user", args)
+                self._send_event(self.slots[origin], ("unhold", *args[:4]))
+        else:
+            # фронт держит те же кэши, что и воркеры: по ним лист ожидания проверяет свободное время
+            cluster.apply((kind, *args))
+            self._forward(origin, kind, args)
+
+    def _forward(self, origin: int, kind: str, args: List[Any]) -> None:
+        for slot in self.slots:
+            if slot.index != origin:
+                self._send_event(slot, (kind, *args))
+
+    @staticmethod
+    def _send_event(slot: _WorkerSlot, event: Tuple[Any, ...]) -> None:
+        if slot.process is not None:
+            slot.queue.put(("event", event))
+
+    # ---- приём апдейтов ----
+
+    def route(self, raw: Dict[str, Any]) -> None:
+        slot = self.slots[update_user_id(raw) % len(self.slots)]
+        slot.queue.put(("update", raw))
+        self.routed += 1
+
+    async def _webhook(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+
+        if WEBHOOK_SECRET and not secret_matches(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+        ):
+            return web.Response(status=401)
+        self.route(await request.json())
+        return web.Response()
+
+    async def _poll(self) -> None:
+        base = TELEGRAM_API_URL.rstrip("/") if TELEGRAM_API_URL else "https://api.telegram.org"
+        url = f"{base}/bot{API_TOKEN}/getUpdates"
+        allowed = dp.resolve_used_update_types()
+        offset = 0
+        backoff = 1.0
+        async with ClientSession(timeout=ClientTimeout(total=60)) as session:
+            while not self._stopping:
+                try:
+                    async with session.post(
+                        url, json={"offset": offset, "timeout": 25, "allowed_updates": allowed}
+                    ) as resp:
+                        body = await resp.json()
+                    if not body.get("ok"):
+                        retry = (body.get("parameters") or {}).get("retry_after")
+                        logging.warning("getUpdates failed: %s", body.get("description"))
+                        await asyncio.sleep(retry or backoff)
+                        backoff = min(backoff * 2, 30.0)
+                        continue
+                    backoff = 1.0
+                    for raw in body["result"]:
+                        offset = raw["update_id"] + 1
+                        self.route(raw)
+                except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.warning("getUpdates error: %s", e)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+
+    async def run(self, bot: Bot) -> None:
+        loop = asyncio.get_running_loop()
+        for slot in self.slots:
+            self._spawn(slot)
+        threading.Thread(target=self._events_reader, args=(loop,), daemon=True).start()
+        supervisor = asyncio.create_task(self.supervise())
+        logging.info("Cluster front: %d workers, mode %s", len(self.slots), BOT_MODE)
+
+        runner: Optional[web.AppRunner] = None
+        poller: Optional[asyncio.Task] = None
+        if BOT_MODE == "webhook":
+            from aiohttp import web
+
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, self._webhook)
+            if ICS_FEED_TOKEN:
+                app.router.add_get("/calendar/{token}.ics", ics_feed_handler)
+            runner = web.AppRunner(app, handle_signals=False)
+            await runner.setup()
+            await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+            if WEBHOOK_URL:
+                await bot.set_webhook(
+                    WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=dp.resolve_used_update_types(),
+                )
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(self._poll())
+
+        stop = asyncio.Event()
+        restarts: Set[asyncio.Task] = set()
+
+        def on_hup() -> None:
+            task = asyncio.create_task(self.rolling_restart())
+            restarts.add(task)
+            task.add_done_callback(restarts.discard)
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with suppress(NotImplementedError):
+                loop.add_signal_handler(sig, stop.set)
+        with suppress(NotImplementedError, AttributeError):
+            loop.add_signal_handler(signal.SIGHUP, on_hup)
+
+        try:
+            await stop.wait()
+        finally:
+            # сначала перестаём принимать, потом даём воркерам доработать своё
+            if poller is not None:
+                poller.cancel()
+            if runner is not None:
+                await runner.cleanup()
+            self._stopping = True
+            supervisor.cancel()
+            for task in list(restarts):
+                task.cancel()
+            await asyncio.gather(*(self._stop_worker(slot, graceful=True) for slot in self.slots))
+            await bot.session.close()
+            logging.info("Cluster front stopped, %d updates routed", self.routed)
+
 # ================= MAIN =================
 
+# длительность этапов старта, секунды: видно в /metrics и в bench_startup.py
+startup_phases: Dict[str, float] = {}
+
+metrics.collected("bot_startup_seconds", "gauge", "Длительность этапов старта процесса",
+                  lambda: {(("phase", k),): v for k, v in startup_phases.items()})
+
+async def warm_up() -> None:
+    """
+    Некритичная часть старта, уже после того как бот принимает апдейты:
+    грузим занятость на текущий и следующий месяц, чтобы первый клиент
+    не ждал этого запроса в своём хендлере.
+    """
+    started = time.perf_counter()
+    try:
+        for year, month, _ in next_months(2):
+            await availability.ensure_month(year, month)
+    except Exception:
+        logging.exception("Warm-up failed")
+    startup_phases["warm_up"] = time.perf_counter() - started
+
+async def startup_phase(name: str, coro: Awaitable[Any]) -> Any:
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        startup_phases[name] = time.perf_counter() - started
+
+async def clear_webhook(bot: Bot) -> None:
+    # если раньше стоял вебхук, getUpdates с ним конфликтует; me() кэшируется и для start_polling
+    await bot.delete_webhook()
+    await bot.me()
+
+async def open_bot_and_clear_webhook() -> Bot:
+    bot = await startup_phase("tls", open_bot())
+    if BOT_MODE != "webhook" and BOT_WORKERS <= 1:
+        await startup_phase("api", clear_webhook(bot))
+    return bot
+
 async def main():
-    await init_db()
-    await dp.start_polling(bot)
+    log_pipeline.start()
+    started = time.perf_counter()
+    await startup_phase("db_open", database.open())
+    archiver: Optional[asyncio.Task] = None
+    warmer: Optional[asyncio.Task] = None
+    metrics_runner: Optional[web.AppRunner] = None
+    try:
+        # бот с TLS-контекстом и (в polling) снятие вебхука — параллельно с миграциями
+        _, bot = await asyncio.gather(startup_phase("db_init", init_db()), open_bot_and_clear_webhook())
+        await startup_phase(
+            "services",
+            asyncio.gather(masters.load(), outbox.start(bot), reminders.start(), waitlist.start(), broadcaster.start(bot)),
+        )
+        metrics_runner = await start_metrics_server()
+        archiver = asyncio.create_task(archive_loop())
+        startup_phases["ready"] = time.perf_counter() - started
+        logging.info("Ready to take updates in %.0f ms", startup_phases["ready"] * 1000)
+        if BOT_WORKERS > 1:
+            await ClusterFront(BOT_WORKERS).run(bot)
+        elif BOT_MODE == "webhook":
+            warmer = asyncio.create_task(warm_up())
+            await run_webhook(bot)
+        else:
+            warmer = asyncio.create_task(warm_up())
+            await dp.start_polling(bot)
+    finally:
+        for task in (archiver, warmer):
+            if task is not None:
+                task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await broadcaster.stop()
+        await waitlist.stop()
+        await reminders.stop()
+        await outbox.stop()
+        await user_registry.close()
+        await audit_log.close()
+        await database.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
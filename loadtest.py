@@ -0,0 +1,408 @@
+"""
+Нагрузочный прогон bot.py без Telegram.
+
+Поднимает локальный фейковый Bot API (aiohttp), направляет на него бота через
+TELEGRAM_API_URL и прогоняет тысячи синтетических клиентов по живому сценарию:
+/start → menu:book → месяц → день → (мастер) → время → контакт → юзернейм,
+часть клиентов потом отменяет запись. Клиенты «нажимают» только те кнопки,
+которые бот им реально показал, и толкаются за небольшой набор дней.
+
+Итог: пропускная способность, p50/p95/p99 по хендлерам, запросы к SQLite,
+вызовы Bot API и доля конфликтов при бронировании.
+
+    python loadtest.py --users 2000 --days 2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+FAKE_API_HOST = "127.0.0.1"
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Нагрузочный прогон бота на фейковом Bot API")
+    p.add_argument("--users", type=int, default=1000, help="сколько клиентов (все одновременно)")
+    p.add_argument("--days", type=int, default=3, help="из скольких ближайших дней клиенты выбирают — чем меньше, тем больше конфликтов")
+    p.add_argument("--cancel-rate", type=float, default=0.2, help="доля записавшихся, которые потом отменяют")
+    p.add_argument("--retries", type=int, default=3, help="сколько раз клиент пробует другое время после конфликта")
+    p.add_argument("--waitlist-rate", type=float, default=0.3, help="доля клиентов, встающих в лист ожидания на занятый день")
+    p.add_argument("--repeat-rate", type=float, default=0.1, help="доля нажатий, которые нетерпеливый клиент повторяет")
+    p.add_argument("--think", type=float, default=0.0, help="пауза клиента между шагами, сек (случайная 0..think)")
+    p.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа фейкового Bot API, сек")
+    p.add_argument("--port", type=int, default=18181)
+    p.add_argument("--db", default="", help="файл базы (по умолчанию — временный)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="итог одной JSON-строкой")
+    return p.parse_args()
+
+args = parse_args()
+
+# бот читает настройки при импорте — окружение готовим до него
+_tmpdir = tempfile.mkdtemp(prefix="loadtest-")
+os.environ["API_TOKEN"] = "123456:LOADTEST"
+os.environ.setdefault("MASTER_CHAT_ID", "1")
+os.environ["DB_PATH"] = args.db or os.path.join(_tmpdir, "loadtest.db")
+os.environ["TELEGRAM_API_URL"] = f"http://{FAKE_API_HOST}:{args.port}"
+os.environ["BOT_MODE"] = "polling"
+# фейковому API лимиты Telegram не нужны — меряем бота, а не ведро токенов
+os.environ.setdefault("OUTBOX_GLOBAL_RATE", "100000")
+os.environ.setdefault("OUTBOX_CHAT_RATE", "100000")
+os.environ.setdefault("OUTBOX_DIGEST_WINDOW", "0.2")
+# синтетические клиенты жмут кнопки без пауз — антифлуд отрезал бы их сценарий
+os.environ.setdefault("FLOOD_RATE", "100000")
+os.environ.setdefault("FLOOD_BURST", "100000")
+
+from aiogram.types import Update  # noqa: E402
+
+import bot  # noqa: E402
+
+# ================= ФЕЙКОВЫЙ BOT API =================
+
+class FakeTelegram:
+    """
+    Отвечает на вызовы Bot API правдоподобными заглушками и запоминает,
+    какие инлайн-кнопки и алерты бот показал каждому чату.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.api_ms: Dict[str, List[float]] = defaultdict(list)
+        self.keyboards: Dict[int, Deque[List[str]]] = defaultdict(lambda: deque(maxlen=4))
+        self.alerts: Dict[int, str] = {}
+        self.texts: Dict[int, Deque[str]] = defaultdict(lambda: deque(maxlen=4))
+        # что сейчас показано в сообщении: Telegram отвергает правку, которая ничего не меняет
+        self.rendered: Dict[Tuple[int, int], Tuple[str, str]] = {}
+        self._ids = itertools.count(1000)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        started = time.perf_counter()
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result: Any = True
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(data.get("chat_id", 0))
+            message_id = int(data["message_id"]) if method == "editMessageText" else next(self._ids)
+            content = (str(data.get("text", "")), str(data.get("reply_markup", "")))
+            if method == "editMessageText" and self.rendered.get((chat_id, message_id)) == content:
+                self.calls["editMessageText (not modified)"] += 1
+                return web.json_response(
+                    {"ok": False, "error_code": 400, "description": "Bad Request: message is not modified"},
+                    status=400,
+                )
+            self.rendered[(chat_id, message_id)] = content
+            self.texts[chat_id].append(str(data.get("text", "")))
+            markup = json.loads(data["reply_markup"]) if data.get("reply_markup") else {}
+            if "inline_keyboard" in markup:
+                self.keyboards[chat_id].append(
+                    [b["callback_data"] for row in markup["inline_keyboard"] for b in row if b.get("callback_data")]
+                )
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": str(data.get("text", "")),
+            }
+        elif method == "answerCallbackQuery":
+            if data.get("show_alert") in ("true", "True", "1") and data.get("text"):
+                # id колбэка = "<user_id>:<n>", см. VirtualUser.click
+                self.alerts[int(str(data["callback_query_id"]).split(":")[0])] = str(data["text"])
+
+        self.api_ms[method].append((time.perf_counter() - started) * 1000)
+        return web.json_response({"ok": True, "result": result})
+
+    def buttons(self, chat_id: int, prefix: str) -> List[str]:
+        # свежие клавиатуры первыми: outbox может прислать меню позже ответа хендлера
+        for kb in reversed(self.keyboards[chat_id]):
+            found = [d for d in kb if d.startswith(prefix)]
+            if found:
+                return found
+        return []
+
+    async def serve(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, FAKE_API_HOST, port).start()
+        return runner
+
+# ================= ЗАМЕРЫ =================
+
+class Stats:
+    def __init__(self) -> None:
+        self.handler_ms: Dict[str, List[float]] = defaultdict(list)
+        self.updates = 0
+        self.errors = 0
+        self.sql: Counter = Counter()
+        self.outcomes: Counter = Counter()
+
+    async def middleware(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.handler_ms[name].append((time.perf_counter() - started) * 1000)
+
+    def trace_sql(self, statement: str) -> None:
+        # вызывается из потока sqlite; Counter под GIL тут достаточно
+        self.sql[statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"] += 1
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+# ================= ВИРТУАЛЬНЫЕ КЛИЕНТЫ =================
+
+class VirtualUser:
+    def __init__(self, user_id: int, fake: FakeTelegram, stats: Stats, rnd: random.Random):
+        self.id = user_id
+        self.fake = fake
+        self.stats = stats
+        self.rnd = rnd
+        self._seq = itertools.count(1)
+        # дни, на которые бот уже ответил «всё занято» — их клиент больше не выбирает
+        self.full_days: set = set()
+
+    def _from(self) -> Dict[str, Any]:
+        user: Dict[str, Any] = {"id": self.id, "is_bot": False, "first_name": "Load"}
+        # у каждого четвёртого нет юзернейма в Telegram — у бота для них своя ветка
+        if self.id % 4:
+            user["username"] = f"load{self.id}"
+        return user
+
+    async def _feed(self, update: Dict[str, Any]) -> None:
+        if args.think:
+            await asyncio.sleep(self.rnd.uniform(0, args.think))
+        update["update_id"] = next(self._seq) + self.id * 1000
+        self.stats.updates += 1
+        await bot.dp.feed_update(bot.bot, Update.model_validate(update))
+
+    async def send(self, text: Optional[str] = None, phone: Optional[str] = None) -> None:
+        msg: Dict[str, Any] = {
+            "message_id": next(self._seq),
+            "date": int(time.time()),
+            "chat": {"id": self.id, "type": "private"},
+            "from": self._from(),
+        }
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if phone is not None:
+            msg["contact"] = {"phone_number": phone, "first_name": "Load", "user_id": self.id}
+        await self._feed({"message": msg})
+
+    async def click(self, data: str) -> Optional[str]:
+        """Нажимает кнопку; возвращает текст алерта, если бот ответил отказом."""
+        self.fake.alerts.pop(self.id, None)
+        await self._click(data)
+        alert = self.fake.alerts.pop(self.id, None)
+        if self.rnd.random() < args.repeat_rate:
+            # та же кнопка ещё раз, когда первое нажатие уже отработало
+            await self._click(data)
+            self.fake.alerts.pop(self.id, None)
+        return alert
+
+    async def _click(self, data: str) -> None:
+        await self._feed({
+            "callback_query": {
+                "id": f"{self.id}:{next(self._seq)}",
+                "chat_instance": "loadtest",
+                "data": data,
+                "from": self._from(),
+                "message": {"message_id": 1, "date": 1, "chat": {"id": self.id, "type": "private"}, "text": "-"},
+            }
+        })
+
+    def shown(self, prefix: str) -> bool:
+        """Есть ли кнопки с таким префиксом в последней показанной клавиатуре."""
+        kbs = self.fake.keyboards[self.id]
+        return bool(kbs) and any(d.startswith(prefix) for d in kbs[-1])
+
+    def pick(self, prefix: str, first: int = 0) -> Optional[str]:
+        options = [o for o in self.fake.buttons(self.id, prefix) if o not in self.full_days]
+        if first:
+            options = options[:first]
+        return self.rnd.choice(options) if options else None
+
+    async def run(self) -> None:
+        await self.send("/start")
+        await self.click(bot.BOOK_CB.pack())
+        service = self.pick(bot.SERVICE_CB.head)
+        if service:
+            await self.click(service)
+        month = self.pick(bot.MONTH_CB.head, first=1)
+        if not month:
+            self.stats.outcomes["no_months"] += 1
+            return
+        await self.click(month)
+
+        for attempt in range(args.retries + 1):
+            day = self.pick(bot.DAY_CB.head, first=args.days)
+            if not day:
+                self.stats.outcomes["no_free_days"] += 1
+                return
+            if await self.click(day):
+                self.stats.outcomes["conflict_day_full"] += 1
+                continue
+            if self.shown(bot.WAIT_CB.head):
+                # день занят целиком — бот предложил лист ожидания
+                self.full_days.add(day)
+                self.stats.outcomes["conflict_day_full"] += 1
+                if self.rnd.random() < args.waitlist_rate:
+                    await self.click(self.pick(bot.WAIT_CB.head))
+                    self.stats.outcomes["waitlisted"] += 1
+                await self.click(self.pick(bot.BACK_DAYS_CB.head))
+                continue
+            master = self.pick(bot.MASTER_CB.head)
+            if master and await self.click(master):
+                self.stats.outcomes["conflict_master_full"] += 1
+                continue
+            slot = self.pick(bot.TIME_CB.head, first=4)
+            if not slot:
+                self.stats.outcomes["no_free_times"] += 1
+                continue
+            alert = await self.click(slot)
+            if alert:
+                self.stats.outcomes["conflict_held" if "бронирует" in alert else "conflict_taken"] += 1
+                continue
+
+            await self.send(phone=f"+7900{self.id:07d}")
+            await self.send(text=f"@load{self.id}")
+            if any("только что заняли" in t for t in self.fake.texts[self.id]):
+                self.fake.texts[self.id].clear()
+                self.stats.outcomes["conflict_insert"] += 1
+                await self.click(bot.BOOK_CB.pack())
+                await self.click(month)
+                continue
+            self.stats.outcomes["booked"] += 1
+            break
+        else:
+            self.stats.outcomes["gave_up"] += 1
+            return
+
+        if self.rnd.random() < args.cancel_rate:
+            await self.click(bot.MY_CANCEL_CB.pack())
+            cancel = self.pick(bot.CANCEL_CB.head)
+            if cancel and not await self.click(cancel):
+                self.stats.outcomes["cancelled"] += 1
+
+# ================= ОТЧЁТ =================
+
+def report(stats: Stats, fake: FakeTelegram, elapsed: float) -> Dict[str, Any]:
+    o = stats.outcomes
+    attempts = sum(v for k, v in o.items() if k.startswith("conflict_")) + o["booked"]
+    return {
+        "users": args.users,
+        "elapsed_s": round(elapsed, 3),
+        "updates": stats.updates,
+        "updates_per_s": round(stats.updates / elapsed, 1) if elapsed else 0.0,
+        "bookings_per_s": round(o["booked"] / elapsed, 1) if elapsed else 0.0,
+        "handler_errors": stats.errors,
+        "handlers": {
+            name: {
+                "count": len(ms),
+                "p50_ms": round(percentile(ms, 0.50), 2),
+                "p95_ms": round(percentile(ms, 0.95), 2),
+                "p99_ms": round(percentile(ms, 0.99), 2),
+                "max_ms": round(max(ms), 2),
+            }
+            for name, ms in sorted(stats.handler_ms.items())
+        },
+        "sql": dict(stats.sql.most_common()),
+        "sql_per_update": round(sum(stats.sql.values()) / stats.updates, 2) if stats.updates else 0.0,
+        "api_calls": dict(fake.calls.most_common()),
+        "outcomes": dict(o.most_common()),
+        "conflict_rate": round(1 - o["booked"] / attempts, 4) if attempts else 0.0,
+        "outbox": bot.outbox.stats(),
+        "api_saved": {f"{flow}/{reason}": n for (flow, reason), n in sorted(bot.api_calls.saved.items())},
+    }
+
+def print_report(r: Dict[str, Any]) -> None:
+    print(f"\nКлиентов: {r['users']}, время: {r['elapsed_s']} с, апдейтов: {r['updates']}")
+    print(f"Пропускная способность: {r['updates_per_s']} апд/с, {r['bookings_per_s']} записей/с")
+    print(f"Ошибок в хендлерах: {r['handler_errors']}\n")
+    print(f"{'хендлер':<20}{'вызовов':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for name, h in r["handlers"].items():
+        print(f"{name:<20}{h['count']:>9}{h['p50_ms']:>10}{h['p95_ms']:>10}{h['p99_ms']:>10}{h['max_ms']:>10}")
+    print(f"\nSQL ({r['sql_per_update']} на апдейт): " + ", ".join(f"{k} {v}" for k, v in r["sql"].items()))
+    print("Bot API: " + ", ".join(f"{k} {v}" for k, v in r["api_calls"].items()))
+    print(f"Сэкономлено вызовов API ({sum(r['api_saved'].values())}): "
+          + (", ".join(f"{k} {v}" for k, v in r["api_saved"].items()) or "—"))
+    print("Исходы: " + ", ".join(f"{k} {v}" for k, v in r["outcomes"].items()))
+    print(f"Доля конфликтов при бронировании: {r['conflict_rate']:.2%}")
+    print(f"Outbox: {r['outbox']}")
+
+# ================= MAIN =================
+
+async def main() -> None:
+    fake = FakeTelegram(args.api_latency)
+    stats = Stats()
+    runner = await fake.serve(args.port)
+
+    bot.dp.message.middleware(stats.middleware)
+    bot.dp.callback_query.middleware(stats.middleware)
+
+    await bot.database.open()
+    tg = await bot.open_bot()
+    try:
+        await bot.init_db()
+        await bot.masters.load()
+        for conn in [bot.database._writer, *bot.database._readers]:
+            await conn.set_trace_callback(stats.trace_sql)
+        await bot.outbox.start(tg)
+        await bot.reminders.start()
+
+        rnd = random.Random(args.seed)
+        users = [VirtualUser(100_000 + i, fake, stats, random.Random(rnd.random())) for i in range(args.users)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(u.run() for u in users), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        for exc in [r for r in results if isinstance(r, BaseException)][:3]:
+            print(f"Клиент упал: {exc!r}")
+
+        # даём outbox разослать подтверждения, чтобы в отчёт попали и они
+        deadline = time.monotonic() + 30
+        while bot.outbox.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        r = report(stats, fake, elapsed)
+        print(json.dumps(r, ensure_ascii=False) if args.json else "", end="")
+        if not args.json:
+            print_report(r)
+    finally:
+        await bot.reminders.stop()
+        await bot.outbox.stop()
+        await bot.dp.storage.close()
+        await bot.database.close()
+        await tg.session.close()
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
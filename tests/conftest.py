@@ -0,0 +1,270 @@
+"""
+Общая обвязка тестов: фейковый Bot API на локальном порту и бот, направленный на него
+через TELEGRAM_API_URL, — как в loadtest.py, только с проверками.
+
+bot.py читает настройки при импорте, поэтому окружение готовится до него. Модуль держит
+глобальное состояние (база, индексы, outbox), поэтому event loop и база общие на всю
+сессию, а тесты не мешают друг другу за счёт своих пользователей и своих дат.
+
+    python -m pytest -q
+"""
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pytest
+
+FAKE_API_HOST = "127.0.0.1"
+MASTER_CHAT_ID = 1
+WEBHOOK_SECRET = "test-secret"
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind((FAKE_API_HOST, 0))
+        return s.getsockname()[1]
+
+_tmpdir = tempfile.mkdtemp(prefix="bot-tests-")
+FAKE_API_PORT = _free_port()
+os.environ.update({
+    "API_TOKEN": "123456:TEST",
+    "MASTER_CHAT_ID": str(MASTER_CHAT_ID),
+    "DB_PATH": os.path.join(_tmpdir, "bot.db"),
+    "EXPORT_DIR": os.path.join(_tmpdir, "exports"),
+    "TELEGRAM_API_URL": f"http://{FAKE_API_HOST}:{FAKE_API_PORT}",
+    "BOT_MODE": "webhook",
+    "WEBHOOK_SECRET": WEBHOOK_SECRET,
+    "METRICS_PORT": "0",
+    # два слота в день, все дни рабочие — занять день целиком легко
+    "SCHEDULE_JSON": json.dumps({
+        "step": 60,
+        "weekdays": {str(wd): {"start": "10:00", "end": "12:00"} for wd in range(7)},
+        "services": [{"code": "mani", "title": "Маникюр", "duration": 60}],
+    }),
+    "FSM_FLUSH_DELAY": "0.05",
+    "OUTBOX_DIGEST_WINDOW": "0.05",
+    "OUTBOX_GLOBAL_RATE": "100000",
+    "OUTBOX_CHAT_RATE": "100000",
+    "FLOOD_RATE": "100000",
+    "FLOOD_BURST": "100000",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.types import Update  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+
+# ================= ФЕЙКОВЫЙ BOT API =================
+
+class FakeTelegram:
+    """
+    Отвечает на вызовы Bot API правдоподобными заглушками и записывает каждый вызов.
+    fail(chat_id, ...) заставляет ответить ошибкой на ближайшие отправки в этот чат.
+    """
+
+    def __init__(self) -> None:
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self._failures: Dict[int, List[Tuple[int, Dict[str, Any]]]] = defaultdict(list)
+        self._ids = itertools.count(1000)
+
+    def fail(self, chat_id: int, status: int, description: str, times: int = 1, **parameters: Any) -> None:
+        body: Dict[str, Any] = {"ok": False, "error_code": status, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        self._failures[chat_id].extend([(status, body)] * times)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls.append((method, data))
+
+        chat_id = int(data.get("chat_id", 0) or 0)
+        if method == "sendMessage" and self._failures.get(chat_id):
+            status, body = self._failures[chat_id].pop(0)
+            return web.json_response(body, status=status)
+
+        result: Any = True
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {
+                "message_id": int(data["message_id"]) if method == "editMessageText" else next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": str(data.get("text", "")),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    async def serve(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, FAKE_API_HOST, port).start()
+        return runner
+
+    def sent(self, chat_id: int, method: str = "sendMessage") -> List[Dict[str, Any]]:
+        return [d for m, d in self.calls if m == method and int(d.get("chat_id", 0) or 0) == chat_id]
+
+    def texts(self, chat_id: int) -> List[str]:
+        """Тексты, показанные в чате: новые сообщения и правки, по порядку."""
+        return [
+            str(d.get("text", ""))
+            for m, d in self.calls
+            if m in ("sendMessage", "editMessageText") and int(d.get("chat_id", 0) or 0) == chat_id
+        ]
+
+    def buttons(self, chat_id: int, prefix: str) -> List[str]:
+        """callback_data с таким префиксом из последней клавиатуры, где они были."""
+        for m, d in reversed(self.calls):
+            if m not in ("sendMessage", "editMessageText") or int(d.get("chat_id", 0) or 0) != chat_id:
+                continue
+            markup = json.loads(d["reply_markup"]) if d.get("reply_markup") else {}
+            found = [
+                b["callback_data"]
+                for row in markup.get("inline_keyboard", [])
+                for b in row
+                if b.get("callback_data", "").startswith(prefix)
+            ]
+            if found:
+                return found
+        return []
+
+    def alerts(self, user_id: int) -> List[str]:
+        # id колбэка = "<user_id>:<n>", см. Client.click
+        return [
+            str(d["text"])
+            for m, d in self.calls
+            if m == "answerCallbackQuery"
+            and str(d.get("callback_query_id", "")).split(":")[0] == str(user_id)
+            and d.get("show_alert") in ("true", "True", "1")
+        ]
+
+# ================= КЛИЕНТ =================
+
+class Client:
+    """Пользователь Telegram: шлёт боту апдейты так, как их прислал бы Telegram."""
+
+    _seq = itertools.count(1)
+
+    def __init__(self, user_id: int, username: Optional[str] = None):
+        self.id = user_id
+        self.username = username
+
+    def _from(self) -> Dict[str, Any]:
+        user: Dict[str, Any] = {"id": self.id, "is_bot": False, "first_name": "Test"}
+        if self.username:
+            user["username"] = self.username
+        return user
+
+    def message(self, text: Optional[str] = None, phone: Optional[str] = None) -> Dict[str, Any]:
+        msg: Dict[str, Any] = {
+            "message_id": next(self._seq),
+            "date": int(time.time()),
+            "chat": {"id": self.id, "type": "private"},
+            "from": self._from(),
+        }
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if phone is not None:
+            msg["contact"] = {"phone_number": phone, "first_name": "Test", "user_id": self.id}
+        return {"update_id": next(self._seq), "message": msg}
+
+    def callback(self, data: str) -> Dict[str, Any]:
+        return {
+            "update_id": next(self._seq),
+            "callback_query": {
+                "id": f"{self.id}:{next(self._seq)}",
+                "chat_instance": "test",
+                "data": data,
+                "from": self._from(),
+                "message": {"message_id": 1, "date": 1, "chat": {"id": self.id, "type": "private"}, "text": "-"},
+            },
+        }
+
+    async def send(self, text: Optional[str] = None, phone: Optional[str] = None) -> None:
+        await bot.dp.feed_update(bot.bot, Update.model_validate(self.message(text, phone)))
+
+    async def click(self, data: str) -> None:
+        await bot.dp.feed_update(bot.bot, Update.model_validate(self.callback(data)))
+
+    async def book(self, date_iso: str, time_str: str, phone: str) -> None:
+        """Весь сценарий записи: день → время → контакт → юзернейм."""
+        await self.click(bot.DAY_CB.pack(date_iso))
+        await self.click(bot.TIME_CB.pack(date_iso, time_str))
+        await self.send(phone=phone)
+        if self.username:
+            await self.click(bot.UNAME_KEEP_CB.pack())
+        else:
+            await self.send(text="Тест")
+
+# ================= ОБВЯЗКА =================
+
+class Harness:
+    def __init__(self, loop: asyncio.AbstractEventLoop, fake: FakeTelegram):
+        self.loop = loop
+        self.fake = fake
+        self._users = itertools.count(10_000)
+        self._days = itertools.count(2)
+
+    def run(self, coro: Awaitable[Any], timeout: float = 20) -> Any:
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def client(self, username: bool = True) -> Client:
+        user_id = next(self._users)
+        return Client(user_id, f"user{user_id}" if username else None)
+
+    def day(self) -> str:
+        """Своя дата на каждый вызов — тесты не делят слоты."""
+        return (datetime.date.today() + datetime.timedelta(days=next(self._days))).isoformat()
+
+    async def until(self, predicate: Callable[[], bool], timeout: float = 5) -> None:
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                raise AssertionError("condition not met in time")
+            await asyncio.sleep(0.02)
+
+async def _start(fake: FakeTelegram) -> web.AppRunner:
+    runner = await fake.serve(FAKE_API_PORT)
+    await bot.database.open()
+    await bot.open_bot()
+    await bot.init_db()
+    await bot.masters.load()
+    await bot.outbox.start(bot.bot)
+    await bot.reminders.start()
+    await bot.waitlist.start()
+    return runner
+
+async def _stop(runner: web.AppRunner) -> None:
+    await bot.waitlist.stop()
+    await bot.reminders.stop()
+    await bot.outbox.stop()
+    await bot.dp.storage.close()
+    await bot.audit_log.close()
+    await bot.database.close()
+    await bot.bot.session.close()
+    await runner.cleanup()
+
+@pytest.fixture(scope="session")
+def tg() -> Iterator[Harness]:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    fake = FakeTelegram()
+    runner = loop.run_until_complete(_start(fake))
+    try:
+        yield Harness(loop, fake)
+    finally:
+        loop.run_until_complete(_stop(runner))
+        loop.close()
+        asyncio.set_event_loop(None)
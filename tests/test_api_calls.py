@@ -0,0 +1,36 @@
+"""ApiCallReducer: повторный ответ на колбэк не уходит, а потерянный алерт виден в логе."""
+import logging
+from typing import Any, List
+
+from aiogram.methods import AnswerCallbackQuery
+
+import bot
+from conftest import Harness
+
+def _answer(tg: Harness, sent: List[Any], query_id: str, **kwargs: Any) -> Any:
+    async def make_request(_bot: Any, method: Any) -> bool:
+        sent.append(method)
+        return True
+
+    return tg.run(bot.api_calls(make_request, bot.bot, AnswerCallbackQuery(callback_query_id=query_id, **kwargs)))
+
+def test_repeated_answer_is_saved(tg: Harness):
+    sent: List[Any] = []
+    saved = sum(bot.api_calls.saved.values())
+    query_id = f"{tg.client().id}:1"
+    assert _answer(tg, sent, query_id) is True
+    assert _answer(tg, sent, query_id) is True
+    assert len(sent) == 1
+    assert sum(bot.api_calls.saved.values()) == saved + 1
+
+def test_repeated_alert_is_logged(tg: Harness, caplog):
+    sent: List[Any] = []
+    saved = sum(bot.api_calls.saved.values())
+    query_id = f"{tg.client().id}:1"
+    _answer(tg, sent, query_id)
+    with caplog.at_level(logging.WARNING):
+        _answer(tg, sent, query_id, text="Слот занят", show_alert=True)
+    assert len(sent) == 1
+    # это не экономия, а потерянный алерт
+    assert sum(bot.api_calls.saved.values()) == saved
+    assert any("Слот занят" in r.getMessage() for r in caplog.records)
@@ -0,0 +1,112 @@
+"""Сквозные сценарии через dp.feed_update: бронь слота, запись, отмена, лист ожидания, журнал."""
+from typing import List, Tuple
+
+import bot
+from conftest import MASTER_CHAT_ID, Client, Harness
+
+async def _audit(user_id: int) -> List[Tuple[str, str, str]]:
+    await bot.audit_log.flush()
+    rows = await bot.database.fetchall(
+        "SELECT event, date, time FROM audit_log WHERE user_id=? ORDER BY id", (user_id,)
+    )
+    return [tuple(r) for r in rows]
+
+def _appointment_id(tg: Harness, user: Client) -> int:
+    apps = tg.run(bot.list_user_appointments(user.id))
+    assert len(apps) == 1
+    return apps[0][0]
+
+def test_hold_blocks_second_client_until_released(tg: Harness):
+    first, second = tg.client(), tg.client()
+    date_iso = tg.day()
+    slot = bot.TIME_CB.pack(date_iso, "10:00")
+
+    async def scenario():
+        await first.click(bot.DAY_CB.pack(date_iso))
+        await first.click(slot)
+        await second.click(bot.DAY_CB.pack(date_iso))
+        await second.click(slot)
+        # первый передумал — слот снова можно взять
+        await first.send("/start")
+        await second.click(slot)
+
+    tg.run(scenario())
+    alerts = tg.fake.alerts(second.id)
+    assert len(alerts) == 1 and "бронирует другой клиент" in alerts[0]
+    assert "Слот закреплён за тобой" in tg.fake.texts(second.id)[-1]
+
+def test_booking_notifies_master_and_client(tg: Harness):
+    user = tg.client()
+    date_iso = tg.day()
+    tg.run(user.book(date_iso, "11:00", "+79000000002"))
+
+    async def delivered():
+        await tg.until(lambda: any("Запись создана" in t for t in tg.fake.texts(user.id)))
+        await tg.until(lambda: any(f"User ID: {user.id}" in t for t in tg.fake.texts(MASTER_CHAT_ID)))
+
+    tg.run(delivered())
+    assert tg.run(bot.list_user_appointments(user.id))[0][1:3] == (date_iso, "11:00")
+    assert tg.run(_audit(user.id)) == [("create", date_iso, "11:00")]
+
+    # слот занят: второй клиент получает отказ ещё до брони
+    late = tg.client()
+    tg.run(late.click(bot.DAY_CB.pack(date_iso)))
+    tg.run(late.click(bot.TIME_CB.pack(date_iso, "11:00")))
+    assert "уже занят" in tg.fake.alerts(late.id)[0]
+
+def test_cancel_notifies_master_and_waitlist(tg: Harness):
+    first, second, waiting = tg.client(), tg.client(), tg.client(username=False)
+    date_iso = tg.day()
+    tg.run(first.book(date_iso, "10:00", "+79000000003"))
+    tg.run(second.book(date_iso, "11:00", "+79000000004"))
+
+    # день занят целиком — вместо времени бот предлагает лист ожидания
+    tg.run(waiting.click(bot.DAY_CB.pack(date_iso)))
+    offer = tg.fake.buttons(waiting.id, bot.WAIT_CB.head)
+    assert bot.WAIT_CB.pack(date_iso, 0) in offer
+    tg.run(waiting.click(bot.WAIT_CB.pack(date_iso, 0)))
+    assert bot.waitlist.entry(waiting.id, date_iso) is not None
+
+    app_id = _appointment_id(tg, first)
+    tg.run(first.click(bot.CANCEL_CB.pack(app_id)))
+
+    async def delivered():
+        await tg.until(lambda: any(f"ID записи: {app_id}" in t for t in tg.fake.texts(MASTER_CHAT_ID)))
+        await tg.until(lambda: any("Освободилось время" in t for t in tg.fake.texts(waiting.id)))
+
+    tg.run(delivered())
+    assert tg.run(bot.list_user_appointments(first.id)) == []
+    # кому написали, тот из листа убран — и в памяти, и в базе
+    assert bot.waitlist.entry(waiting.id, date_iso) is None
+    assert tg.run(bot.database.fetchone("SELECT 1 FROM waitlist WHERE user_id=?", (waiting.id,))) is None
+    assert tg.run(_audit(first.id)) == [("create", date_iso, "10:00"), ("cancel", date_iso, "10:00")]
+
+def test_cancel_of_foreign_appointment_is_refused(tg: Harness):
+    owner, stranger = tg.client(), tg.client()
+    date_iso = tg.day()
+    tg.run(owner.book(date_iso, "10:00", "+79000000005"))
+    app_id = _appointment_id(tg, owner)
+
+    tg.run(stranger.click(bot.CANCEL_CB.pack(app_id)))
+    assert "Не удалось отменить" in tg.fake.alerts(stranger.id)[0]
+    assert _appointment_id(tg, owner) == app_id
+
+def test_waitlist_limit_per_user(tg: Harness):
+    user = tg.client()
+    days = [tg.day() for _ in range(bot.WAITLIST_MAX_PER_USER + 1)]
+
+    async def join_all():
+        return [await bot.join_waitlist(user.id, d, 0, None) for d in days]
+
+    entries = tg.run(join_all())
+    assert all(e is not None for e in entries[:-1])
+    assert entries[-1] is None
+    # повторная подписка на ту же дату меняет окно, но не место в очереди
+    again = tg.run(bot.join_waitlist(user.id, days[0], 1, None))
+    assert again.id == entries[0].id and again.time_to == bot.WAITLIST_WINDOWS[1][2]
+    # запись на день снимает ожидание этого дня
+    assert tg.run(bot.create_appointment(user.id, days[0], "10:00", "+7", "u"))
+    assert bot.waitlist.entry(user.id, days[0]) is None
+    assert tg.run(bot.database.fetchone(
+        "SELECT 1 FROM waitlist WHERE user_id=? AND date=?", (user.id, days[0])
+    )) is None
@@ -0,0 +1,62 @@
+"""Кодеки callback_data и таблица префиксов CallbackRouter."""
+import pytest
+
+import bot
+from conftest import Harness
+
+CODECS = [
+    (bot.DAY_CB, ("2026-03-14",), bot.DayCb("2026-03-14")),
+    (bot.TIME_CB, ("2026-03-14", "09:05"), bot.TimeCb("2026-03-14", "09:05")),
+    (bot.MONTH_CB, (2026, 12), bot.MonthCb(2026, 12)),
+    (bot.WAIT_CB, ("2026-03-14", 2), bot.WaitCb("2026-03-14", 2)),
+    (bot.WAIT_CB, ("2026-03-14", None), bot.WaitCb("2026-03-14", None)),
+    (bot.MASTER_CB, ("2026-03-14", 7), bot.MasterCb("2026-03-14", 7)),
+    (bot.CANCEL_CB, (36 ** 8 - 1,), bot.CancelCb(36 ** 8 - 1)),
+    (bot.SERVICE_CB, ("mani",), bot.ServiceCb("mani")),
+]
+
+@pytest.mark.parametrize("codec, values, expected", CODECS)
+def test_pack_unpack_roundtrip(codec: bot.CallbackCodec, values, expected):
+    data = codec.pack(*values)
+    assert len(data.encode()) <= bot.CALLBACK_DATA_LIMIT
+    prefix, _, raw = data.partition(":")
+    assert prefix == codec.prefix
+    assert codec.unpack(raw) == expected
+
+def test_plain_codec_has_no_payload():
+    assert bot.BOOK_CB.pack() == "b"
+    assert bot.BOOK_CB.unpack("") is None
+    with pytest.raises(ValueError):
+        bot.BOOK_CB.unpack("junk")
+
+@pytest.mark.parametrize("codec, raw", [
+    (bot.TIME_CB, "x"),
+    (bot.MONTH_CB, "zz:1"),
+    (bot.WAIT_CB, f"{bot.DAY_CB.pack('2026-03-14')[2:]}:9"),
+    (bot.CANCEL_CB, "-1"),
+])
+def test_unpack_rejects_garbage(codec: bot.CallbackCodec, raw: str):
+    with pytest.raises(ValueError):
+        codec.unpack(raw)
+
+def test_pack_rejects_bad_values():
+    with pytest.raises(ValueError):
+        bot.SERVICE_CB.pack("a:b")
+    with pytest.raises(ValueError):
+        bot.TIME_CB.pack("2026-03-14")
+
+def test_router_refuses_duplicate_prefix():
+    router = bot.CallbackRouter()
+    router.route(bot.DAY_CB)(lambda call: None)
+    with pytest.raises(ValueError):
+        router.route(bot.CallbackCodec(bot.DAY_CB.prefix))(lambda call: None)
+
+def test_stale_button_returns_to_menu(tg: Harness):
+    user = tg.client()
+    # кнопка старой версии бота: префикс известен, данные — нет
+    tg.run(user.click("d:2026-03-14"))
+    tg.run(user.click("no-such-button"))
+    assert tg.fake.buttons(user.id, bot.BOOK_CB.prefix)
+    answers = [d.get("text") for m, d in tg.fake.calls if m == "answerCallbackQuery"
+               and str(d.get("callback_query_id", "")).startswith(f"{user.id}:")]
+    assert answers == ["Эта кнопка устарела — вот актуальное меню."] * 2
@@ -0,0 +1,69 @@
+"""
+Брони в кластере: фронт разводит пересекающиеся брони воркеров, воркеры подчиняются фронту.
+Процессы не запускаются — события подаются фронту так, как их принёс бы _events_reader.
+"""
+import queue
+from typing import Any, List, Tuple
+
+import bot
+from conftest import Harness
+
+def _conflicts() -> float:
+    return bot.metrics._counters.get("bot_cluster_hold_conflicts_total", {}).get((), 0.0)
+
+def _drain(q: Any) -> List[Tuple[Any, ...]]:
+    out = []
+    while True:
+        try:
+            out.append(q.get(timeout=0.2))
+        except queue.Empty:
+            return out
+
+async def _release(*user_ids: int) -> None:
+    for user_id in user_ids:
+        bot.slot_holds.release(user_id)
+
+def test_front_rejects_conflicting_hold(tg: Harness):
+    front = bot.ClusterFront(3)
+    for slot in front.slots:
+        slot.process = object()  # «живой» воркер: события ему кладутся в очередь
+    first, second = tg.client().id, tg.client().id
+    date_iso = tg.day()
+    master_id = bot.DEFAULT_MASTER_ID
+    conflicts = _conflicts()
+
+    async def scenario():
+        front._on_event((0, "hold", first, master_id, date_iso, "10:00", 60))
+        # второй воркер успел забронировать пересекающийся слот у себя
+        front._on_event((1, "hold", second, master_id, date_iso, "10:30", 60))
+        return bot.slot_holds.holder(master_id, date_iso, "10:00"), bot.slot_holds.holder(master_id, date_iso, "10:30")
+
+    try:
+        assert tg.run(scenario()) == (first, None)
+        assert _conflicts() == conflicts + 1
+        # победившая бронь ушла всем, кроме источника; проигравшему — отказ
+        assert _drain(front.slots[0].queue) == []
+        assert _drain(front.slots[1].queue) == [
+            ("event", ("hold", first, master_id, date_iso, "10:00", 60)),
+            ("event", ("unhold", second, master_id, date_iso, "10:30")),
+        ]
+        assert _drain(front.slots[2].queue) == [("event", ("hold", first, master_id, date_iso, "10:00", 60))]
+    finally:
+        tg.run(_release(first, second))
+
+def test_worker_yields_to_front(tg: Harness):
+    first, second = tg.client().id, tg.client().id
+    date_iso = tg.day()
+    master_id = bot.DEFAULT_MASTER_ID
+
+    async def scenario():
+        assert bot.slot_holds.acquire(second, master_id, date_iso, "10:30", 60)
+        # бронь от фронта снимает пересекающуюся здешнюю, отказ по ней — уже пустой
+        bot.cluster.apply(("hold", first, master_id, date_iso, "10:00", 60))
+        bot.cluster.apply(("unhold", second, master_id, date_iso, "10:30"))
+        return bot.slot_holds.holder(master_id, date_iso, "10:00"), bot.slot_holds.holder(master_id, date_iso, "10:30")
+
+    try:
+        assert tg.run(scenario()) == (first, None)
+    finally:
+        tg.run(_release(first, second))
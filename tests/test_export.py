@@ -0,0 +1,86 @@
+"""Выгрузки CSV/ICS: содержимое, кеш по версии таблицы, команда /export мастера."""
+import csv
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import bot
+from conftest import MASTER_CHAT_ID, Client, Harness
+
+def _read(path: str, encoding: str) -> str:
+    with open(path, encoding=encoding, newline="") as f:
+        return f.read()
+
+def test_export_files_and_cache(tg: Harness):
+    date_iso = tg.day()
+    assert tg.run(bot.create_appointment(tg.client().id, date_iso, "10:00", "+79001112233", "@alice"))
+
+    path = tg.run(bot.export_cache.get("csv", date_iso, date_iso))
+    lines = _read(path, "utf-8-sig").splitlines()
+    assert lines[0].startswith("id,date,time")
+    assert len(lines) == 2 and "+79001112233" in lines[1] and "@alice" in lines[1]
+
+    hits = bot.export_cache.hits
+    assert tg.run(bot.export_cache.get("csv", date_iso, date_iso)) == path
+    assert bot.export_cache.hits == hits + 1
+
+    # новая запись меняет версию таблицы — файл собирается заново
+    assert tg.run(bot.create_appointment(tg.client().id, date_iso, "11:00", "+79004445566", "@bob"))
+    fresh = tg.run(bot.export_cache.get("csv", date_iso, date_iso))
+    assert fresh != path and len(_read(fresh, "utf-8-sig").splitlines()) == 3
+
+    ics = _read(tg.run(bot.export_cache.get("ics", date_iso, date_iso)), "utf-8")
+    assert ics.startswith("BEGIN:VCALENDAR\r\n") and ics.endswith("END:VCALENDAR\r\n")
+    assert ics.count("BEGIN:VEVENT") == 2
+    assert f"DTSTART:{date_iso.replace('-', '')}T100000" in ics
+
+def test_history_goes_before_live_rows(tg: Harness):
+    date_iso = tg.day()
+    user = tg.client()
+    assert tg.run(bot.create_appointment(user.id, date_iso, "10:00", "+7", "u"))
+
+    async def archive():
+        async with bot.database.write() as db:
+            await db.execute(
+                "INSERT INTO appointments_history(id, user_id, date, time, contact, created_at, duration, master_id) "
+                "VALUES(?, ?, '2000-01-01', '09:00', '+7', datetime('now'), 60, ?)",
+                (10 ** 9 + user.id, user.id, bot.DEFAULT_MASTER_ID),
+            )
+
+    tg.run(archive())
+    path = tg.run(bot.export_cache.get("csv", "2000-01-01", date_iso))
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.reader(f))[1:]
+    assert rows[0][1:3] == ["2000-01-01", "09:00"]
+    assert rows[-1][1:3] == [date_iso, "10:00"]
+    assert [r[1:3] for r in rows] == sorted(r[1:3] for r in rows)
+
+def test_ics_feed_token_is_compared_as_bytes(tg: Harness, monkeypatch):
+    monkeypatch.setattr(bot, "ICS_FEED_TOKEN", "календарь")
+
+    async def fetch(token: str) -> web.StreamResponse:
+        return await bot.ics_feed_handler(make_mocked_request("GET", "/", match_info={"token": token}))
+
+    # не-ASCII токен — обычный отказ, а не TypeError из compare_digest
+    with pytest.raises(web.HTTPNotFound):
+        tg.run(fetch("чужой"))
+    assert isinstance(tg.run(fetch("календарь")), web.FileResponse)
+
+def test_failed_export_returns_reader(tg: Harness, monkeypatch):
+    date_iso = tg.day()
+    assert tg.run(bot.create_appointment(tg.client().id, date_iso, "10:00", "+7", "u"))
+
+    def broken(self, rows):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(bot.CsvExport, "write", broken)
+    with pytest.raises(OSError):
+        tg.run(bot.export_cache.get("csv", date_iso, "2999-01-01"))
+    # соединение читателя вернулось в пул сразу, а не при сборке мусора
+    assert bot.database._pool.qsize() == bot.database.readers_count
+
+def test_export_command_sends_document(tg: Harness):
+    master = Client(MASTER_CHAT_ID)
+    tg.run(master.send("/export csv"))
+    assert tg.fake.sent(MASTER_CHAT_ID, "sendDocument")
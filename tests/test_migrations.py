@@ -0,0 +1,71 @@
+"""
+Миграции схемы на базе старой версии бота. Модуль bot держит одну базу на процесс,
+поэтому старая база поднимается в отдельном интерпретаторе.
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from typing import Any, Dict
+
+import bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MIGRATE = """
+import asyncio, json
+import bot
+
+async def main():
+    await bot.database.open()
+    try:
+        await bot.init_db()
+        await bot.init_db()
+        apps = await bot.list_user_appointments(77, only_future=False)
+        booked = await bot.create_appointment(78, "2099-03-02", "11:00", "+7", "u", master_id=bot.DEFAULT_MASTER_ID)
+        version = await bot.database.fetchone("PRAGMA user_version")
+        master = await bot.database.fetchone("SELECT chat_id FROM masters WHERE id=?", (bot.DEFAULT_MASTER_ID,))
+    finally:
+        await bot.database.close()
+    print(json.dumps({"apps": apps, "booked": booked, "version": version[0], "master_chat": master[0]}))
+
+asyncio.run(main())
+"""
+
+def _migrate(path: str) -> Dict[str, Any]:
+    env = {**os.environ, "DB_PATH": path, "MASTER_CHAT_ID": "555"}
+    out = subprocess.run(
+        [sys.executable, "-c", MIGRATE], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def test_legacy_database_is_migrated(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    # схема первой версии бота: без мастеров, длительности и user_version
+    conn.execute(
+        "CREATE TABLE appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+        "date TEXT NOT NULL, time TEXT NOT NULL, contact TEXT NOT NULL, "
+        "created_at TEXT NOT NULL DEFAULT (datetime('now')), UNIQUE(date, time))"
+    )
+    conn.execute("INSERT INTO appointments(user_id, date, time, contact) VALUES(77, '2099-03-02', '10:00', '+7')")
+    conn.commit()
+    conn.close()
+
+    result = _migrate(path)
+    assert result["version"] == bot.SCHEMA_VERSION
+    assert result["master_chat"] == 555
+    assert [a[1:4] for a in result["apps"]] == [["2099-03-02", "10:00", "+7"]]
+    assert result["booked"] is True
+
+    conn = sqlite3.connect(path)
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(appointments)")}
+    conn.close()
+    assert {"duration", "service", "master_id", "username"} <= columns
+
+def test_fresh_database_is_created(tmp_path):
+    result = _migrate(str(tmp_path / "fresh.db"))
+    assert result["version"] == bot.SCHEMA_VERSION
+    assert result["apps"] == []
+    assert result["booked"] is True
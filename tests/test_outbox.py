@@ -0,0 +1,46 @@
+"""Outbox: повтор после flood-wait и ошибок сервера, отказ от безнадёжных сообщений, сводки мастеру."""
+import bot
+from conftest import Harness
+
+def _enqueue(tg: Harness, *messages: bot.OutboxMessage) -> None:
+    tg.run(bot.outbox.enqueue(list(messages)))
+
+def test_retry_after_flood_wait(tg: Harness):
+    chat = tg.client().id
+    tg.fake.fail(chat, 429, "Too Many Requests: retry after 1", retry_after=1)
+    retried = bot.outbox.retried
+    # у первого клавиатура — значит, два отдельных сообщения, а не одно склеенное
+    _enqueue(tg, bot.OutboxMessage(chat, "первое", reply_markup=bot.main_menu_kb()), bot.OutboxMessage(chat, "второе"))
+
+    tg.run(tg.until(lambda: len(tg.fake.sent(chat)) == 3, timeout=10))
+    assert bot.outbox.retried == retried + 1
+    # отказ + оба сообщения по порядку: порядок в чате сохраняется
+    assert [d["text"] for d in tg.fake.sent(chat)] == ["первое", "первое", "второе"]
+
+def test_retry_with_backoff_after_server_error(tg: Harness):
+    chat = tg.client().id
+    tg.fake.fail(chat, 500, "Internal Server Error")
+    _enqueue(tg, bot.OutboxMessage(chat, "после ошибки"))
+
+    tg.run(tg.until(lambda: len(tg.fake.sent(chat)) == 2, timeout=10))
+    assert tg.fake.sent(chat)[-1]["text"] == "после ошибки"
+    assert tg.run(bot.database.fetchone("SELECT 1 FROM outbox WHERE chat_id=?", (chat,))) is None
+
+def test_blocked_chat_is_dropped(tg: Harness):
+    chat = tg.client().id
+    tg.fake.fail(chat, 403, "Forbidden: bot was blocked by the user")
+    dropped = bot.outbox.dropped
+    _enqueue(tg, bot.OutboxMessage(chat, "никогда не дойдёт"))
+
+    tg.run(tg.until(lambda: bot.outbox.dropped == dropped + 1))
+    assert len(tg.fake.sent(chat)) == 1
+    assert tg.run(bot.database.fetchone("SELECT 1 FROM outbox WHERE chat_id=?", (chat,))) is None
+
+def test_digest_merges_master_notices(tg: Harness):
+    chat = tg.client().id
+    _enqueue(tg, *(bot.OutboxMessage(chat, f"уведомление {i}", digest=True) for i in range(3)))
+
+    tg.run(tg.until(lambda: bool(tg.fake.sent(chat))))
+    sent = tg.fake.sent(chat)
+    assert len(sent) == 1
+    assert sent[0]["text"].startswith("📬 Сводка (3)")
@@ -0,0 +1,65 @@
+"""SQLiteStorage: состояние FSM переживает рестарт, новые пользователи не ходят в базу."""
+from aiogram.fsm.storage.base import StorageKey
+
+import bot
+from conftest import Harness
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+def test_state_survives_restart(tg: Harness):
+    key = _key(tg.client().id)
+
+    async def scenario():
+        storage = bot.SQLiteStorage(bot.database, flush_delay=0.01)
+        await storage.set_state(key, bot.BookingStates.waiting_phone)
+        await storage.update_data(key, {"date_iso": "2026-03-14", "time_str": "10:00"})
+        await storage.close()
+
+        # новый экземпляр — как после рестарта процесса
+        restarted = bot.SQLiteStorage(bot.database)
+        return await restarted.get_state(key), await restarted.get_data(key)
+
+    state, data = tg.run(scenario())
+    assert state == bot.BookingStates.waiting_phone.state
+    assert data == {"date_iso": "2026-03-14", "time_str": "10:00"}
+
+def test_cleared_state_is_deleted(tg: Harness):
+    key = _key(tg.client().id)
+
+    async def scenario():
+        storage = bot.SQLiteStorage(bot.database, flush_delay=0.01)
+        await storage.set_state(key, bot.BookingStates.choosing_date)
+        await storage.flush()
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        await storage.close()
+        return await bot.database.fetchone(bot.SQL_FSM_GET, (bot.SQLiteStorage._key(key),))
+
+    assert tg.run(scenario()) is None
+
+def test_unknown_key_skips_database(tg: Harness, monkeypatch):
+    reads = []
+    fetchone = bot.database.fetchone
+
+    async def counting(sql, params=()):
+        if sql == bot.SQL_FSM_GET:
+            reads.append(params)
+        return await fetchone(sql, params)
+
+    monkeypatch.setattr(bot.database, "fetchone", counting)
+    known = _key(tg.client().id)
+
+    async def scenario():
+        writer = bot.SQLiteStorage(bot.database, flush_delay=0.01)
+        await writer.set_state(known, bot.BookingStates.choosing_date)
+        await writer.close()
+
+        storage = bot.SQLiteStorage(bot.database)
+        # набор ключей поднимается один раз, дальше в базу ходят только за известными
+        for _ in range(5):
+            assert await storage.get_state(_key(tg.client().id)) is None
+        assert await storage.get_state(known) == bot.BookingStates.choosing_date.state
+
+    tg.run(scenario())
+    assert len(reads) == 1
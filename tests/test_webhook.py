@@ -0,0 +1,43 @@
+"""Вебхук: BoundedRequestHandler (SimpleRequestHandler aiogram) против фейкового Bot API."""
+from typing import Any, Dict, List
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+from conftest import WEBHOOK_SECRET, Harness
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+async def _post(updates: List[Dict[str, Any]], headers: Dict[str, str]) -> List[int]:
+    app, handler = bot.make_webhook_app(bot.bot)
+    async with TestClient(TestServer(app)) as client:
+        statuses = []
+        for update in updates:
+            resp = await client.post(bot.WEBHOOK_PATH, json=update, headers=headers)
+            statuses.append(resp.status)
+        # апдейты обрабатываются в фоне — ждём их до остановки сервера
+        await handler.drain(5)
+        resp = await client.post(bot.WEBHOOK_PATH, json=updates[0], headers=headers)
+        statuses.append(resp.status)
+    return statuses
+
+def test_webhook_rejects_wrong_secret(tg: Harness):
+    user = tg.client()
+    statuses = tg.run(_post([user.message("/start")], {SECRET_HEADER: "wrong"}))
+    assert statuses[0] == 401
+    assert tg.fake.sent(user.id) == []
+
+def test_webhook_rejects_non_ascii_secret(tg: Harness):
+    user = tg.client()
+    # заголовок приходит как есть; сравнение не должно падать с TypeError (500)
+    statuses = tg.run(_post([user.message("/start")], {SECRET_HEADER: "сек".encode().decode("latin-1")}))
+    assert statuses[0] == 401
+
+def test_webhook_feeds_update_and_replies(tg: Harness):
+    user = tg.client()
+    statuses = tg.run(_post([user.message("/start")], {SECRET_HEADER: WEBHOOK_SECRET}))
+    # 200 сразу, до обработки; после drain новые апдейты не принимаются — Telegram повторит их позже
+    assert statuses == [200, 503]
+    sent = tg.fake.sent(user.id)
+    assert len(sent) == 1
+    assert bot.BOOK_CB.pack() in sent[0]["reply_markup"]